@@ -6,6 +6,7 @@ from django.utils import timezone
 from django.db.models import Count, Q
 from datetime import datetime, timedelta
 from .models import PrintOrderFlat, OrderProgress
+from . import daily_rollup
 import json
 from crm.models import AIAssistantMemory
 
@@ -18,44 +19,38 @@ class AIAssistant:
         self.yesterday = self.today - timedelta(days=1)
         self.week_ago = self.today - timedelta(days=7)
         
+    def _refresh_dates(self):
+        """全局实例长期存活，每次生成报告前刷新日期"""
+        self.today = timezone.localdate()
+        self.yesterday = self.today - timedelta(days=1)
+        self.week_ago = self.today - timedelta(days=7)
+        
     def generate_daily_report(self):
-        """生成每日工作报告"""
+        """生成每日工作报告（数据来自每日运营汇总表）"""
         try:
-            # 获取今日数据
-            today_orders = PrintOrderFlat.objects.filter(
-                detail_type=None,
-                order_date__date=self.today
-            )
-            
-            # 获取今日完成的步骤
-            today_completed_steps = OrderProgress.objects.filter(
-                status=3,  # 已完成
-                end_time__date=self.today,
-                order__detail_type=None
-            )
-            
-            # 获取今日开始的步骤
-            today_started_steps = OrderProgress.objects.filter(
-                status__in=[2, 3],  # 进行中或已完成
-                start_time__date=self.today,
-                order__detail_type=None
-            )
+            self._refresh_dates()
+            # 待处理/处理中等状态数是时点值，每次生成报告时刷新快照（两条分组查询）
+            daily_rollup.refresh_snapshot(self.today)
+            summary = daily_rollup.get_day_summary(self.today)
             
             # 统计数据
             stats = {
-                'new_orders': today_orders.count(),
-                'completed_steps': today_completed_steps.count(),
-                'started_steps': today_started_steps.count(),
-                'pending_orders': PrintOrderFlat.objects.filter(
-                    detail_type=None, status=1
-                ).count(),
-                'processing_orders': PrintOrderFlat.objects.filter(
-                    detail_type=None, status=2
-                ).count(),
+                'new_orders': summary['orders_created'],
+                'completed_steps': summary['steps_completed'],
+                'started_steps': summary['steps_started'],
+                'pending_orders': summary['pending_count'],
+                'processing_orders': summary['processing_count'],
             }
             
+            # 今日完成步骤的明细只取前5条
+            recent_completed = OrderProgress.objects.filter(
+                status=3,  # 已完成
+                end_time__date=self.today,
+                order__detail_type=None
+            ).select_related('order').order_by('-end_time')[:5]
+            
             # 生成报告内容
-            report_content = self._format_daily_report(stats, today_completed_steps, today_started_steps)
+            report_content = self._format_daily_report(stats, list(recent_completed), summary)
             
             return {
                 'status': 'success',
@@ -70,7 +65,7 @@ class AIAssistant:
                 'message': f'生成日报时发生错误：{str(e)}'
             }
     
-    def _format_daily_report(self, stats, completed_steps, started_steps):
+    def _format_daily_report(self, stats, recent_completed, summary):
         """格式化日报内容"""
         current_time = timezone.now().strftime('%Y年%m月%d日 %H:%M')
         
@@ -89,20 +84,20 @@ class AIAssistant:
         """
         
         # 添加完成步骤详情
-        if completed_steps.exists():
+        if recent_completed:
             html_content += """
             <div style="background: #d4edda; padding: 15px; border-radius: 8px; margin-bottom: 15px;">
                 <div style="font-weight: bold; margin-bottom: 10px; color: #155724;">✅ 今日完成步骤</div>
             """
-            for step in completed_steps[:5]:  # 只显示前5个
+            for step in recent_completed:  # 只显示前5个
                 html_content += f'<div style="margin-bottom: 3px; font-size: 12px;">• {step.order.order_no} - {step.step_name}</div>'
             
-            if completed_steps.count() > 5:
-                html_content += f'<div style="margin-top: 8px; font-size: 11px; color: #666;">...还有 {completed_steps.count() - 5} 个步骤</div>'
+            if stats['completed_steps'] > 5:
+                html_content += f'<div style="margin-top: 8px; font-size: 11px; color: #666;">...还有 {stats["completed_steps"] - 5} 个步骤</div>'
             html_content += "</div>"
         
         # 添加效率分析
-        efficiency_analysis = self._analyze_efficiency()
+        efficiency_analysis = self._analyze_efficiency(summary)
         html_content += f"""
             <div style="background: #fff3cd; padding: 15px; border-radius: 8px;">
                 <div style="font-weight: bold; margin-bottom: 10px; color: #856404;">⚡ 效率分析</div>
@@ -113,78 +108,86 @@ class AIAssistant:
         
         return html_content
     
-    def _analyze_efficiency(self):
-        """分析工作效率"""
-        # 计算平均完成时间
-        completed_today = OrderProgress.objects.filter(
-            status=3,
-            end_time__date=self.today,
-            order__detail_type=None
-        )
+    def _analyze_efficiency(self, summary=None):
+        """分析工作效率（今日数据与近7天日均对比）"""
+        summary = summary or daily_rollup.get_day_summary(self.today)
+        total_steps = summary['steps_completed']
         
-        if not completed_today.exists():
+        if not total_steps:
             return "<div style='font-size: 12px;'>今日暂无完成的步骤数据</div>"
         
         # 简单的效率分析
-        total_steps = completed_today.count()
-        avg_per_hour = round(total_steps / max(timezone.now().hour, 1), 1) if timezone.now().hour > 0 else 0
+        avg_per_hour = round(total_steps / max(timezone.localtime().hour, 1), 1)
+        # 只按有汇总数据的天数平均，避免上线不足7天或停工日拉低日均
+        trend = daily_rollup.get_daily_trend(self.week_ago, self.yesterday)
+        week_avg = round(sum(day['steps_completed'] for day in trend) / len(trend), 1) if trend else 0
+        avg_minutes = round(summary['avg_duration_seconds'] / 60)
         
         return f"""
         <div style="font-size: 12px;">
             <div>• 平均每小时完成：{avg_per_hour} 个步骤</div>
-            <div>• 总体进度：{"良好" if total_steps >= 5 else "一般" if total_steps >= 2 else "较慢"}</div>
+            <div>• 单步平均耗时：{avg_minutes} 分钟</div>
+            <div>• 近7天日均完成：{week_avg} 个步骤</div>
+            <div>• 总体进度：{"良好" if total_steps >= max(week_avg, 5) else "一般" if total_steps >= 2 else "较慢"}</div>
         </div>
         """
     
     def analyze_anomalies(self):
         """分析异常数据"""
         try:
+            self._refresh_dates()
+            now = timezone.now()
             anomalies = []
             
-            # 1. 检查长期未处理的订单
-            overdue_orders = PrintOrderFlat.objects.filter(
-                detail_type=None,
-                status=1,  # 待处理
-                order_date__lte=timezone.now() - timedelta(days=3)
+            # 订单类异常一次聚合查询
+            order_counts = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
+                # 1. 长期未处理的订单
+                overdue=Count('id', filter=Q(status=1, order_date__lte=now - timedelta(days=3))),
+                # 3. 即将逾期的订单
+                urgent=Count('id', filter=Q(status__in=[1, 2], delivery_date__isnull=False, delivery_date__lte=now + timedelta(days=2))),
             )
             
-            if overdue_orders.exists():
+            # 2. 长时间停滞的步骤
+            stalled_count = OrderProgress.objects.filter(
+                status=2,  # 进行中
+                start_time__lte=now - timedelta(days=daily_rollup.STALLED_STEP_DAYS),
+                order__detail_type=None
+            ).count()
+            
+            if order_counts['overdue']:
                 anomalies.append({
                     'type': 'overdue_orders',
                     'title': '⚠️ 长期未处理订单',
-                    'count': overdue_orders.count(),
-                    'description': f'发现 {overdue_orders.count()} 个订单超过3天未开始处理'
+                    'count': order_counts['overdue'],
+                    'description': f'发现 {order_counts["overdue"]} 个订单超过3天未开始处理'
                 })
             
-            # 2. 检查长时间停滞的步骤
-            stalled_steps = OrderProgress.objects.filter(
-                status=2,  # 进行中
-                start_time__lte=timezone.now() - timedelta(days=2),
-                order__detail_type=None
-            )
-            
-            if stalled_steps.exists():
+            if stalled_count:
                 anomalies.append({
                     'type': 'stalled_steps',
                     'title': '🔄 停滞的生产步骤',
-                    'count': stalled_steps.count(),
-                    'description': f'发现 {stalled_steps.count()} 个步骤超过2天未完成'
+                    'count': stalled_count,
+                    'description': f'发现 {stalled_count} 个步骤超过2天未完成'
                 })
             
-            # 3. 检查即将逾期的订单
-            urgent_orders = PrintOrderFlat.objects.filter(
-                detail_type=None,
-                status__in=[1, 2],
-                delivery_date__isnull=False,
-                delivery_date__lte=timezone.now() + timedelta(days=2)
-            )
-            
-            if urgent_orders.exists():
+            if order_counts['urgent']:
                 anomalies.append({
                     'type': 'urgent_orders',
                     'title': '🚨 紧急交期订单',
-                    'count': urgent_orders.count(),
-                    'description': f'发现 {urgent_orders.count()} 个订单将在2天内到期'
+                    'count': order_counts['urgent'],
+                    'description': f'发现 {order_counts["urgent"]} 个订单将在2天内到期'
+                })
+            
+            # 4. 产能下降：昨日完成步骤数低于此前7天日均的一半（读汇总表）
+            trend = {day['date']: day['steps_completed'] for day in daily_rollup.get_daily_trend(self.today - timedelta(days=8), self.yesterday)}
+            previous_avg = sum(count for day, count in trend.items() if day < self.yesterday) / 7
+            yesterday_completed = trend.get(self.yesterday, 0)
+            if previous_avg >= 2 and yesterday_completed < previous_avg / 2:
+                anomalies.append({
+                    'type': 'throughput_drop',
+                    'title': '📉 产能下降',
+                    'count': yesterday_completed,
+                    'description': f'昨日完成 {yesterday_completed} 个步骤，低于此前7天日均 {previous_avg:.1f} 个的一半'
                 })
             
             # 格式化异常报告
@@ -231,33 +234,27 @@ class AIAssistant:
         """检查交期情况"""
         try:
             now = timezone.now()
+            today = timezone.localdate()
             
-            # 获取不同时间段的交期订单
-            deadline_data = {
-                'overdue': PrintOrderFlat.objects.filter(
-                    detail_type=None,
-                    status__in=[1, 2],
-                    delivery_date__lt=now
-                ),
-                'today': PrintOrderFlat.objects.filter(
-                    detail_type=None,
-                    status__in=[1, 2],
-                    delivery_date__date=now.date()
-                ),
-                'tomorrow': PrintOrderFlat.objects.filter(
-                    detail_type=None,
-                    status__in=[1, 2],
-                    delivery_date__date=now.date() + timedelta(days=1)
-                ),
-                'this_week': PrintOrderFlat.objects.filter(
-                    detail_type=None,
-                    status__in=[1, 2],
-                    delivery_date__range=[
-                        now.date() + timedelta(days=2),
-                        now.date() + timedelta(days=7)
-                    ]
-                )
-            }
+            # 一次取出一周内到期（含已逾期）的未完成订单，在内存中分组
+            open_orders = PrintOrderFlat.objects.filter(
+                detail_type=None,
+                status__in=[1, 2],
+                delivery_date__isnull=False,
+                delivery_date__date__lte=today + timedelta(days=7)
+            ).only('order_no', 'delivery_date').order_by('delivery_date')
+            
+            deadline_data = {'overdue': [], 'today': [], 'tomorrow': [], 'this_week': []}
+            for order in open_orders:
+                delivery_day = timezone.localtime(order.delivery_date).date()
+                if order.delivery_date < now:
+                    deadline_data['overdue'].append(order)
+                if delivery_day == today:
+                    deadline_data['today'].append(order)
+                elif delivery_day == today + timedelta(days=1):
+                    deadline_data['tomorrow'].append(order)
+                elif delivery_day >= today + timedelta(days=2):
+                    deadline_data['this_week'].append(order)
             
             # 格式化交期分析报告
             content = self._format_deadline_report(deadline_data)
@@ -281,47 +278,47 @@ class AIAssistant:
         """
         
         # 逾期订单
-        if deadline_data['overdue'].exists():
+        if deadline_data['overdue']:
             html_content += f"""
             <div style="background: #f8d7da; padding: 15px; border-radius: 8px; margin-bottom: 15px; border-left: 3px solid #dc3545;">
-                <div style="font-weight: bold; color: #721c24; margin-bottom: 10px;">🚨 已逾期订单 ({deadline_data['overdue'].count()}个)</div>
+                <div style="font-weight: bold; color: #721c24; margin-bottom: 10px;">🚨 已逾期订单 ({len(deadline_data['overdue'])}个)</div>
             """
             for order in deadline_data['overdue'][:3]:
-                days_overdue = (timezone.now().date() - order.delivery_date.date()).days
+                days_overdue = (timezone.localdate() - timezone.localtime(order.delivery_date).date()).days
                 html_content += f'<div style="font-size: 12px; margin-bottom: 3px;">• {order.order_no} (逾期{days_overdue}天)</div>'
             html_content += "</div>"
         
         # 今日交期
-        if deadline_data['today'].exists():
+        if deadline_data['today']:
             html_content += f"""
             <div style="background: #fff3cd; padding: 15px; border-radius: 8px; margin-bottom: 15px; border-left: 3px solid #ffc107;">
-                <div style="font-weight: bold; color: #856404; margin-bottom: 10px;">📅 今日交期 ({deadline_data['today'].count()}个)</div>
+                <div style="font-weight: bold; color: #856404; margin-bottom: 10px;">📅 今日交期 ({len(deadline_data['today'])}个)</div>
             """
             for order in deadline_data['today']:
                 html_content += f'<div style="font-size: 12px; margin-bottom: 3px;">• {order.order_no}</div>'
             html_content += "</div>"
         
         # 明日交期
-        if deadline_data['tomorrow'].exists():
+        if deadline_data['tomorrow']:
             html_content += f"""
             <div style="background: #d1ecf1; padding: 15px; border-radius: 8px; margin-bottom: 15px; border-left: 3px solid #17a2b8;">
-                <div style="font-weight: bold; color: #0c5460; margin-bottom: 10px;">📋 明日交期 ({deadline_data['tomorrow'].count()}个)</div>
+                <div style="font-weight: bold; color: #0c5460; margin-bottom: 10px;">📋 明日交期 ({len(deadline_data['tomorrow'])}个)</div>
             """
             for order in deadline_data['tomorrow']:
                 html_content += f'<div style="font-size: 12px; margin-bottom: 3px;">• {order.order_no}</div>'
             html_content += "</div>"
         
         # 本周交期
-        if deadline_data['this_week'].exists():
+        if deadline_data['this_week']:
             html_content += f"""
             <div style="background: #d4edda; padding: 15px; border-radius: 8px; margin-bottom: 15px; border-left: 3px solid #28a745;">
-                <div style="font-weight: bold; color: #155724; margin-bottom: 10px;">📊 本周交期 ({deadline_data['this_week'].count()}个)</div>
+                <div style="font-weight: bold; color: #155724; margin-bottom: 10px;">📊 本周交期 ({len(deadline_data['this_week'])}个)</div>
                 <div style="font-size: 12px; color: #666;">本周内需要完成的订单数量</div>
             </div>
             """
         
         # 如果没有任何交期订单
-        if not any(data.exists() for data in deadline_data.values()):
+        if not any(deadline_data.values()):
             html_content += """
             <div style="text-align: center; color: #28a745; padding: 20px;">
                 <div style="font-size: 24px; margin-bottom: 10px;">✅</div>
@@ -333,6 +330,87 @@ class AIAssistant:
         html_content += "</div>"
         return html_content
     
+    def generate_trend_report(self, days=90):
+        """生成历史趋势报告（只读每日运营汇总表，按月/按步骤汇总）"""
+        try:
+            self._refresh_dates()
+            days = max(min(int(days), 366), 7)
+            start = self.today - timedelta(days=days - 1)
+            trend = daily_rollup.get_daily_trend(start, self.today)
+            step_durations = daily_rollup.get_step_durations(start, self.today)
+            
+            # 按月汇总
+            months = {}
+            for day in trend:
+                month = months.setdefault(day['date'].strftime('%Y-%m'), {'orders_created': 0, 'steps_completed': 0})
+                month['orders_created'] += day['orders_created']
+                month['steps_completed'] += day['steps_completed']
+            
+            data = {
+                'start': start.isoformat(),
+                'end': self.today.isoformat(),
+                'orders_created': sum(day['orders_created'] for day in trend),
+                'steps_completed': sum(day['steps_completed'] for day in trend),
+                'months': months,
+                'daily': [dict(day, date=day['date'].isoformat()) for day in trend],
+                'steps': step_durations[:10],
+            }
+            
+            return {
+                'status': 'success',
+                'report': self._format_trend_report(data, days),
+                'data': data,
+                'timestamp': timezone.now().isoformat()
+            }
+            
+        except Exception as e:
+            return {
+                'status': 'error',
+                'message': f'生成趋势报告时发生错误：{str(e)}'
+            }
+    
+    def _format_trend_report(self, data, days):
+        """格式化趋势报告"""
+        html_content = f"""
+        <div style="text-align: left;">
+            <h4 style="color: #667eea; margin-bottom: 15px;">📈 近{days}天趋势报告</h4>
+            
+            <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; margin-bottom: 15px;">
+                <div style="font-weight: bold; margin-bottom: 10px;">📊 总览（{data['start']} ~ {data['end']}）</div>
+                <div style="margin-bottom: 5px;">• 新增订单：<span style="color: #28a745; font-weight: bold;">{data['orders_created']}</span> 个</div>
+                <div>• 完成步骤：<span style="color: #17a2b8; font-weight: bold;">{data['steps_completed']}</span> 个</div>
+            </div>
+        """
+        
+        if data['months']:
+            html_content += """
+            <div style="background: #d1ecf1; padding: 15px; border-radius: 8px; margin-bottom: 15px;">
+                <div style="font-weight: bold; margin-bottom: 10px; color: #0c5460;">🗓️ 按月汇总</div>
+            """
+            for month, values in sorted(data['months'].items()):
+                html_content += f'<div style="font-size: 12px; margin-bottom: 3px;">• {month}：新增订单 {values["orders_created"]} 个，完成步骤 {values["steps_completed"]} 个</div>'
+            html_content += "</div>"
+        
+        if data['steps']:
+            html_content += """
+            <div style="background: #fff3cd; padding: 15px; border-radius: 8px;">
+                <div style="font-weight: bold; margin-bottom: 10px; color: #856404;">⏱️ 步骤平均耗时（由长到短）</div>
+            """
+            for step in data['steps']:
+                html_content += f'<div style="font-size: 12px; margin-bottom: 3px;">• {step["step_name"]}：平均 {round(step["avg_duration_seconds"] / 3600, 1)} 小时，完成 {step["steps_completed"]} 次</div>'
+            html_content += "</div>"
+        
+        if not data['months']:
+            html_content += """
+            <div style="text-align: center; color: #666; padding: 20px;">
+                <div>暂无汇总数据</div>
+                <div style="font-size: 12px; margin-top: 5px;">请先运行 python manage.py rollup_daily_operations 初始化汇总表</div>
+            </div>
+            """
+        
+        html_content += "</div>"
+        return html_content
+    
     def get_auto_report_time(self):
         """获取自动报告时间（每天下午5:30）"""
         today = timezone.now().date()
@@ -3,11 +3,14 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 
+from . import metrics
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     """
     WebSocket消费者，处理实时通知
     """
+    room_group_name = None
     
     async def connect(self):
         """
@@ -35,6 +38,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         
         # 接受WebSocket连接
         await self.accept()
+        metrics.WEBSOCKET_CONNECTIONS.labels(self.room_group_name).inc()
         
         print(f"🔌 WebSocket连接已建立，用户: {user.username}")
         
@@ -42,19 +46,32 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({
             'type': 'connection_established',
             'message': f'WebSocket连接已建立，欢迎 {user.username}',
-            'user': user.username
+            'user': user.username,
+            # 重连时带上令牌可跳过session查询（见 websocket_auth_middleware）
+            'token': self.scope.get('ws_token')
         }))
     
     async def disconnect(self, close_code):
         """
         WebSocket断开连接时调用
         """
+        # 未通过认证的连接没有加入通知组
+        if self.room_group_name is None:
+            return
+        metrics.WEBSOCKET_CONNECTIONS.labels(self.room_group_name).dec()
         # 离开通知组
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        发送消息到WebSocket，按组统计发送条数
+        """
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        metrics.WEBSOCKET_MESSAGES_SENT.labels(self.room_group_name or 'none').inc()
+    
     async def receive(self, text_data):
         """
         接收来自WebSocket的消息
@@ -116,6 +133,16 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'data': event['data']
         }))
     
+    async def deadline_alert(self, event):
+        """
+        处理交期提醒（由交期调度器在订单跨过阈值时推送）
+        """
+        # 发送消息到WebSocket
+        await self.send(text_data=json.dumps({
+            'type': 'deadline_alert',
+            'data': event['data']
+        }))
+    
     async def notification_message(self, event):
         """
         处理通知消息
@@ -0,0 +1,135 @@
+"""
+对话上下文并发收集
+订单上下文、RAG检索等访问数据库的来源放到小线程池里并发执行，会话历史、滚动摘要这类
+内存/缓存读取直接在当前线程执行；每个来源单独超时，超时或出错时使用默认值，不拖慢整个回答。
+池中的数据库查询带语句超时，超时的查询由数据库中止，不会一直占住线程；
+线程池已满时不再提交新任务，直接使用默认值
+"""
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, NamedTuple
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+
+class ContextSource(NamedTuple):
+    """
+    一个上下文来源：取值函数、超时（秒）、超时/出错时的默认值
+    inline=True 的来源（很快、不访问数据库）在调用线程执行，不占线程池
+    """
+    func: Callable[[], Any]
+    timeout: float
+    default: Any
+    inline: bool = False
+
+
+MAX_WORKERS = getattr(settings, 'AI_CONTEXT_WORKERS', 8)
+
+_executor = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS,
+    thread_name_prefix='ai-context'
+)
+
+# 已提交但尚未结束的任务数（包括调用方已放弃等待、仍在池中执行的任务）
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def _try_reserve() -> bool:
+    global _in_flight
+    with _in_flight_lock:
+        if _in_flight >= MAX_WORKERS:
+            return False
+        _in_flight += 1
+        return True
+
+
+def _release(future=None):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight -= 1
+
+
+class _StatementTimeout:
+    """
+    执行包装器：本线程第一次访问数据库时给连接设置语句超时（MySQL 只对 SELECT 生效），
+    不访问数据库的来源不会因此建立连接；不支持的数据库忽略
+    """
+
+    STATEMENTS = {
+        'mysql': 'SET SESSION MAX_EXECUTION_TIME = %s',
+        'postgresql': 'SET statement_timeout = %s',
+    }
+
+    def __init__(self, timeout: float):
+        self.milliseconds = max(int(timeout * 1000), 1)
+        self.applied = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.applied:
+            self.applied = True
+            statement = self.STATEMENTS.get(context['connection'].vendor)
+            if statement:
+                try:
+                    context['cursor'].cursor.execute(statement, [self.milliseconds])
+                except Exception as e:
+                    print(f"⚠️ 设置上下文查询超时失败: {e}")
+        return execute(sql, params, many, context)
+
+
+def _run_source(func: Callable[[], Any], timeout: float) -> Any:
+    """在线程池中执行，前后清理该线程的过期数据库连接"""
+    close_old_connections()
+    try:
+        with connection.execute_wrapper(_StatementTimeout(timeout)):
+            return func()
+    finally:
+        close_old_connections()
+
+
+def gather_context(sources: Dict[str, ContextSource]) -> Dict[str, Any]:
+    """并发执行所有来源，总耗时约等于最慢的单个来源（且不超过其超时）"""
+    start = time.monotonic()
+    futures = {}
+    results = {}
+    for name, source in sources.items():
+        if source.inline:
+            continue
+        if not _try_reserve():
+            print(f"⚠️ 上下文线程池已满，跳过来源 {name}")
+            results[name] = source.default
+            continue
+        try:
+            # 带上当前上下文（contextvar），池中的查询也计入请求的SQL统计
+            future = _executor.submit(contextvars.copy_context().run, _run_source, source.func, source.timeout)
+        except Exception:
+            _release()
+            raise
+        future.add_done_callback(_release)
+        futures[name] = future
+
+    # 池中任务执行期间，在当前线程完成内存/缓存来源
+    for name, source in sources.items():
+        if not source.inline:
+            continue
+        try:
+            results[name] = source.func()
+        except Exception as e:
+            print(f"⚠️ 上下文来源 {name} 出错: {e}")
+            results[name] = source.default
+
+    for name, future in futures.items():
+        source = sources[name]
+        remaining = source.timeout - (time.monotonic() - start)
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except TimeoutError:
+            print(f"⚠️ 上下文来源 {name} 超时（{source.timeout}s），已跳过")
+            results[name] = source.default
+        except Exception as e:
+            print(f"⚠️ 上下文来源 {name} 出错: {e}")
+            results[name] = source.default
+    return results
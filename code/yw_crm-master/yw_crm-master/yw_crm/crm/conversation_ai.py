@@ -13,11 +13,21 @@ from django.utils import timezone
 from django.db.models import Q, Count
 from django.conf import settings
 
+from channels.db import database_sync_to_async
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import ToolMessage
 
 from .models import PrintOrderFlat, OrderProgress, UserInfo
 from .conversation_memory import ConversationMemory, ConversationFragment
+from .response_cache import ResponseCache
+from .conversation_sessions import ConversationSessionStore
+from .data_version import get_order_data_version, context_cache
+from .llm_gateway import LLMGateway, LLMGatewayError
+from .conversation_tools import ORDER_TOOLS, OrderToolExecutor
+from .prompt_builder import PromptBuilder
+from .context_gathering import ContextSource, gather_context
+from .memory_writer import ConversationWriteBehind
+from .intent_router import IntentRouter, HELP_TEXT
 
 
 class OrderQueryTool:
@@ -38,6 +48,15 @@ class OrderQueryTool:
             if 'order_no' in query_params:
                 queryset = queryset.filter(order_no__icontains=query_params['order_no'])
             
+            if 'customer_name' in query_params:
+                queryset = queryset.filter(customer_name__icontains=query_params['customer_name'])
+            
+            if 'product_name' in query_params:
+                queryset = queryset.filter(product_name__icontains=query_params['product_name'])
+            
+            if 'salesman' in query_params:
+                queryset = queryset.filter(salesman__icontains=query_params['salesman'])
+            
             if 'status' in query_params:
                 queryset = queryset.filter(status=query_params['status'])
             
@@ -63,6 +82,14 @@ class OrderQueryTool:
                     status__in=[1, 2]
                 )
             
+            return self.format_orders(queryset, query_params)
+            
+        except Exception as e:
+            return f"🔍 订单搜索：\n\n❌ 查询失败：{str(e)[:50]}...\n\n请稍后重试"
+    
+    def format_orders(self, queryset, condition: Any = None) -> str:
+        """格式化订单查询结果（工具调用和意图路由共用）"""
+        try:
             # 🚀 一次性获取结果和总数
             orders = queryset.order_by('-order_date')[:8]  # 减少返回数量
             filtered_count = queryset.count()
@@ -70,7 +97,7 @@ class OrderQueryTool:
             if filtered_count == 0:
                 if not PrintOrderFlat.objects.filter(detail_type=None).exists():
                     return "🔍 订单搜索：\n\n⚠️ 暂无订单数据"
-                return f"🔍 订单搜索：\n\n没有找到符合条件的订单\n\n搜索条件：{query_params}"
+                return f"🔍 订单搜索：\n\n没有找到符合条件的订单\n\n搜索条件：{condition}"
             
             # 🚀 精简格式化结果
             status_map = {1: "待处理", 2: "处理中", 3: "已完成"}
@@ -135,48 +162,132 @@ class OrderQueryTool:
         except Exception as e:
             return f"获取订单详情时出错：{str(e)}"
     
-    def get_statistics(self) -> str:
-        """获取订单统计信息 - 优化单次查询"""
+    def search_steps(self, step_name: Optional[str] = None, status: int = 2) -> str:
+        """按生产步骤查询订单"""
         try:
-            # 🚀 使用单次聚合查询获取所有统计数据
-            from django.db.models import Count, Case, When, IntegerField
-            
-            stats = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
-                total=Count('id'),
-                pending=Count(Case(When(status=1, then=1), output_field=IntegerField())),
-                processing=Count(Case(When(status=2, then=1), output_field=IntegerField())),
-                completed=Count(Case(When(status=3, then=1), output_field=IntegerField())),
-                today=Count(Case(When(order_date__date=self.today, then=1), output_field=IntegerField())),
-                urgent=Count(Case(When(
-                    status__in=[1, 2],
-                    delivery_date__isnull=False,
-                    delivery_date__lte=timezone.now() + timedelta(days=3),
-                    then=1
-                ), output_field=IntegerField()))
-            )
+            queryset = OrderProgress.objects.filter(status=status, order__detail_type=None)
+            if step_name:
+                queryset = queryset.filter(step_name__icontains=step_name)
             
-            # 快速数据验证
-            if stats['total'] == 0:
-                return "📊 订单统计信息：\n\n⚠️ 暂无订单数据\n\n建议：检查数据导入或联系管理员"
+            title = f"「{step_name}」" if step_name else "所有步骤"
+            return self.format_steps(queryset, title, status)
             
-            # 生成简洁的统计报告
-            result = f"📊 订单统计（{timezone.now().strftime('%m-%d %H:%M')}）：\n\n"
-            result += f"📈 总数：{stats['total']} 订单\n"
-            result += f"⏳ 待处理：{stats['pending']}\n"
-            result += f"🔄 处理中：{stats['processing']}\n"
-            result += f"✅ 已完成：{stats['completed']}\n"
-            result += f"🆕 今日新增：{stats['today']}\n"
-            result += f"🚨 紧急订单：{stats['urgent']}\n"
+        except Exception as e:
+            return f"步骤查询失败：{str(e)[:50]}"
+    
+    def format_steps(self, queryset, title: str, status: int) -> str:
+        """格式化步骤查询结果（工具调用和意图路由共用）"""
+        try:
+            step_status_map = {1: "待开始", 2: "进行中", 3: "已完成", 4: "已跳过"}
+            total = queryset.count()
+            if total == 0:
+                return f"🏭 {title}中没有{step_status_map.get(status, '')}的订单"
+            
+            steps = queryset.select_related('order', 'operator').order_by('-updated_time')[:10]
+            result = f"🏭 {title}{step_status_map.get(status, '')}：共 {total} 个，显示前 {len(steps)} 个：\n\n"
+            for step in steps:
+                product_name = step.order.product_name or "未命名产品"
+                operator_info = f"，操作员：{step.operator.name}" if step.operator else ""
+                time_info = f"，开始于{step.start_time.strftime('%m-%d %H:%M')}" if step.start_time else ""
+                result += f"• {product_name} ({step.order.order_no}) - {step.step_name}{operator_info}{time_info}\n"
+            return result
             
-            # 检查数据一致性
-            other_status = stats['total'] - (stats['pending'] + stats['processing'] + stats['completed'])
-            if other_status > 0:
-                result += f"❓ 其他状态：{other_status}\n"
+        except Exception as e:
+            return f"步骤查询失败：{str(e)[:50]}"
+    
+    def get_order_materials(self, order_no: str) -> str:
+        """获取订单的用料明细"""
+        try:
+            order = PrintOrderFlat.objects.filter(order_no=order_no, detail_type=None).only('order_no', 'product_name', 'material_json').first()
+            if not order:
+                return f"未找到订单号为 {order_no} 的订单。"
+            
+            materials = json.loads(order.material_json or '[]')
+            if not materials:
+                return f"订单 {order_no} 暂无用料明细。"
+            
+            result = f"📦 {order.product_name or '未命名产品'} ({order_no}) 用料明细：\n"
+            for item in materials:
+                parts = [item.get('项目', ''), item.get('材料名称', ''), item.get('规格', '')]
+                line = ' '.join(part for part in parts if part)
+                if item.get('总数'):
+                    line += f"，总数{item['总数']}"
+                if item.get('金额'):
+                    line += f"，金额{item['金额']}"
+                result += f"  {item.get('序', '-')}. {line}\n"
+            return result
             
+        except Exception as e:
+            return f"获取用料明细时出错：{str(e)[:50]}"
+    
+    def search_materials(self, material_name: str) -> str:
+        """查找用料中包含某材料的订单"""
+        try:
+            if not material_name:
+                return "请提供材料名称。"
+            
+            # material_json 以 ensure_ascii=False 保存，可以直接按中文匹配
+            queryset = PrintOrderFlat.objects.filter(detail_type=None, material_json__icontains=material_name)
+            total = queryset.count()
+            if total == 0:
+                return f"没有找到使用「{material_name}」的订单。"
+            
+            status_map = {1: "待处理", 2: "处理中", 3: "已完成", 4: "已取消"}
+            orders = queryset.order_by('-order_date').only('order_no', 'product_name', 'status')[:8]
+            result = f"📦 使用「{material_name}」的订单共 {total} 个，显示前 {len(orders)} 个：\n\n"
+            for order in orders:
+                result += f"• {order.product_name or '未命名产品'} ({order.order_no}) - {status_map.get(order.status, '未知')}\n"
             return result
             
+        except Exception as e:
+            return f"材料查询失败：{str(e)[:50]}"
+    
+    def get_statistics(self) -> str:
+        """获取订单统计信息 - 按订单数据版本缓存"""
+        try:
+            self.today = timezone.now().date()
+            return context_cache.get_or_set(('statistics', self.today), self._build_statistics)
         except Exception as e:
             return f"📊 订单统计信息：\n\n❌ 获取失败：{str(e)[:100]}...\n\n请稍后重试或联系技术支持"
+    
+    def _build_statistics(self) -> str:
+        """生成订单统计信息 - 优化单次查询"""
+        # 🚀 使用单次聚合查询获取所有统计数据
+        from django.db.models import Count, Case, When, IntegerField
+        
+        stats = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
+            total=Count('id'),
+            pending=Count(Case(When(status=1, then=1), output_field=IntegerField())),
+            processing=Count(Case(When(status=2, then=1), output_field=IntegerField())),
+            completed=Count(Case(When(status=3, then=1), output_field=IntegerField())),
+            today=Count(Case(When(order_date__date=self.today, then=1), output_field=IntegerField())),
+            urgent=Count(Case(When(
+                status__in=[1, 2],
+                delivery_date__isnull=False,
+                delivery_date__lte=timezone.now() + timedelta(days=3),
+                then=1
+            ), output_field=IntegerField()))
+        )
+        
+        # 快速数据验证
+        if stats['total'] == 0:
+            return "📊 订单统计信息：\n\n⚠️ 暂无订单数据\n\n建议：检查数据导入或联系管理员"
+        
+        # 生成简洁的统计报告
+        result = f"📊 订单统计（{timezone.now().strftime('%m-%d %H:%M')}）：\n\n"
+        result += f"📈 总数：{stats['total']} 订单\n"
+        result += f"⏳ 待处理：{stats['pending']}\n"
+        result += f"🔄 处理中：{stats['processing']}\n"
+        result += f"✅ 已完成：{stats['completed']}\n"
+        result += f"🆕 今日新增：{stats['today']}\n"
+        result += f"🚨 紧急订单：{stats['urgent']}\n"
+        
+        # 检查数据一致性
+        other_status = stats['total'] - (stats['pending'] + stats['processing'] + stats['completed'])
+        if other_status > 0:
+            result += f"❓ 其他状态：{other_status}\n"
+        
+        return result
 
 
 class ConversationAI:
@@ -226,8 +337,14 @@ class ConversationAI:
             # 创建一个备用的虚拟LLM，避免程序崩溃
             self.llm = None
         
+        # 所有大模型调用经过网关：并发上限、排队、限流、熔断
+        self.gateway = LLMGateway(self.llm)
+        
         self.order_tool = OrderQueryTool()
-        self.conversation_history = []
+        # 规则意图路由：常规问题直接编译为ORM查询
+        self.intent_router = IntentRouter(self.order_tool)
+        # 每个用户独立的有界对话历史
+        self.sessions = ConversationSessionStore()
         self.today = timezone.now().date()
         
         # 初始化RAG对话记忆
@@ -238,6 +355,30 @@ class ConversationAI:
             print(f"⚠️ 对话记忆系统初始化失败: {e}")
             self.memory = None
         
+        # 对话记忆异步批量写入，不占用回答时间
+        self.memory_writer = ConversationWriteBehind(self.memory, self._determine_context_type) if self.memory else None
+        
+        # 相同问题 + 相同订单数据直接复用回复
+        self.response_cache = ResponseCache()
+        
+        # 按输入token预算组装提示词
+        self.prompt_builder = PromptBuilder()
+        
+        # 函数调用：大模型按需查询订单数据，而不是每轮都塞入固定上下文
+        self.use_tools = getattr(settings, 'AI_TOOL_CALLING', True) and self.llm is not None
+        self.max_tool_rounds = getattr(settings, 'AI_MAX_TOOL_ROUNDS', 3) if self.use_tools else 0
+        self.tool_executor = OrderToolExecutor(self.order_tool)
+        self.tool_llm = self.answer_llm = self.llm
+        if self.use_tools:
+            try:
+                self.tool_llm = self.llm.bind_tools(ORDER_TOOLS)
+                # 工具轮数用完后强制直接作答
+                self.answer_llm = self.llm.bind_tools(ORDER_TOOLS, tool_choice='none')
+            except Exception as e:
+                print(f"⚠️ 绑定查询工具失败，使用固定上下文模式: {e}")
+                self.use_tools = False
+                self.max_tool_rounds = 0
+        
         # 创建系统提示
         self.system_prompt = """你是华龙印务管理系统的AI助手。你可以帮助用户查询和了解华龙印务的订单信息。
 
@@ -257,6 +398,7 @@ class ConversationAI:
 - 你会收到最新的订单数据上下文
 - 你可能会收到相关的历史对话记录，用于理解用户的持续需求
 - 历史对话以<conversation_history>标签包围
+- 较早对话的摘要以<conversation_summary>标签包围
 
 重要提示：
 - 请始终基于提供的数据回答问题，不要编造信息
@@ -271,129 +413,103 @@ class ConversationAI:
 - 使用适当的emoji来增强可读性
 - 根据具体问题提供相关建议
 - 体现对用户历史需求的理解"""
+        
+        if self.use_tools:
+            self.system_prompt += """
+
+查询工具说明：
+- 需要订单数据时，调用提供的工具查询（订单搜索、订单详情、统计、生产步骤、用料），不要猜测
+- 只查询回答问题所需的数据，能一次查清的不要重复调用
+- 订单数据上下文中只包含当前时间，具体数据以工具返回为准"""
     
     def _get_order_context_data(self) -> str:
         """
-        获取订单上下文数据 - 优化数据库查询性能
+        获取订单上下文数据 - 按订单数据版本缓存，数据未变化时不查库
         """
         try:
-            # 🚀 优化：使用单次查询获取所有需要的统计数据
-            from django.db.models import Count, Case, When, IntegerField
-            
-            # 一次性获取所有统计数据
-            stats = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
-                total=Count('id'),
-                pending=Count(Case(When(status=1, then=1), output_field=IntegerField())),
-                processing=Count(Case(When(status=2, then=1), output_field=IntegerField())),
-                completed=Count(Case(When(status=3, then=1), output_field=IntegerField())),
-                today=Count(Case(When(order_date__date=self.today, then=1), output_field=IntegerField())),
-                urgent=Count(Case(When(
-                    status__in=[1, 2],
-                    delivery_date__isnull=False,
-                    delivery_date__lte=timezone.now() + timedelta(days=3),
-                    then=1
-                ), output_field=IntegerField()))
-            )
-            
-            # 快速检查数据可用性
-            if stats['total'] == 0:
-                return f"<order_data_context>\n⚠️ 暂无订单数据\n</order_data_context>\n"
-            
-            # 🚀 优化：使用select_related减少查询次数，只获取前5条最近订单
-            recent_orders = PrintOrderFlat.objects.filter(detail_type=None).order_by('-order_date')[:5]
-            
-            # 构建精简的上下文数据
-            context_text = f"""<order_data_context>
+            self.today = timezone.now().date()
+            return context_cache.get_or_set(('order_context', self.today), self._build_order_context_data)
+        except Exception as e:
+            return f"<order_data_context>\n❌ 数据获取失败：{str(e)[:50]}...\n</order_data_context>\n"
+    
+    def _build_order_context_data(self) -> str:
+        """
+        生成订单上下文数据 - 优化数据库查询性能
+        """
+        # 🚀 优化：使用单次查询获取所有需要的统计数据
+        from django.db.models import Count, Case, When, IntegerField
+        
+        # 一次性获取所有统计数据
+        stats = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
+            total=Count('id'),
+            pending=Count(Case(When(status=1, then=1), output_field=IntegerField())),
+            processing=Count(Case(When(status=2, then=1), output_field=IntegerField())),
+            completed=Count(Case(When(status=3, then=1), output_field=IntegerField())),
+            today=Count(Case(When(order_date__date=self.today, then=1), output_field=IntegerField())),
+            urgent=Count(Case(When(
+                status__in=[1, 2],
+                delivery_date__isnull=False,
+                delivery_date__lte=timezone.now() + timedelta(days=3),
+                then=1
+            ), output_field=IntegerField()))
+        )
+        
+        # 快速检查数据可用性
+        if stats['total'] == 0:
+            return f"<order_data_context>\n⚠️ 暂无订单数据\n</order_data_context>\n"
+        
+        # 🚀 优化：只获取前5条最近订单
+        recent_orders = list(PrintOrderFlat.objects.filter(detail_type=None).order_by('-order_date')[:5])
+        
+        # 构建精简的上下文数据
+        context_text = f"""<order_data_context>
 📊 订单统计：总数{stats['total']} | 待处理{stats['pending']} | 处理中{stats['processing']} | 已完成{stats['completed']} | 今日{stats['today']} | 紧急{stats['urgent']}
 
 📋 最近订单："""
-            
-            # 添加最近订单（简化格式）
-            if recent_orders.exists():
-                urgent_date = timezone.now() + timedelta(days=3)
-                for order in recent_orders:
-                    try:
-                        status_text = {1: "待处理", 2: "处理中", 3: "已完成"}.get(order.status, "未知")
-                        is_urgent = (order.delivery_date and order.delivery_date <= urgent_date and order.status in [1, 2]) if order.delivery_date else False
-                        urgent_mark = "🚨" if is_urgent else ""
-                        date_str = order.order_date.strftime('%m-%d') if order.order_date else "未知"
-                        product_name = getattr(order, 'product_name', '') or "未命名产品"
-                        context_text += f"\n- {product_name}({order.order_no}){urgent_mark} {status_text} {date_str}"
-                    except Exception:
-                        context_text += f"\n- {order.order_no}(数据错误)"
-            else:
-                context_text += "\n暂无订单"
-            
-            context_text += "\n</order_data_context>\n"
-            return context_text
-            
-        except Exception as e:
-            return f"<order_data_context>\n❌ 数据获取失败：{str(e)[:50]}...\n</order_data_context>\n"
+        
+        # 添加最近订单（简化格式）
+        if recent_orders:
+            urgent_date = timezone.now() + timedelta(days=3)
+            for order in recent_orders:
+                try:
+                    status_text = {1: "待处理", 2: "处理中", 3: "已完成"}.get(order.status, "未知")
+                    is_urgent = (order.delivery_date and order.delivery_date <= urgent_date and order.status in [1, 2]) if order.delivery_date else False
+                    urgent_mark = "🚨" if is_urgent else ""
+                    date_str = order.order_date.strftime('%m-%d') if order.order_date else "未知"
+                    product_name = getattr(order, 'product_name', '') or "未命名产品"
+                    context_text += f"\n- {product_name}({order.order_no}){urgent_mark} {status_text} {date_str}"
+                except Exception:
+                    context_text += f"\n- {order.order_no}(数据错误)"
+        else:
+            context_text += "\n暂无订单"
+        
+        context_text += "\n</order_data_context>\n"
+        return context_text
     
     def chat(self, user_message: str, user_id: Optional[int] = None) -> Dict[str, Any]:
         """
         处理用户消息并返回AI回复 - 精简版
         """
         try:
-            # 🚀 优先处理简单查询
-            simple_response = self._handle_simple_queries(user_message)
-            if simple_response:
+            prepared = self._prepare_chat(user_message, user_id)
+            
+            if prepared['kind'] == 'text':
                 return {
                     'status': 'success',
-                    'response': simple_response,
+                    'response': prepared['text'],
+                    'cached': prepared.get('cached', False),
                     'timestamp': timezone.now().isoformat()
                 }
             
-            # 检查LLM可用性
-            if self.llm is None:
+            if prepared['kind'] == 'error':
                 return {
                     'status': 'error',
-                    'response': '抱歉，DeepSeek AI助手暂时不可用。您可以尝试使用快速查询功能（如：输入「统计」、「今天」、「紧急」等）。',
+                    'response': prepared['message'],
                     'timestamp': timezone.now().isoformat()
                 }
             
-            # 🚀 快速获取上下文并构建消息
-            order_context = self._get_order_context_data()
-            
-            # 简化的历史对话检索
-            conversation_context = ""
-            if self.memory:
-                try:
-                    relevant_conversations = self.memory.retrieve_relevant_conversations(
-                        user_message, user_id=user_id, limit=2, similarity_threshold=0.2
-                    )
-                    if relevant_conversations:
-                        conversation_context = f"\n<history>最近相关对话：{relevant_conversations[0].user_message[:30]}...</history>\n"
-                except Exception:
-                    pass
-            
-            enhanced_message = f"{order_context}{conversation_context}\n用户问题：{user_message}\n\n请简洁回答。"
-            
-            # 更新对话历史
-            self.conversation_history.append(HumanMessage(content=user_message))
-            if len(self.conversation_history) > 12:
-                self.conversation_history = self.conversation_history[-12:]
-            
-            # 调用LLM
-            messages = [
-                SystemMessage(content=self.system_prompt),
-                *self.conversation_history[:-1],
-                HumanMessage(content=enhanced_message)
-            ]
-            
-            response = self.llm.invoke(messages)
-            ai_response = response.content
-            
-            # 更新历史记录
-            self.conversation_history.append(AIMessage(content=ai_response))
-            
-            # 异步存储对话（不阻塞）
-            if self.memory and ai_response:
-                try:
-                    context_type = self._determine_context_type(user_message, ai_response)
-                    self.memory.store_conversation(user_message, ai_response, user_id, context_type)
-                except Exception:
-                    pass
+            ai_response = self._invoke_with_tools(prepared['messages'], user_id)
+            self._finish_chat(user_message, user_id, ai_response, prepared['data_version'])
             
             return {
                 'status': 'success',
@@ -401,6 +517,14 @@ class ConversationAI:
                 'timestamp': timezone.now().isoformat()
             }
             
+        except LLMGatewayError as e:
+            # 繁忙/限流/熔断：不等待上游，直接给出快速查询结果
+            return {
+                'status': 'success',
+                'response': self._gateway_fallback(user_message, e),
+                'degraded': True,
+                'timestamp': timezone.now().isoformat()
+            }
         except Exception as e:
             # 🚀 简化的错误处理 - 尝试降级
             fallback_response = self._handle_simple_queries(user_message)
@@ -418,107 +542,271 @@ class ConversationAI:
                 'timestamp': timezone.now().isoformat()
             }
     
+    def _prepare_chat(self, user_message: str, user_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        对话的准备阶段（全部ORM/缓存访问都在这里，便于异步视图放到线程中执行）
+        返回 kind 为 text（直接输出文本）、error 或 llm（需要调用大模型）
+        """
+        # 🚀 优先处理简单查询 - 最快路径
+        simple_response = self._handle_simple_queries(user_message)
+        if simple_response:
+            return {'kind': 'text', 'text': simple_response}
+        
+        # ⚡ 回复缓存（数据未变化时直接返回）
+        data_version = get_order_data_version()
+        cached_response = self.response_cache.get(user_message, data_version, user_id)
+        if cached_response:
+            self._record_turn(user_id, user_message, cached_response)
+            return {'kind': 'text', 'text': cached_response, 'cached': True}
+        
+        # 检查LLM可用性
+        if not self.gateway.available:
+            return {'kind': 'error', 'message': '抱歉，DeepSeek AI助手暂时不可用。您可以尝试使用快速查询功能（如：输入「统计」、「今天」、「紧急」等）。'}
+        
+        # 📊 并发收集上下文（各来源独立超时，超时则不带该部分；历史和摘要是单键读取，直接在当前线程执行）
+        timeouts = getattr(settings, 'AI_CONTEXT_TIMEOUTS', {})
+        sources = {
+            'history': ContextSource(lambda: self.sessions.get_messages(user_id), 0, [], inline=True),
+        }
+        # 工具模式下只给当前时间，数据由大模型按需查询
+        if not self.use_tools:
+            sources['order_context'] = ContextSource(
+                self._get_order_context_data, timeouts.get('order_context', 1.5),
+                "<order_data_context>\n⚠️ 订单数据暂时无法获取\n</order_data_context>\n"
+            )
+        if self.memory:
+            sources['fragments'] = ContextSource(
+                lambda: self.memory.retrieve_relevant_conversations(user_message, user_id=user_id, limit=5, similarity_threshold=0.2),
+                timeouts.get('fragments', 0.5), []
+            )
+            sources['summary'] = ContextSource(lambda: self.memory.get_summary(user_id), 0, '', inline=True)
+        context = gather_context(sources)
+        
+        order_context = context.get('order_context') or (
+            f"<order_data_context>\n当前时间：{timezone.now().strftime('%Y-%m-%d %H:%M')}\n</order_data_context>\n"
+        )
+        
+        # 🤖 按token预算组装消息
+        messages = self.prompt_builder.build(
+            self.system_prompt,
+            user_message,
+            data_context=order_context,
+            fragments=context.get('fragments', []),
+            history=context['history'],
+            summary=context.get('summary', '')
+        )
+        return {'kind': 'llm', 'messages': messages, 'data_version': data_version}
+    
+    def _finish_chat(self, user_message: str, user_id: Optional[int], ai_response: str, data_version: str):
+        """对话完成后记录历史、缓存和RAG记忆（RAG记忆进入写入队列，由后台批量落盘）"""
+        self._record_turn(user_id, user_message, ai_response)
+        self.response_cache.set(user_message, data_version, ai_response, user_id)
+        
+        if self.memory_writer and ai_response:
+            self.memory_writer.submit(user_message, ai_response, user_id)
+    
+    def _record_turn(self, user_id: Optional[int], user_message: str, ai_response: str):
+        """记录一轮问答；移出会话窗口的较早记录压缩进滚动摘要"""
+        dropped = self.sessions.append(user_id, user_message, ai_response)
+        if dropped and self.memory:
+            # 摘要同样交给写入线程，保证同一用户的摘要更新按顺序执行
+            self.memory_writer.submit_call(self._fold_summary, user_id, dropped)
+    
+    def _fold_summary(self, user_id: Optional[int], dropped):
+        try:
+            summary = self.prompt_builder.compact(self.memory.get_summary(user_id), dropped)
+            self.memory.save_summary(user_id, summary)
+        except Exception as e:
+            print(f"⚠️ 更新对话摘要失败: {e}")
+    
+    # ---------- 工具调用循环 ----------
+    
+    def _round_llm(self, round_no: int):
+        """前 max_tool_rounds 轮允许调用工具，最后一轮强制直接作答"""
+        return self.tool_llm if round_no < self.max_tool_rounds else self.answer_llm
+    
+    def _run_tool_calls(self, messages: List, ai_message) -> None:
+        """执行一轮工具调用，把调用和结果追加到消息列表（会访问ORM）"""
+        messages.append(ai_message)
+        for call in ai_message.tool_calls:
+            result = self.tool_executor.run(call['name'], call.get('args') or {})
+            messages.append(ToolMessage(content=result, tool_call_id=call['id']))
     
+    def _invoke_with_tools(self, messages: List, user_id: Optional[int] = None) -> str:
+        """非流式：循环执行工具调用直到大模型给出回答"""
+        messages = list(messages)
+        for round_no in range(self.max_tool_rounds + 1):
+            ai_message = self.gateway.invoke(messages, user_id, llm=self._round_llm(round_no))
+            if not getattr(ai_message, 'tool_calls', None):
+                return ai_message.content
+            self._run_tool_calls(messages, ai_message)
+        return ''
+    
+    async def _ainvoke_with_tools(self, messages: List, user_id: Optional[int] = None) -> str:
+        """非流式（异步）"""
+        messages = list(messages)
+        for round_no in range(self.max_tool_rounds + 1):
+            ai_message = await self.gateway.ainvoke(messages, user_id, llm=self._round_llm(round_no))
+            if not getattr(ai_message, 'tool_calls', None):
+                return ai_message.content
+            await database_sync_to_async(self._run_tool_calls)(messages, ai_message)
+        return ''
+    
+    def _stream_with_tools(self, messages: List, user_id: Optional[int], collected: List[str]):
+        """流式：文本分块到达即输出，若本轮是工具调用则执行后进入下一轮"""
+        messages = list(messages)
+        for round_no in range(self.max_tool_rounds + 1):
+            gathered = None
+            for chunk in self.gateway.stream(messages, user_id, llm=self._round_llm(round_no)):
+                gathered = chunk if gathered is None else gathered + chunk
+                if chunk.content:
+                    collected.append(chunk.content)
+                    yield {
+                        'type': 'content',
+                        'content': chunk.content,
+                        'timestamp': timezone.now().isoformat()
+                    }
+            if gathered is None or not getattr(gathered, 'tool_calls', None):
+                return
+            self._run_tool_calls(messages, gathered)
+    
+    async def _astream_with_tools(self, messages: List, user_id: Optional[int], collected: List[str]):
+        """流式（异步）"""
+        messages = list(messages)
+        for round_no in range(self.max_tool_rounds + 1):
+            gathered = None
+            async for chunk in self.gateway.astream(messages, user_id, llm=self._round_llm(round_no)):
+                gathered = chunk if gathered is None else gathered + chunk
+                if chunk.content:
+                    collected.append(chunk.content)
+                    yield {
+                        'type': 'content',
+                        'content': chunk.content,
+                        'timestamp': timezone.now().isoformat()
+                    }
+            if gathered is None or not getattr(gathered, 'tool_calls', None):
+                return
+            await database_sync_to_async(self._run_tool_calls)(messages, gathered)
+    
+    # ---------- 流式对话 ----------
+    
+    @staticmethod
+    def _interrupted_event() -> Dict[str, Any]:
+        """流式输出到一半失败：已发送的内容保留，不计入历史和缓存"""
+        return {
+            'type': 'error',
+            'message': '回答中断，以上内容可能不完整，请稍后重试。',
+            'interrupted': True,
+            'timestamp': timezone.now().isoformat()
+        }
     
     def chat_stream(self, user_message: str, user_id: Optional[int] = None):
         """
-        优化的流式对话处理 - 简化流程，加快响应速度
+        同步流式对话处理（WSGI部署时 ConversationStreamAPI 使用；ASGI下使用 achat_stream）
         """
         try:
-            # 🚀 优先处理简单查询 - 最快路径
-            simple_response = self._handle_simple_queries(user_message)
-            if simple_response:
-                # 直接流式输出简单查询结果，无需状态更新
-                yield from self._stream_text_chunks(simple_response, delay=0.015)
-                yield {'type': 'complete', 'timestamp': timezone.now().isoformat()}
+            prepared = self._prepare_chat(user_message, user_id)
+            
+            if prepared['kind'] == 'text':
+                yield from self._stream_text_chunks(prepared['text'])
+                yield {'type': 'complete', 'cached': prepared.get('cached', False), 'timestamp': timezone.now().isoformat()}
                 return
             
-            # 检查LLM可用性
-            if self.llm is None:
-                yield {
-                    'type': 'error',
-                    'message': '抱歉，DeepSeek AI助手暂时不可用。您可以尝试使用快速查询功能。',
-                    'timestamp': timezone.now().isoformat()
-                }
+            if prepared['kind'] == 'error':
+                yield {'type': 'error', 'message': prepared['message'], 'timestamp': timezone.now().isoformat()}
                 return
             
-            # 📊 快速获取数据上下文（减少日志开销）
-            order_context = self._get_order_context_data()
+            messages = prepared['messages']
             
-            # 🧠 检索历史对话（简化处理）
-            conversation_context = ""
-            if self.memory:
+            # 🌊 流式AI调用，收到即转发
+            ai_response_chunks = []
+            try:
+                yield from self._stream_with_tools(messages, user_id, ai_response_chunks)
+                ai_response = ''.join(ai_response_chunks)
+                
+            except Exception as e:
+                # 已经输出过部分回答时不能再整段重发，只通知客户端回答中断
+                if ai_response_chunks:
+                    yield self._interrupted_event()
+                    return
+                if isinstance(e, LLMGatewayError):
+                    yield from self._stream_text_chunks(self._gateway_fallback(user_message, e))
+                    yield {'type': 'complete', 'degraded': True, 'timestamp': timezone.now().isoformat()}
+                    return
+                # 还没有任何输出 - 降级到非流式
                 try:
-                    relevant_conversations = self.memory.retrieve_relevant_conversations(
-                        user_message, user_id=user_id, limit=2, similarity_threshold=0.2
-                    )
-                    if relevant_conversations:
-                        conversation_context = f"\n<conversation_history>\n相关历史对话：\n"
-                        for i, conv in enumerate(relevant_conversations, 1):
-                            time_desc = "今天" if (timezone.now() - conv.timestamp.replace(tzinfo=timezone.get_current_timezone())).days == 0 else "最近"
-                            conversation_context += f"{i}. {time_desc}: {conv.user_message[:50]}\n"
-                        conversation_context += "</conversation_history>\n"
+                    ai_response = self._invoke_with_tools(messages, user_id)
+                    yield from self._stream_text_chunks(ai_response)
                 except Exception:
-                    pass  # 静默处理历史对话错误
+                    yield {
+                        'type': 'error',
+                        'message': '抱歉，DeepSeek服务暂时不可用。请尝试使用快速查询功能。',
+                        'timestamp': timezone.now().isoformat()
+                    }
+                    return
             
-            # 🤖 构建AI消息
-            enhanced_message = f"{order_context}{conversation_context}\n用户问题：{user_message}\n\n请基于以上数据简洁回答。"
+            self._finish_chat(user_message, user_id, ai_response, prepared['data_version'])
+            yield {'type': 'complete', 'timestamp': timezone.now().isoformat()}
             
-            # 更新对话历史
-            self.conversation_history.append(HumanMessage(content=user_message))
-            if len(self.conversation_history) > 16:  # 减少历史记录长度
-                self.conversation_history = self.conversation_history[-16:]
+        except Exception as e:
+            yield {
+                'type': 'error',
+                'message': f'系统繁忙，请稍后重试。错误信息：{str(e)[:50]}',
+                'timestamp': timezone.now().isoformat()
+            }
+    
+    async def achat_stream(self, user_message: str, user_id: Optional[int] = None):
+        """
+        异步流式对话处理 - 只在ORM/缓存访问时占用线程，大模型输出逐token转发
+        """
+        try:
+            # 不绑定到共享的同步线程，多个对话的准备阶段可以并行
+            prepared = await database_sync_to_async(self._prepare_chat, thread_sensitive=False)(user_message, user_id)
+            
+            if prepared['kind'] == 'text':
+                for event in self._stream_text_chunks(prepared['text']):
+                    yield event
+                yield {'type': 'complete', 'cached': prepared.get('cached', False), 'timestamp': timezone.now().isoformat()}
+                return
             
-            messages = [
-                SystemMessage(content=self.system_prompt),
-                *self.conversation_history[:-1],
-                HumanMessage(content=enhanced_message)
-            ]
+            if prepared['kind'] == 'error':
+                yield {'type': 'error', 'message': prepared['message'], 'timestamp': timezone.now().isoformat()}
+                return
+            
+            messages = prepared['messages']
             
-            # 🌊 流式AI调用 - 简化重试逻辑
             ai_response_chunks = []
             try:
-                for chunk in self.llm.stream(messages):
-                    if hasattr(chunk, 'content') and chunk.content:
-                        ai_response_chunks.append(chunk.content)
-                        yield {
-                            'type': 'content',
-                            'content': chunk.content,
-                            'timestamp': timezone.now().isoformat()
-                        }
-                        time.sleep(0.02)  # 减少延迟
-                
-                # 成功完成
+                async for event in self._astream_with_tools(messages, user_id, ai_response_chunks):
+                    yield event
                 ai_response = ''.join(ai_response_chunks)
-                self.conversation_history.append(AIMessage(content=ai_response))
-                
-                # 异步存储对话（不阻塞响应）
-                if self.memory and ai_response:
-                    try:
-                        context_type = self._determine_context_type(user_message, ai_response)
-                        self.memory.store_conversation(user_message, ai_response, user_id, context_type)
-                    except Exception:
-                        pass  # 静默处理存储错误
-                
-                yield {'type': 'complete', 'timestamp': timezone.now().isoformat()}
                 
             except Exception as e:
-                # 简化的错误处理 - 直接降级到非流式
+                # 已经输出过部分回答时不能再整段重发，只通知客户端回答中断
+                if ai_response_chunks:
+                    yield self._interrupted_event()
+                    return
+                if isinstance(e, LLMGatewayError):
+                    fallback = await database_sync_to_async(self._gateway_fallback)(user_message, e)
+                    for event in self._stream_text_chunks(fallback):
+                        yield event
+                    yield {'type': 'complete', 'degraded': True, 'timestamp': timezone.now().isoformat()}
+                    return
+                # 还没有任何输出 - 降级到非流式
                 try:
-                    response = self.llm.invoke(messages)
-                    ai_response = response.content
-                    self.conversation_history.append(AIMessage(content=ai_response))
-                    
-                    # 快速流式输出降级结果
-                    yield from self._stream_text_chunks(ai_response, delay=0.025)
-                    yield {'type': 'complete', 'timestamp': timezone.now().isoformat()}
-                    
+                    ai_response = await self._ainvoke_with_tools(messages, user_id)
+                    for event in self._stream_text_chunks(ai_response):
+                        yield event
                 except Exception:
                     yield {
                         'type': 'error',
                         'message': '抱歉，DeepSeek服务暂时不可用。请尝试使用快速查询功能。',
-                'timestamp': timezone.now().isoformat()
-            }
+                        'timestamp': timezone.now().isoformat()
+                    }
+                    return
+            
+            await database_sync_to_async(self._finish_chat, thread_sensitive=False)(user_message, user_id, ai_response, prepared['data_version'])
+            yield {'type': 'complete', 'timestamp': timezone.now().isoformat()}
             
         except Exception as e:
             yield {
@@ -527,18 +815,14 @@ class ConversationAI:
                 'timestamp': timezone.now().isoformat()
             }
     
-    def _stream_text_chunks(self, text: str, delay: float = 0.02):
+    def _split_text_chunks(self, text: str) -> List[str]:
         """
-        优化的文本流式输出 - 智能分块，自然节奏
+        按语义单位分块 - 优先按句子分割，过长的句子再按逗号分割
         """
-        if not text:
-            return
-        
-        # 🚀 智能分块策略 - 按语义单位分割
-        # 优先按句子分割，再按词组分割
         chunks = []
+        if not text:
+            return chunks
         
-        # 首先按句子分割
         sentences = re.split(r'([。！？；])', text)
         for i in range(0, len(sentences), 2):
             if i + 1 < len(sentences):
@@ -560,123 +844,45 @@ class ConversationAI:
                 else:
                     chunks.append(sentence)
         
-        # 🌊 流式输出
-        for i, chunk in enumerate(chunks):
-            if not chunk.strip():
-                continue
-            
+        return chunks
+    
+    def _stream_text_chunks(self, text: str, delay: float = 0):
+        """
+        把整段文本按块输出为 content 事件
+        服务端默认不做停顿（节奏交给前端），delay 仅为兼容保留
+        """
+        for chunk in self._split_text_chunks(text):
             yield {
                 'type': 'content',
                 'content': chunk,
                 'timestamp': timezone.now().isoformat()
             }
-            
-            # 🎯 智能延迟 - 根据内容调整
-            if chunk.endswith(('。', '！', '？')):
-                time.sleep(delay * 3)  # 句子结尾较长停顿
-            elif chunk.endswith(('，', '、', '：', '；')):
-                time.sleep(delay * 2)  # 短语结尾中等停顿
-            elif len(chunk) > 20:
-                time.sleep(delay * 1.5)  # 长内容稍慢
-            else:
-                time.sleep(delay)  # 标准延迟
+            if delay:
+                time.sleep(delay)
     
     def _handle_simple_queries(self, user_message: str) -> Optional[str]:
         """
-        超高速简单查询处理 - 目标: 0.01-0.05秒内返回结果
+        超高速简单查询处理 - 规则意图路由直接编译为ORM查询，不经过大模型
         """
         start_time = time.time()
-        message_cleaned = user_message.strip().lower()
-        
         try:
-            # 🚀 最高优先级：精确匹配（最快路径）
-            exact_commands = {
-                '统计': 'stats', '数据': 'stats', '概况': 'stats', '总览': 'stats',
-                '今天': 'today', '今日': 'today', '昨天': 'yesterday', '本周': 'week', '本月': 'month',
-                '待处理': 'pending', '处理中': 'processing', '已完成': 'completed',
-                '紧急': 'urgent', '急单': 'urgent', '交期': 'urgent',
-                '帮助': 'help', 'help': 'help', '你好': 'hello', 'hi': 'hello'
-            }
-            
-            command = exact_commands.get(message_cleaned)
-            if command:
-                result = self._execute_quick_command(command)
-                elapsed = time.time() - start_time
-                return f"{result}\n\n⚡ 快速查询 ({elapsed:.3f}s)"
-            
-            # 🎯 高效模糊匹配（单次遍历）
-            if len(message_cleaned) <= 20:  # 只对短消息进行模糊匹配
-                command = self._fuzzy_match_command(message_cleaned)
-                if command:
-                    result = self._execute_quick_command(command)
-                    elapsed = time.time() - start_time
-                    return f"{result}\n\n⚡ 智能匹配 ({elapsed:.3f}s)"
-            
-            # 🔢 订单号快速检测
-            if any(c.isdigit() for c in user_message[:10]):  # 只检查前10个字符
-                order_match = re.search(r'\b[A-Za-z]*\d{3,}[A-Za-z0-9]*\b', user_message)
-                if order_match:
-                    order_no = order_match.group()
-                    result = self.order_tool.get_order_details(order_no)
-                    elapsed = time.time() - start_time
-                    return f"{result}\n\n⚡ 订单查询 ({elapsed:.3f}s)"
-            
+            result = self.intent_router.answer(user_message)
+        except Exception as e:
+            print(f"⚠️ 意图路由失败，交给AI处理: {e}")
+            return None  # 交给AI处理
+        
+        if result is None:
             return None  # 未匹配，交给AI处理
-            
+        elapsed = time.time() - start_time
+        return f"{result}\n\n⚡ 快速查询 ({elapsed:.3f}s)"
+    
+    def _gateway_fallback(self, user_message: str, error: LLMGatewayError) -> str:
+        """大模型繁忙/限流/熔断时的降级回答：不要求完整理解，执行最接近的快速查询"""
+        try:
+            result = self.intent_router.answer(user_message, strict=False)
         except Exception:
-            return None  # 静默处理错误，交给AI处理
-    
-    def _execute_quick_command(self, command: str) -> str:
-        """执行预定义的快速命令"""
-        command_actions = {
-            'stats': lambda: self.order_tool.get_statistics(),
-            'today': lambda: self.order_tool.search_orders({'date_range': 'today'}),
-            'yesterday': lambda: self.order_tool.search_orders({'date_range': 'yesterday'}),
-            'week': lambda: self.order_tool.search_orders({'date_range': 'week'}),
-            'month': lambda: self.order_tool.search_orders({'date_range': 'month'}),
-            'pending': lambda: self.order_tool.search_orders({'status': 1}),
-            'processing': lambda: self.order_tool.search_orders({'status': 2}),
-            'completed': lambda: self.order_tool.search_orders({'status': 3}),
-            'urgent': lambda: self.order_tool.search_orders({'delivery_urgent': True}),
-            'help': lambda: "🤖 快速查询指南：\n📊 说「统计」查看概览\n📅 说「今天」查看今日订单\n⚡ 说「处理中」查看进行中订单\n🚨 说「紧急」查看急单\n💬 说具体问题让AI详细回答",
-            'hello': lambda: "👋 您好！我是订单管理AI助手\n\n💡 快速提示：\n• 「统计」- 查看数据概览\n• 「今天」- 今日订单\n• 「紧急」- 查看急单\n• 直接说订单号查询详情"
-        }
-        
-        action = command_actions.get(command)
-        return action() if action else "❓ 命令未识别"
-    
-    def _fuzzy_match_command(self, message: str) -> Optional[str]:
-        """高效的模糊匹配 - 单次扫描"""
-        # 关键词到命令的映射
-        keyword_map = {
-            # 统计相关
-            ('多少', '几个', '数量', '总数', '汇总'): 'stats',
-            ('新增', '新订单'): 'today',
-            
-            # 时间相关
-            ('当天', '本日'): 'today',
-            ('昨日',): 'yesterday',
-            ('这周', '一周', '七天'): 'week',
-            ('这月', '一月', '30天'): 'month',
-            
-            # 状态相关
-            ('未处理', '新订单'): 'pending',
-            ('进行中', '正在处理'): 'processing',
-            ('完成', '完成的'): 'completed',
-            
-            # 紧急相关
-            ('加急', '截止', '到期', '延期', '逾期', '超期'): 'urgent',
-            
-            # 其他
-            ('功能', '指令'): 'help'
-        }
-        
-        # 快速遍历匹配
-        for keywords, command in keyword_map.items():
-            if any(kw in message for kw in keywords):
-                return command
-        
-        return None
+            result = None
+        return f"⚠️ {error.reason}，先为您提供快速查询结果：\n\n{result or HELP_TEXT}"
     
     def _determine_context_type(self, user_message: str, ai_response: str) -> str:
         """确定对话的上下文类型"""
@@ -710,18 +916,24 @@ class ConversationAI:
         # 默认为一般对话
         return 'general'
     
-    def clear_history(self):
-        """清除对话历史"""
-        self.conversation_history = []
+    def clear_history(self, user_id: Optional[int] = None):
+        """清除指定用户的对话历史（以及由旧对话生成的缓存回复）"""
+        self.sessions.clear(user_id)
+        self.response_cache.invalidate_user(user_id)
+        if self.memory:
+            try:
+                self.memory.clear_summary(user_id)
+            except Exception:
+                pass
     
-    def get_conversation_summary(self) -> str:
-        """获取对话摘要"""
-        if not self.conversation_history:
+    def get_conversation_summary(self, user_id: Optional[int] = None) -> str:
+        """获取指定用户的对话摘要"""
+        human_messages = self.sessions.human_messages(user_id)
+        if not human_messages:
             return "暂无对话历史"
         
         # 简单的对话摘要
-        human_messages = [msg.content for msg in self.conversation_history if isinstance(msg, HumanMessage)]
-        return f"共进行了 {len(human_messages)} 轮对话，最近询问了：{human_messages[-1] if human_messages else '无'}"
+        return f"共进行了 {len(human_messages)} 轮对话，最近询问了：{human_messages[-1]}"
 
 
 # 全局实例
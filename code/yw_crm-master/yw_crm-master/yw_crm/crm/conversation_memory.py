@@ -4,13 +4,17 @@ RAG对话记忆模块
 """
 
 import os
+import re
 import json
 import sqlite3
 import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 import numpy as np
+from django.conf import settings
 from django.utils import timezone
 
 
@@ -25,84 +29,130 @@ class ConversationFragment:
     context_type: str  # 'order_query', 'statistics', 'general', etc.
     keywords: List[str]
     embedding: Optional[np.ndarray] = None
+    score: Optional[float] = None  # 检索时与查询的相似度
 
 
-class SimpleEmbedding:
-    """简单的文本嵌入实现（基于TF-IDF和关键词）"""
-    
-    def __init__(self):
-        self.vocabulary = set()
-        self.idf_scores = {}
-        
+class HashingEmbedding:
+    """无状态的哈希向量化（字符一元/二元组 + 带符号哈希，float32，L2归一化）
+
+    不维护词汇表，相同文本在任何进程中得到完全相同的向量。
+    """
+
+    # 去掉标点，保留中文、英文和数字
+    CLEAN_PATTERN = re.compile(r'[^\u4e00-\u9fa5a-zA-Z0-9]+')
+    STOP_WORDS = {'的', '了', '是', '在', '有', '和', '与', '或', '但', '不', '没', '也', '都', '很', '最', '更', '我', '你', '他', '她', '它'}
+    # 二元组与一元组分开编码，避免互相碰撞
+    BIGRAM_TAG = np.uint64(1 << 42)
+
+    def __init__(self, dimension: int = None):
+        self.dimension = int(dimension or getattr(settings, 'CONVERSATION_EMBEDDING_DIM', 512))
+        self._stop_codes = np.array([ord(word) for word in self.STOP_WORDS], dtype=np.uint64)
+
     def _extract_keywords(self, text: str) -> List[str]:
-        """提取关键词"""
-        # 简单的中文关键词提取
-        import re
-        
-        # 移除标点符号，保留中文、英文和数字
-        cleaned = re.sub(r'[^\u4e00-\u9fa5a-zA-Z0-9\s]', ' ', text.lower())
-        
-        # 分词（简单按空格分割，实际项目中可以使用jieba等）
-        words = cleaned.split()
-        
-        # 过滤停用词和短词
-        stop_words = {'的', '了', '是', '在', '有', '和', '与', '或', '但', '不', '没', '也', '都', '很', '最', '更', '我', '你', '他', '她', '它'}
-        keywords = [word for word in words if len(word) > 1 and word not in stop_words]
-        
-        return keywords
-    
-    def _calculate_tf_idf(self, keywords: List[str], all_keywords: List[List[str]]) -> np.ndarray:
-        """计算TF-IDF向量"""
-        # 简化的TF-IDF实现
-        vocab_size = len(self.vocabulary)
-        if vocab_size == 0:
-            return np.zeros(100)  # 返回固定长度的零向量
-        
-        # 创建词汇表索引
-        vocab_list = list(self.vocabulary)
-        vocab_dict = {word: i for i, word in enumerate(vocab_list)}
-        
-        # 计算TF
-        tf_vector = np.zeros(min(vocab_size, 100))  # 限制向量长度
-        for keyword in keywords:
-            if keyword in vocab_dict and vocab_dict[keyword] < 100:
-                tf_vector[vocab_dict[keyword]] += 1
-        
-        # 标准化
-        if np.sum(tf_vector) > 0:
-            tf_vector = tf_vector / np.sum(tf_vector)
-        
-        return tf_vector
-    
+        """提取关键词（仅用于存档展示，不参与向量计算）"""
+        words = self.CLEAN_PATTERN.sub(' ', text.lower()).split()
+        return [word for word in words if len(word) > 1 and word not in self.STOP_WORDS]
+
+    def _ngram_keys(self, text: str) -> np.ndarray:
+        """把文本转成字符一元组和相邻二元组的整数键"""
+        cleaned = self.CLEAN_PATTERN.sub(' ', text.lower())
+        codes = np.frombuffer(cleaned.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        if codes.size == 0:
+            return codes
+
+        valid = codes != 32  # 空格只作为分隔符
+        unigrams = codes[valid & ~np.isin(codes, self._stop_codes)]
+
+        pair_mask = valid[:-1] & valid[1:]
+        bigrams = (codes[:-1][pair_mask] << np.uint64(21)) | codes[1:][pair_mask] | self.BIGRAM_TAG
+
+        return np.concatenate([unigrams, bigrams])
+
+    @staticmethod
+    def _mix(keys: np.ndarray) -> np.ndarray:
+        """splitmix64 整数混淆，纯 numpy 计算且跨进程确定"""
+        with np.errstate(over='ignore'):
+            h = keys + np.uint64(0x9E3779B97F4A7C15)
+            h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            return h ^ (h >> np.uint64(31))
+
+    def encode_many(self, texts: List[str]) -> np.ndarray:
+        """批量编码，返回 (len(texts), dimension) 的 float32 矩阵"""
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        if not texts:
+            return matrix
+
+        key_arrays = [self._ngram_keys(text or '') for text in texts]
+        rows = np.repeat(np.arange(len(texts)), [keys.size for keys in key_arrays])
+        keys = np.concatenate(key_arrays)
+        if keys.size == 0:
+            return matrix
+
+        hashed = self._mix(keys)
+        buckets = (hashed % np.uint64(self.dimension)).astype(np.int64)
+        signs = np.where(hashed >> np.uint64(63), -1.0, 1.0)
+
+        flat = np.bincount(rows * self.dimension + buckets, weights=signs, minlength=matrix.size)
+        matrix[:] = flat.reshape(matrix.shape)
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
     def encode(self, text: str, all_texts: List[str] = None) -> np.ndarray:
-        """对文本进行编码"""
-        keywords = self._extract_keywords(text)
-        
-        # 更新词汇表
-        self.vocabulary.update(keywords)
-        
-        # 如果提供了所有文本，计算TF-IDF
-        if all_texts:
-            all_keywords = [self._extract_keywords(t) for t in all_texts]
-            return self._calculate_tf_idf(keywords, all_keywords)
-        
-        # 否则返回简单的词频向量
-        return self._simple_encoding(keywords)
-    
-    def _simple_encoding(self, keywords: List[str]) -> np.ndarray:
-        """简单编码：基于关键词哈希"""
-        vector = np.zeros(100)
-        for keyword in keywords:
-            # 使用哈希函数将关键词映射到向量位置
-            hash_val = int(hashlib.md5(keyword.encode()).hexdigest(), 16)
-            idx = hash_val % 100
-            vector[idx] += 1
-        
-        # 标准化
-        if np.sum(vector) > 0:
-            vector = vector / np.sum(vector)
-        
-        return vector
+        """对单条文本进行编码（all_texts 参数保留兼容，不再使用）"""
+        return self.encode_many([text])[0]
+
+
+# 兼容旧名称
+SimpleEmbedding = HashingEmbedding
+
+
+class _EmbeddingIndex:
+    """内存向量索引：一个用户（或全部用户）的归一化嵌入矩阵"""
+
+    def __init__(self, dimension: int, capacity: int = 64):
+        self.dimension = dimension
+        self.matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        self.ids: List[str] = []
+        # 对话ID -> 矩阵中的行号；INSERT OR REPLACE 重写的行以新 rowid 同步过来，按ID覆盖原行
+        self.positions: Dict[str, int] = {}
+        self.last_rowid = 0
+        # 只保护本索引；不同用户的同步/检索互不阻塞
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def add(self, rowid: int, conversation_id: str, embedding: np.ndarray):
+        """按对话ID写入一行向量：已有则覆盖，否则追加（容量不足时按倍数扩容；维度不符的旧数据跳过，需重新嵌入）"""
+        if embedding.shape[0] != self.dimension:
+            return
+        norm = np.linalg.norm(embedding)
+        if norm == 0:
+            return
+        position = self.positions.get(conversation_id)
+        if position is None:
+            if self.size >= self.matrix.shape[0]:
+                grown = np.zeros((self.matrix.shape[0] * 2, self.dimension), dtype=np.float32)
+                grown[:self.size] = self.matrix[:self.size]
+                self.matrix = grown
+            position = self.positions[conversation_id] = self.size
+            self.ids.append(conversation_id)
+        self.matrix[position] = embedding / norm
+        self.last_rowid = max(self.last_rowid, rowid)
+
+    def search(self, query: np.ndarray, limit: int, threshold: float) -> List[Tuple[float, str]]:
+        """一次矩阵-向量乘法 + argpartition 取 top-k"""
+        if self.size == 0 or limit <= 0:
+            return []
+        scores = self.matrix[:self.size] @ query
+        k = min(limit, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.ids[i]) for i in top if scores[i] > threshold]
 
 
 class ConversationMemory:
@@ -110,12 +160,27 @@ class ConversationMemory:
     
     def __init__(self, db_path: str = None):
         self.db_path = db_path or os.path.join(os.path.dirname(__file__), 'conversation_memory.db')
-        self.embedding_model = SimpleEmbedding()
+        self.embedding_model = HashingEmbedding()
+        # 每个线程一个长连接；向量索引按 user_id 缓存（None 表示不区分用户），最近最少使用的先淘汰
+        self._local = threading.local()
+        self._indexes: 'OrderedDict[Optional[int], _EmbeddingIndex]' = OrderedDict()
+        self._index_lock = threading.Lock()
+        self.max_indexes = getattr(settings, 'AI_MEMORY_MAX_INDEXES', 200)
         self.init_database()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的 WAL 模式长连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
         
     def init_database(self):
         """初始化数据库"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -139,137 +204,228 @@ class ConversationMemory:
             CREATE INDEX IF NOT EXISTS idx_timestamp ON conversations(timestamp)
         ''')
         
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_user_timestamp ON conversations(user_id, timestamp)
+        ''')
+        
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_context_type ON conversations(context_type)
         ''')
         
+        # 每个用户一条滚动摘要（较早的多轮对话压缩而来）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+        
         conn.commit()
-        conn.close()
     
     def store_conversation(self, user_message: str, ai_response: str, user_id: Optional[int] = None, context_type: str = 'general') -> str:
         """存储对话片段"""
-        # 生成唯一ID
-        conversation_id = hashlib.md5(f"{user_message}{ai_response}{timezone.now().isoformat()}".encode()).hexdigest()
-        
-        # 提取关键词
-        combined_text = f"{user_message} {ai_response}"
-        keywords = self.embedding_model._extract_keywords(combined_text)
-        
-        # 生成嵌入向量
-        embedding = self.embedding_model.encode(combined_text)
+        return self.store_conversations_batch([{
+            'user_message': user_message,
+            'ai_response': ai_response,
+            'user_id': user_id,
+            'context_type': context_type,
+        }])[0]
+    
+    def store_conversations_batch(self, turns: List[Dict[str, Any]]) -> List[str]:
+        """
+        批量存储对话片段：一次向量化编码，一个事务写入
+        每项包含 user_message、ai_response，可选 user_id、context_type、timestamp
+        """
+        if not turns:
+            return []
+        
+        combined_texts = [f"{turn['user_message']} {turn['ai_response']}" for turn in turns]
+        embeddings = self.embedding_model.encode_many(combined_texts)
+        
+        rows = []
+        for turn, combined_text, embedding in zip(turns, combined_texts, embeddings):
+            timestamp = turn.get('timestamp') or timezone.now().isoformat()
+            # 生成唯一ID
+            conversation_id = hashlib.md5(f"{turn['user_message']}{turn['ai_response']}{timestamp}".encode()).hexdigest()
+            keywords = self.embedding_model._extract_keywords(combined_text)
+            rows.append((
+                conversation_id,
+                turn.get('user_id'),
+                turn['user_message'],
+                turn['ai_response'],
+                timestamp,
+                turn.get('context_type') or 'general',
+                json.dumps(keywords, ensure_ascii=False),
+                embedding.tobytes()
+            ))
         
         # 存储到数据库
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO conversations 
-            (id, user_id, user_message, ai_response, timestamp, context_type, keywords, embedding)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            conversation_id,
-            user_id,
-            user_message,
-            ai_response,
-            timezone.now().isoformat(),
-            context_type,
-            json.dumps(keywords, ensure_ascii=False),
-            embedding.tobytes()
-        ))
-        
-        conn.commit()
-        conn.close()
-        
-        return conversation_id
+        conn = self._get_connection()
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO conversations 
+                (id, user_id, user_message, ai_response, timestamp, context_type, keywords, embedding)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+        
+        # 已加载的索引在下次检索时按 rowid 增量同步，这里无需直接写入
+        return [row[0] for row in rows]
+
+    def _get_index(self, user_id: Optional[int]) -> _EmbeddingIndex:
+        """取出（或新建）某个用户的索引，超过 max_indexes 时淘汰最久未用的"""
+        with self._index_lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = self._indexes[user_id] = _EmbeddingIndex(self.embedding_model.dimension)
+                while len(self._indexes) > self.max_indexes:
+                    self._indexes.popitem(last=False)
+            else:
+                self._indexes.move_to_end(user_id)
+            return index
+
+    def _sync_index(self, user_id: Optional[int]) -> _EmbeddingIndex:
+        """
+        加载/增量同步某个用户的内存向量索引（包括其它进程写入的新行）
+        查询数据库时不持有任何锁，只在追加到索引时持有该索引自己的锁
+        """
+        index = self._get_index(user_id)
+        with index.lock:
+            last_rowid = index.last_rowid
+
+        conn = self._get_connection()
+        if user_id is None:
+            rows = conn.execute(
+                'SELECT rowid, id, embedding FROM conversations WHERE rowid > ? ORDER BY rowid',
+                (last_rowid,)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                'SELECT rowid, id, embedding FROM conversations WHERE user_id = ? AND rowid > ? ORDER BY rowid',
+                (user_id, last_rowid)
+            ).fetchall()
+
+        with index.lock:
+            for rowid, conversation_id, blob in rows:
+                # 其它线程可能已同步过同一批行
+                if rowid <= index.last_rowid:
+                    continue
+                if blob:
+                    index.add(rowid, conversation_id, np.frombuffer(blob, dtype=np.float32))
+                index.last_rowid = max(index.last_rowid, rowid)
+        return index
     
     def retrieve_relevant_conversations(self, query: str, user_id: Optional[int] = None, limit: int = 3, similarity_threshold: float = 0.1) -> List[ConversationFragment]:
-        """检索相关的历史对话"""
-        # 对查询进行编码
-        query_embedding = self.embedding_model.encode(query)
-        
-        # 从数据库获取候选对话
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """检索相关的历史对话（覆盖全部历史，向量化计算相似度）"""
+        # 对查询进行编码（已L2归一化）
+        query_vector = self.embedding_model.encode(query)
+        if not query_vector.any():
+            return []
         
-        # 构建查询条件
-        query_conditions = []
-        params = []
-        
-        if user_id is not None:
-            query_conditions.append("user_id = ?")
-            params.append(user_id)
-        
-        # 只获取最近30天的对话
-        thirty_days_ago = (timezone.now() - timedelta(days=30)).isoformat()
-        query_conditions.append("timestamp > ?")
-        params.append(thirty_days_ago)
-        
-        where_clause = " AND ".join(query_conditions) if query_conditions else "1=1"
-        
-        cursor.execute(f'''
+        try:
+            index = self._sync_index(user_id)
+            with index.lock:
+                hits = index.search(query_vector, limit, similarity_threshold)
+        except Exception as e:
+            print(f"检索对话索引时出错: {e}")
+            return []
+        
+        if not hits:
+            return []
+        
+        # 只回表读取命中的几行
+        conn = self._get_connection()
+        placeholders = ','.join('?' * len(hits))
+        rows = conn.execute(f'''
             SELECT id, user_id, user_message, ai_response, timestamp, context_type, keywords, embedding
             FROM conversations 
-            WHERE {where_clause}
-            ORDER BY timestamp DESC
-            LIMIT 50
-        ''', params)
-        
-        rows = cursor.fetchall()
-        conn.close()
+            WHERE id IN ({placeholders})
+        ''', [conversation_id for _, conversation_id in hits]).fetchall()
+        rows_by_id = {row[0]: row for row in rows}
         
-        # 计算相似度并排序
         relevant_conversations = []
-        
-        for row in rows:
+        for score, conversation_id in hits:
+            row = rows_by_id.get(conversation_id)
+            if row is None:
+                # 已被清理（可能是其它进程）
+                continue
             try:
-                stored_embedding = np.frombuffer(row[7], dtype=np.float64)
-                
-                # 计算余弦相似度
-                similarity = self._calculate_cosine_similarity(query_embedding, stored_embedding)
-                
-                if similarity > similarity_threshold:
-                    fragment = ConversationFragment(
-                        id=row[0],
-                        user_id=row[1],
-                        user_message=row[2],
-                        ai_response=row[3],
-                        timestamp=datetime.fromisoformat(row[4]),
-                        context_type=row[5],
-                        keywords=json.loads(row[6]) if row[6] else [],
-                        embedding=stored_embedding
-                    )
-                    relevant_conversations.append((similarity, fragment))
+                relevant_conversations.append(ConversationFragment(
+                    id=row[0],
+                    user_id=row[1],
+                    user_message=row[2],
+                    ai_response=row[3],
+                    timestamp=datetime.fromisoformat(row[4]),
+                    context_type=row[5],
+                    keywords=json.loads(row[6]) if row[6] else [],
+                    embedding=np.frombuffer(row[7], dtype=np.float32),
+                    score=score
+                ))
             except Exception as e:
                 print(f"处理对话片段时出错: {e}")
                 continue
         
-        # 按相似度排序并返回前N个
-        relevant_conversations.sort(key=lambda x: x[0], reverse=True)
-        return [conv[1] for conv in relevant_conversations[:limit]]
+        return relevant_conversations
     
-    def _calculate_cosine_similarity(self, vec1: np.ndarray, vec2: np.ndarray) -> float:
-        """计算余弦相似度"""
-        try:
-            # 确保向量长度一致
-            min_len = min(len(vec1), len(vec2))
-            vec1 = vec1[:min_len]
-            vec2 = vec2[:min_len]
-            
-            # 计算余弦相似度
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
+    @staticmethod
+    def _summary_key(user_id: Optional[int]) -> str:
+        return str(user_id) if user_id is not None else 'anonymous'
+    
+    def get_summary(self, user_id: Optional[int]) -> str:
+        """获取用户的滚动对话摘要"""
+        row = self._get_connection().execute(
+            'SELECT summary FROM conversation_summaries WHERE user_key = ?',
+            (self._summary_key(user_id),)
+        ).fetchone()
+        return row[0] if row else ''
+    
+    def save_summary(self, user_id: Optional[int], summary: str):
+        """保存用户的滚动对话摘要"""
+        conn = self._get_connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO conversation_summaries (user_key, summary, updated_at) VALUES (?, ?, ?)',
+                (self._summary_key(user_id), summary, timezone.now().isoformat())
+            )
+    
+    def clear_summary(self, user_id: Optional[int]):
+        """清除用户的滚动对话摘要"""
+        conn = self._get_connection()
+        with conn:
+            conn.execute('DELETE FROM conversation_summaries WHERE user_key = ?', (self._summary_key(user_id),))
+    
+    def reembed_conversations(self, batch_size: int = 500) -> int:
+        """用当前向量化器重新计算全部对话的嵌入向量，返回处理条数"""
+        conn = self._get_connection()
+        total = 0
+        last_rowid = 0
+        
+        while True:
+            rows = conn.execute('''
+                SELECT rowid, user_message, ai_response FROM conversations
+                WHERE rowid > ? ORDER BY rowid LIMIT ?
+            ''', (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
             
-            if norm1 == 0 or norm2 == 0:
-                return 0.0
+            matrix = self.embedding_model.encode_many([f"{row[1]} {row[2]}" for row in rows])
+            with conn:
+                conn.executemany(
+                    'UPDATE conversations SET embedding = ? WHERE rowid = ?',
+                    [(matrix[i].tobytes(), row[0]) for i, row in enumerate(rows)]
+                )
             
-            return dot_product / (norm1 * norm2)
-        except Exception:
-            return 0.0
+            total += len(rows)
+            last_rowid = rows[-1][0]
+        
+        with self._index_lock:
+            self._indexes.clear()
+        
+        return total
     
     def get_user_conversation_summary(self, user_id: int, days: int = 7) -> Dict[str, Any]:
         """获取用户对话摘要"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         since_date = (timezone.now() - timedelta(days=days)).isoformat()
@@ -291,8 +447,6 @@ class ConversationMemory:
         
         total_conversations = cursor.fetchone()[0]
         
-        conn.close()
-        
         return {
             'total_conversations': total_conversations,
             'context_distribution': [
@@ -304,15 +458,18 @@ class ConversationMemory:
     
     def clean_old_conversations(self, days_to_keep: int = 90):
         """清理旧的对话记录"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._get_connection()
         
         cutoff_date = (timezone.now() - timedelta(days=days_to_keep)).isoformat()
         
-        cursor.execute('DELETE FROM conversations WHERE timestamp < ?', (cutoff_date,))
+        with conn:
+            cursor = conn.execute('DELETE FROM conversations WHERE timestamp < ?', (cutoff_date,))
         
         deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
         
-        return deleted_count 
\ No newline at end of file
+        # 索引中的过期行需要重建
+        if deleted_count:
+            with self._index_lock:
+                self._indexes.clear()
+        
+        return deleted_count
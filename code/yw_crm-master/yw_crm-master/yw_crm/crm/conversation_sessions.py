@@ -0,0 +1,162 @@
+"""
+对话会话存储
+按用户隔离ConversationAI的多轮对话历史：限制轮数和字符数，空闲会话按LRU淘汰；
+可选使用Django缓存作为共享后端，使多个ASGI进程看到一致的历史
+"""
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+from utils.cache import shared_cache as cache
+
+
+# 每条记录为 (role, content)，role 取 'human' / 'ai'
+Turn = Tuple[str, str]
+
+
+class ConversationSessionStore:
+    """按用户隔离、有界的对话历史（线程安全）"""
+
+    CACHE_KEY_PREFIX = 'crm:ai_session:'
+    LOCK_KEY_PREFIX = 'crm:ai_session_lock:'
+    # 共享后端追加时按用户加锁：锁的最长持有时间 / 最长等待时间（秒）
+    LOCK_TIMEOUT = 5
+    LOCK_WAIT = 2
+
+    def __init__(self, max_turns: int = None, max_chars: int = None, max_sessions: int = None,
+                 idle_timeout: int = None, backend: str = None):
+        self.max_turns = max_turns or getattr(settings, 'AI_SESSION_MAX_TURNS', 8)
+        self.max_chars = max_chars or getattr(settings, 'AI_SESSION_MAX_CHARS', 6000)
+        self.max_sessions = max_sessions or getattr(settings, 'AI_SESSION_MAX_USERS', 500)
+        self.idle_timeout = idle_timeout or getattr(settings, 'AI_SESSION_IDLE_TIMEOUT', 3600)
+        # 'local'：进程内；'cache'：共享缓存 CACHES['shared']（多进程共享）
+        self.backend = backend or getattr(settings, 'AI_SESSION_BACKEND', 'local')
+        self._sessions = OrderedDict()  # user_key -> (last_active, [Turn, ...])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _user_key(user_id: Optional[int]) -> str:
+        return str(user_id) if user_id is not None else 'anonymous'
+
+    def _trim(self, turns: List[Turn]) -> Tuple[List[Turn], List[Turn]]:
+        """按轮数和字符数截断，保留最近的完整问答；返回（保留的, 被移出的）"""
+        start = max(len(turns) - self.max_turns * 2, 0)
+        total = 0
+        for i in range(len(turns) - 1, start - 1, -1):
+            total += len(turns[i][1])
+            if total > self.max_chars:
+                start = i + 1
+                break
+        # 不以AI回复开头
+        if start < len(turns) and turns[start][0] == 'ai':
+            start += 1
+        return turns[start:], turns[:start]
+
+    def _load(self, key: str) -> List[Turn]:
+        if self.backend == 'cache':
+            try:
+                return [tuple(turn) for turn in cache.get(self.CACHE_KEY_PREFIX + key) or []]
+            except Exception as e:
+                print(f"⚠️ 读取对话会话失败: {e}")
+                return []
+
+        with self._lock:
+            return self._load_local(key)
+
+    def _load_local(self, key: str) -> List[Turn]:
+        """调用方持锁"""
+        session = self._sessions.get(key)
+        if session is None:
+            return []
+        if time.time() - session[0] > self.idle_timeout:
+            del self._sessions[key]
+            return []
+        self._sessions.move_to_end(key)
+        return list(session[1])
+
+    def _save_local(self, key: str, turns: List[Turn]):
+        """调用方持锁"""
+        self._sessions[key] = (time.time(), turns)
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    @contextmanager
+    def _cache_lock(self, key: str):
+        """
+        共享后端的按用户锁（cache.add 在Redis上是 SET NX，多进程间原子）
+        等待超过 LOCK_WAIT 仍未拿到时照常写入，宁可丢一轮也不让对话卡住
+        """
+        lock_key = self.LOCK_KEY_PREFIX + key
+        token = uuid.uuid4().hex
+        acquired = False
+        deadline = time.monotonic() + self.LOCK_WAIT
+        try:
+            while True:
+                try:
+                    acquired = cache.add(lock_key, token, self.LOCK_TIMEOUT)
+                except Exception as e:
+                    print(f"⚠️ 获取对话会话锁失败: {e}")
+                    break
+                if acquired or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.01)
+            if not acquired:
+                print(f"⚠️ 等待对话会话锁超时: {key}")
+            yield
+        finally:
+            if acquired:
+                try:
+                    # 锁已过期并被其它请求取得时不能删除
+                    if cache.get(lock_key) == token:
+                        cache.delete(lock_key)
+                except Exception as e:
+                    print(f"⚠️ 释放对话会话锁失败: {e}")
+
+    def get_messages(self, user_id: Optional[int]) -> List[BaseMessage]:
+        """获取用户的历史消息（LangChain消息对象）"""
+        return [
+            HumanMessage(content=content) if role == 'human' else AIMessage(content=content)
+            for role, content in self._load(self._user_key(user_id))
+        ]
+
+    def append(self, user_id: Optional[int], user_message: str, ai_response: str) -> List[Turn]:
+        """追加一轮问答，返回因超出上限被移出的较早记录（供调用方压缩成摘要）"""
+        key = self._user_key(user_id)
+        new_turns = [('human', user_message), ('ai', ai_response)]
+        # 读取-追加-写回在同一把锁内完成，同一用户的并发请求（多个标签页、SSE与REST同时）不会互相覆盖
+        if self.backend == 'cache':
+            with self._cache_lock(key):
+                kept, dropped = self._trim(self._load(key) + new_turns)
+                try:
+                    cache.set(self.CACHE_KEY_PREFIX + key, kept, self.idle_timeout)
+                except Exception as e:
+                    print(f"⚠️ 保存对话会话失败: {e}")
+            return dropped
+
+        with self._lock:
+            kept, dropped = self._trim(self._load_local(key) + new_turns)
+            self._save_local(key, kept)
+        return dropped
+
+    def clear(self, user_id: Optional[int]):
+        """清除用户的对话历史"""
+        key = self._user_key(user_id)
+        if self.backend == 'cache':
+            try:
+                cache.delete(self.CACHE_KEY_PREFIX + key)
+            except Exception as e:
+                print(f"⚠️ 清除对话会话失败: {e}")
+            return
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def human_messages(self, user_id: Optional[int]) -> List[str]:
+        """用户在会话中提出的问题"""
+        return [content for role, content in self._load(self._user_key(user_id)) if role == 'human']
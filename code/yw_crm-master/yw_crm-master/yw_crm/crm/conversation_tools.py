@@ -0,0 +1,138 @@
+"""
+对话AI的函数调用工具
+把 OrderQueryTool 的查询以 OpenAI function calling 的格式暴露给大模型，
+由大模型按需调用；本地执行并按订单数据版本缓存结果
+"""
+import json
+from typing import Any, Dict
+
+from .data_version import VersionedLRUCache
+
+
+# 返回给大模型的单个工具结果最大长度
+MAX_TOOL_RESULT_CHARS = 2000
+
+
+ORDER_TOOLS = [
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_orders',
+            'description': '按条件搜索订单，返回匹配数量和最多8个订单摘要（产品、订单号、状态、委印日期）',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'order_no': {'type': 'string', 'description': '订单号（模糊匹配）'},
+                    'customer_name': {'type': 'string', 'description': '客户名称（模糊匹配）'},
+                    'product_name': {'type': 'string', 'description': '印品名称（模糊匹配）'},
+                    'salesman': {'type': 'string', 'description': '业务员姓名（模糊匹配）'},
+                    'status': {'type': 'integer', 'enum': [1, 2, 3, 4], 'description': '订单状态：1待处理 2处理中 3已完成 4已取消'},
+                    'date_range': {'type': 'string', 'enum': ['today', 'yesterday', 'week', 'month'], 'description': '委印日期范围'},
+                    'delivery_urgent': {'type': 'boolean', 'description': '只看3天内到交期且未完成的紧急订单'},
+                },
+            },
+        },
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_order_details',
+            'description': '获取单个订单的详细信息（客户、联系人、交期、生产进度）',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'order_no': {'type': 'string', 'description': '完整订单号'},
+                },
+                'required': ['order_no'],
+            },
+        },
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_statistics',
+            'description': '获取订单总体统计：总数、各状态数量、今日新增、紧急订单数',
+            'parameters': {'type': 'object', 'properties': {}},
+        },
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_steps',
+            'description': '按生产步骤查询：某个步骤（如印刷、装订）当前有哪些订单处于指定状态',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'step_name': {'type': 'string', 'description': '步骤名称（模糊匹配）'},
+                    'status': {'type': 'integer', 'enum': [1, 2, 3, 4], 'description': '步骤状态：1待开始 2进行中 3已完成 4已跳过，默认2'},
+                },
+            },
+        },
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_order_materials',
+            'description': '获取单个订单的用料明细（材料名称、规格、数量、金额）',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'order_no': {'type': 'string', 'description': '完整订单号'},
+                },
+                'required': ['order_no'],
+            },
+        },
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'search_materials',
+            'description': '查找用料明细中包含某种材料的订单',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'material_name': {'type': 'string', 'description': '材料名称关键字，如：铜版纸'},
+                },
+                'required': ['material_name'],
+            },
+        },
+    },
+]
+
+
+class OrderToolExecutor:
+    """在本地执行大模型发起的工具调用"""
+
+    def __init__(self, order_tool):
+        self.order_tool = order_tool
+        self.cache = VersionedLRUCache('order_tools', max_size=256)
+        self.handlers = {
+            'search_orders': self._search_orders,
+            'get_order_details': lambda args: self.order_tool.get_order_details(str(args.get('order_no', '')).strip()),
+            'get_statistics': lambda args: self.order_tool.get_statistics(),
+            'search_steps': lambda args: self.order_tool.search_steps(args.get('step_name'), args.get('status') or 2),
+            'get_order_materials': lambda args: self.order_tool.get_order_materials(str(args.get('order_no', '')).strip()),
+            'search_materials': lambda args: self.order_tool.search_materials(str(args.get('material_name', '')).strip()),
+        }
+
+    def _search_orders(self, args: Dict[str, Any]) -> str:
+        allowed = ('order_no', 'customer_name', 'product_name', 'salesman', 'status', 'date_range', 'delivery_urgent')
+        query_params = {key: args[key] for key in allowed if args.get(key) not in (None, '')}
+        return self.order_tool.search_orders(query_params)
+
+    def run(self, name: str, args: Dict[str, Any]) -> str:
+        """执行工具调用，结果按（工具名, 参数, 数据版本）缓存"""
+        handler = self.handlers.get(name)
+        if handler is None:
+            return f"未知工具：{name}"
+
+        args = args or {}
+        key = (name, json.dumps(args, sort_keys=True, ensure_ascii=False))
+        try:
+            result = self.cache.get_or_set(key, lambda: handler(args))
+        except Exception as e:
+            return f"工具 {name} 执行失败：{str(e)[:100]}"
+
+        if len(result) > MAX_TOOL_RESULT_CHARS:
+            result = result[:MAX_TOOL_RESULT_CHARS] + "\n...（结果过长已截断）"
+        return result
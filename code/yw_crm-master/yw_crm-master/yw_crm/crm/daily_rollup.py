@@ -0,0 +1,224 @@
+"""
+每日运营汇总
+按 日期 + 步骤 累计新增订单、开始/完成/跳过步骤数和步骤耗时：
+步骤/订单保存时由信号按「新状态贡献 - 旧状态贡献」在事务提交后增量累加，
+rollup_daily_operations 命令按原始数据重算指定日期并刷新状态快照。
+日报和趋势报表只读汇总表，不再扫描全部订单/进度数据
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Count, Sum, Max, F, Q, DurationField, ExpressionWrapper
+from django.db.models.functions import Greatest, TruncDate
+from django.utils import timezone
+
+from .models import PrintOrderFlat, OrderProgress, DailyOperationRollup
+
+
+# 订单级汇总行的 step_name
+ORDER_ROW = ''
+# 进行中超过该天数的步骤计为停滞
+STALLED_STEP_DAYS = 2
+# 增量累加的事件字段（重算时会先清零）
+EVENT_FIELDS = ('orders_created', 'steps_started', 'steps_completed', 'steps_skipped', 'duration_seconds', 'duration_max_seconds')
+
+STEP_DURATION = ExpressionWrapper(F('end_time') - F('start_time'), output_field=DurationField())
+
+
+def _local_date(value) -> date:
+    return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+
+
+# ---------- 增量累加（信号调用） ----------
+
+def step_contribution(values: Optional[Dict[str, Any]]) -> Dict[Tuple[date, str], Dict[str, int]]:
+    """一个步骤在当前状态下对汇总表的贡献（与 rebuild_days 一致，只统计主订单的步骤）"""
+    contribution = defaultdict(dict)
+    if not values or values.get('detail_type') is not None:
+        return contribution
+    status, step_name = values['status'], values['step_name']
+    start_time, end_time = values['start_time'], values['end_time']
+
+    if start_time and status in (2, 3):
+        contribution[(_local_date(start_time), step_name)]['steps_started'] = 1
+    if end_time and status == 3:
+        fields = contribution[(_local_date(end_time), step_name)]
+        fields['steps_completed'] = 1
+        if start_time:
+            fields['duration_seconds'] = max(int((end_time - start_time).total_seconds()), 0)
+    if end_time and status == 4:
+        contribution[(_local_date(end_time), step_name)]['steps_skipped'] = 1
+    return contribution
+
+
+def order_contribution(values: Optional[Dict[str, Any]]) -> Dict[Tuple[date, str], Dict[str, int]]:
+    """一个订单对汇总表的贡献（只统计主订单）"""
+    contribution = defaultdict(dict)
+    if values and values.get('detail_type') is None and values.get('order_date'):
+        contribution[(_local_date(values['order_date']), ORDER_ROW)]['orders_created'] = 1
+    return contribution
+
+
+def apply_change(before, after):
+    """把 after - before 的差值累加到汇总表；单步最长耗时只在新增完成时更新"""
+    keys = set(before) | set(after)
+    for key in keys:
+        old, new = before.get(key, {}), after.get(key, {})
+        updates = {}
+        for field in set(old) | set(new):
+            delta = new.get(field, 0) - old.get(field, 0)
+            if delta:
+                updates[field] = F(field) + delta
+        if not updates:
+            continue
+        if new.get('duration_seconds') and 'steps_completed' in updates:
+            updates['duration_max_seconds'] = Greatest(F('duration_max_seconds'), new['duration_seconds'])
+
+        day, step_name = key
+        row, _ = DailyOperationRollup.objects.get_or_create(date=day, step_name=step_name)
+        DailyOperationRollup.objects.filter(pk=row.pk).update(**updates)
+
+
+def step_values(instance) -> Dict[str, Any]:
+    try:
+        detail_type = instance.order.detail_type
+    except ObjectDoesNotExist:
+        # 级联删除时订单可能已先被删除，按主订单处理（rebuild_days 可校正）
+        detail_type = None
+    return {
+        'status': instance.status,
+        'step_name': instance.step_name,
+        'start_time': instance.start_time,
+        'end_time': instance.end_time,
+        'detail_type': detail_type,
+    }
+
+
+def order_values(instance) -> Dict[str, Any]:
+    return {'detail_type': instance.detail_type, 'order_date': instance.order_date}
+
+
+# ---------- 重算与快照（命令调用） ----------
+
+def rebuild_days(start: date, end: date) -> int:
+    """按原始数据重算 [start, end] 的事件字段，返回写入的行数"""
+    rows = defaultdict(lambda: dict.fromkeys(EVENT_FIELDS, 0))
+    steps = OrderProgress.objects.filter(order__detail_type=None)
+
+    started = (steps.filter(status__in=[2, 3], start_time__date__range=(start, end))
+               .annotate(day=TruncDate('start_time')).values('day', 'step_name').annotate(count=Count('id')))
+    for item in started:
+        rows[(item['day'], item['step_name'])]['steps_started'] = item['count']
+
+    completed = (steps.filter(status=3, end_time__date__range=(start, end))
+                 .annotate(day=TruncDate('end_time')).values('day', 'step_name')
+                 .annotate(count=Count('id'), total=Sum(STEP_DURATION), longest=Max(STEP_DURATION)))
+    for item in completed:
+        fields = rows[(item['day'], item['step_name'])]
+        fields['steps_completed'] = item['count']
+        fields['duration_seconds'] = int(item['total'].total_seconds()) if item['total'] else 0
+        fields['duration_max_seconds'] = int(item['longest'].total_seconds()) if item['longest'] else 0
+
+    skipped = (steps.filter(status=4, end_time__date__range=(start, end))
+               .annotate(day=TruncDate('end_time')).values('day', 'step_name').annotate(count=Count('id')))
+    for item in skipped:
+        rows[(item['day'], item['step_name'])]['steps_skipped'] = item['count']
+
+    created = (PrintOrderFlat.objects.filter(detail_type=None, order_date__date__range=(start, end))
+               .annotate(day=TruncDate('order_date')).values('day').annotate(count=Count('id')))
+    for item in created:
+        rows[(item['day'], ORDER_ROW)]['orders_created'] = item['count']
+
+    with transaction.atomic():
+        DailyOperationRollup.objects.filter(date__range=(start, end)).update(**dict.fromkeys(EVENT_FIELDS, 0))
+        for (day, step_name), fields in rows.items():
+            DailyOperationRollup.objects.update_or_create(date=day, step_name=step_name, defaults=fields)
+    return len(rows)
+
+
+def refresh_snapshot(day: Optional[date] = None):
+    """刷新当天的状态快照：订单各状态数、逾期数；各步骤的待开始/进行中/停滞数"""
+    now = timezone.now()
+    day = day or timezone.localdate()
+
+    orders = PrintOrderFlat.objects.filter(detail_type=None).aggregate(
+        pending=Count('id', filter=Q(status=1)),
+        processing=Count('id', filter=Q(status=2)),
+        completed=Count('id', filter=Q(status=3)),
+        cancelled=Count('id', filter=Q(status=4)),
+        overdue=Count('id', filter=Q(status__in=[1, 2], delivery_date__lt=now)),
+    )
+    step_rows = (OrderProgress.objects.filter(order__detail_type=None).values('step_name').annotate(
+        pending=Count('id', filter=Q(status=1)),
+        processing=Count('id', filter=Q(status=2)),
+        completed=Count('id', filter=Q(status=3)),
+        cancelled=Count('id', filter=Q(status=4)),
+        overdue=Count('id', filter=Q(status=2, start_time__lte=now - timedelta(days=STALLED_STEP_DAYS))),
+    ))
+
+    with transaction.atomic():
+        for step_name, counts in [(ORDER_ROW, orders)] + [(item['step_name'], item) for item in step_rows]:
+            DailyOperationRollup.objects.update_or_create(date=day, step_name=step_name, defaults={
+                'pending_count': counts['pending'],
+                'processing_count': counts['processing'],
+                'completed_count': counts['completed'],
+                'cancelled_count': counts['cancelled'],
+                'overdue_count': counts['overdue'],
+                'snapshot_time': now,
+            })
+
+
+# ---------- 读取（报表调用） ----------
+
+def get_day_summary(day: date) -> Dict[str, Any]:
+    """某一天的汇总：订单行的新增/快照 + 所有步骤行的事件合计"""
+    order_row = DailyOperationRollup.objects.filter(date=day, step_name=ORDER_ROW).first()
+    steps = DailyOperationRollup.objects.filter(date=day).exclude(step_name=ORDER_ROW).aggregate(
+        started=Sum('steps_started'), completed=Sum('steps_completed'),
+        skipped=Sum('steps_skipped'), duration=Sum('duration_seconds'),
+    )
+    completed = steps['completed'] or 0
+    return {
+        'orders_created': order_row.orders_created if order_row else 0,
+        'steps_started': steps['started'] or 0,
+        'steps_completed': completed,
+        'steps_skipped': steps['skipped'] or 0,
+        'avg_duration_seconds': (steps['duration'] or 0) // completed if completed else 0,
+        'pending_count': order_row.pending_count if order_row else 0,
+        'processing_count': order_row.processing_count if order_row else 0,
+        'overdue_count': order_row.overdue_count if order_row else 0,
+        'snapshot_time': order_row.snapshot_time if order_row else None,
+    }
+
+
+def get_daily_trend(start: date, end: date) -> List[Dict[str, Any]]:
+    """[start, end] 每天的新增订单、开始/完成步骤数和平均耗时（一条分组查询）"""
+    rows = (DailyOperationRollup.objects.filter(date__range=(start, end)).values('date')
+            .annotate(created=Sum('orders_created'), started=Sum('steps_started'),
+                      completed=Sum('steps_completed'), duration=Sum('duration_seconds'))
+            .order_by('date'))
+    return [{
+        'date': row['date'],
+        'orders_created': row['created'] or 0,
+        'steps_started': row['started'] or 0,
+        'steps_completed': row['completed'] or 0,
+        'avg_duration_seconds': row['duration'] // row['completed'] if row['completed'] else 0,
+    } for row in rows]
+
+
+def get_step_durations(start: date, end: date) -> List[Dict[str, Any]]:
+    """[start, end] 各步骤的完成数与平均/最长耗时，按平均耗时降序"""
+    rows = (DailyOperationRollup.objects.filter(date__range=(start, end)).exclude(step_name=ORDER_ROW)
+            .values('step_name')
+            .annotate(completed=Sum('steps_completed'), duration=Sum('duration_seconds'), longest=Max('duration_max_seconds'))
+            .filter(completed__gt=0))
+    result = [{
+        'step_name': row['step_name'],
+        'steps_completed': row['completed'],
+        'avg_duration_seconds': row['duration'] // row['completed'],
+        'max_duration_seconds': row['longest'] or 0,
+    } for row in rows]
+    return sorted(result, key=lambda item: item['avg_duration_seconds'], reverse=True)
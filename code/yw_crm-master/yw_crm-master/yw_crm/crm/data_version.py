@@ -0,0 +1,91 @@
+"""
+订单数据版本
+订单/进度保存或删除时（见 crm/signals.py）递增版本号，
+AI回复、提示词上下文等缓存以版本号为键，数据不变时直接复用
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from django.conf import settings
+
+from utils.cache import shared_cache as cache
+from . import metrics
+
+
+VERSION_CACHE_KEY = 'crm:order_data_version'
+
+# 共享缓存不可用时退回进程内版本号
+_local_version = int(time.time() * 1000)
+_local_lock = threading.Lock()
+
+
+def get_order_data_version() -> str:
+    """获取当前订单数据版本"""
+    try:
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            # 以时间戳初始化，缓存被清空后也不会与旧版本号重复
+            cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+            version = cache.get(VERSION_CACHE_KEY)
+        if version is not None:
+            return str(version)
+    except Exception as e:
+        print(f"⚠️ 读取订单数据版本失败: {e}")
+    return str(_local_version)
+
+
+def bump_order_data_version():
+    """订单数据变化时调用，使相关缓存失效"""
+    global _local_version
+    with _local_lock:
+        _local_version += 1
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # 键不存在
+        cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+    except Exception as e:
+        print(f"⚠️ 更新订单数据版本失败: {e}")
+
+
+class VersionedLRUCache:
+    """进程内按数据版本失效的LRU缓存，另有TTL兜底（批量update等不触发信号的写入）"""
+
+    def __init__(self, name: str, max_size: int = 64, ttl: int = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl or getattr(settings, 'AI_CONTEXT_CACHE_TTL', 60)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key: Hashable, producer: Callable[[], Any]) -> Any:
+        """命中则返回缓存值，否则调用 producer 计算并缓存"""
+        version = get_order_data_version()
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self._entries.move_to_end(key)
+                metrics.record_cache(self.name, True)
+                return entry[2]
+
+        metrics.record_cache(self.name, False)
+        value = producer()
+
+        with self._lock:
+            self._entries[key] = (version, now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# 提示词上下文 / 统计信息共用
+context_cache = VersionedLRUCache('ai_context')
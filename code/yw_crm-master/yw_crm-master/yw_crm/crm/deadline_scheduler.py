@@ -0,0 +1,312 @@
+"""
+交期提醒调度器
+把未完成订单的交期阈值（3天内到期、今天到期、已逾期）放进按时间排序的小顶堆，
+到点时通过 WebSocket 推送提醒，不再由页面/对话反复查询数据库。
+订单保存/删除时由信号把变化发到调度器的通道；调度器由
+python manage.py run_deadline_scheduler 常驻运行，并定期与数据库对账
+"""
+import time
+import heapq
+import logging
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from utils.cache import shared_cache as cache
+from .models import PrintOrderFlat
+
+
+# 调度器接收订单变化的通道名
+SCHEDULER_CHANNEL = 'crm.deadline-scheduler'
+# 提醒推送到的 WebSocket 组
+ALERT_GROUP = 'notifications'
+# 各阶段订单数的缓存（仪表板统计优先读取）
+STAGE_COUNTS_CACHE_KEY = 'crm:deadline_stage_counts'
+
+URGENT_DAYS = 3
+OPEN_STATUSES = (1, 2)
+# 严重程度递增
+STAGES = ('urgent', 'today', 'overdue')
+STAGE_TEXT = {'urgent': '3天内到交期', 'today': '今天到交期', 'overdue': '已逾期'}
+
+logger = logging.getLogger(__name__)
+
+
+def stage_thresholds(delivery_date) -> List[Tuple[str, Any]]:
+    """订单进入各阶段的时刻"""
+    start_of_day = timezone.localtime(delivery_date).replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ('urgent', delivery_date - timedelta(days=URGENT_DAYS)),
+        ('today', start_of_day),
+        ('overdue', delivery_date),
+    ]
+
+
+def current_stage(delivery_date, now) -> Optional[str]:
+    stage = None
+    for name, threshold in stage_thresholds(delivery_date):
+        if threshold <= now:
+            stage = name
+    return stage
+
+
+def notify_order_changed(instance, deleted: bool = False):
+    """
+    订单交期/状态变化后通知调度器
+    只在调度器心跳（发布的阶段统计）未过期时发送，调度器未运行时不往通道里堆积消息；
+    期间漏掉的变化由调度器启动时的全量对账补上
+    """
+    if get_stage_counts() is None:
+        logger.debug('交期调度器未运行，跳过订单 %s 的变化通知', instance.id)
+        return
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        async_to_sync(channel_layer.send)(SCHEDULER_CHANNEL, {
+            'type': 'deadline.update',
+            'order_id': instance.id,
+            'order_no': instance.order_no,
+            'product_name': instance.product_name,
+            'customer_name': instance.customer_name,
+            'status': instance.status,
+            'delivery_date': instance.delivery_date.isoformat() if instance.delivery_date else None,
+            'deleted': deleted,
+        })
+    except Exception as e:
+        logger.debug('通知交期调度器失败: %s', e)
+
+
+def get_stage_counts(max_age: int = None) -> Optional[Dict[str, Any]]:
+    """读取调度器发布的各阶段订单数；调度器未运行或数据过旧时返回 None"""
+    max_age = max_age or getattr(settings, 'DEADLINE_COUNTS_MAX_AGE', 120)
+    try:
+        counts = cache.get(STAGE_COUNTS_CACHE_KEY)
+    except Exception:
+        return None
+    if not counts or time.time() - counts.get('updated_at', 0) > max_age:
+        return None
+    return counts
+
+
+class DeadlineScheduler:
+    """交期阈值小顶堆 + 通道消息驱动的调度循环"""
+
+    def __init__(self, resync_interval: int = None, catch_up: bool = False):
+        self.resync_interval = resync_interval or getattr(settings, 'DEADLINE_RESYNC_INTERVAL', 600)
+        self.catch_up = catch_up
+        self.channel_layer = get_channel_layer()
+        # 堆元素：(触发时间戳, 代次, 订单ID, 阶段)；订单更新时换新代次，旧元素出堆时丢弃
+        self.heap: List[Tuple[float, int, int, str]] = []
+        self.orders: Dict[int, Dict[str, Any]] = {}
+        self._generation = itertools.count()
+        self._updates: asyncio.Queue = None
+        self._counts_published_at = 0.0
+        self._counts_dirty = True
+        self.alerts_sent = 0
+
+    # ---------- 堆维护 ----------
+
+    def schedule(self, order: Dict[str, Any], now, emit_crossing: bool = True) -> List[str]:
+        """
+        放入/更新一个订单，返回需要立即推送的阶段
+        emit_crossing：更新后阶段比原来更严重时立即提醒（如交期被提前、新建的急单）
+        """
+        order_id = order['id']
+        previous = self.orders.pop(order_id, None)
+        self._counts_dirty = True
+        if order.get('status') not in OPEN_STATUSES or not order.get('delivery_date'):
+            return []
+
+        generation = next(self._generation)
+        stage = current_stage(order['delivery_date'], now)
+        self.orders[order_id] = dict(order, generation=generation, stage=stage)
+
+        for name, threshold in stage_thresholds(order['delivery_date']):
+            if threshold > now:
+                heapq.heappush(self.heap, (threshold.timestamp(), generation, order_id, name))
+
+        if not emit_crossing or stage is None:
+            return []
+        previous_stage = previous['stage'] if previous else None
+        if previous_stage is None or STAGES.index(stage) > STAGES.index(previous_stage):
+            return [stage]
+        return []
+
+    def remove(self, order_id: int):
+        if self.orders.pop(order_id, None) is not None:
+            self._counts_dirty = True
+
+    def pop_due(self, now_ts: float) -> List[Tuple[Dict[str, Any], str]]:
+        """取出已到点的阈值；同一订单同时到点多个阶段时只提醒最严重的"""
+        due = {}
+        while self.heap and self.heap[0][0] <= now_ts:
+            _, generation, order_id, stage = heapq.heappop(self.heap)
+            order = self.orders.get(order_id)
+            if order is None or order['generation'] != generation:
+                continue
+            # 只交期日期的订单 today 与 overdue 阈值相同，按严重程度取，不能按出堆顺序覆盖
+            if order['stage'] and STAGES.index(order['stage']) >= STAGES.index(stage):
+                continue
+            order['stage'] = stage
+            due[order_id] = (order, stage)
+            self._counts_dirty = True
+        return list(due.values())
+
+    def next_due_in(self) -> Optional[float]:
+        # 顺便丢弃堆顶的失效元素
+        while self.heap:
+            _, generation, order_id, _ = self.heap[0]
+            order = self.orders.get(order_id)
+            if order is not None and order['generation'] == generation:
+                return max(self.heap[0][0] - time.time(), 0)
+            heapq.heappop(self.heap)
+        return None
+
+    def stage_counts(self) -> Dict[str, Any]:
+        counts = dict.fromkeys(STAGES, 0)
+        for order in self.orders.values():
+            if order['stage']:
+                counts[order['stage']] += 1
+        # 与仪表板「3天内到期」口径一致：包含今天到期和已逾期
+        counts['urgent_total'] = sum(counts[stage] for stage in STAGES)
+        counts['tracked'] = len(self.orders)
+        counts['updated_at'] = time.time()
+        return counts
+
+    # ---------- 数据加载 ----------
+
+    @database_sync_to_async
+    def _load_open_orders(self) -> List[Dict[str, Any]]:
+        return list(PrintOrderFlat.objects.filter(
+            detail_type=None,
+            status__in=OPEN_STATUSES,
+            delivery_date__isnull=False
+        ).values('id', 'order_no', 'product_name', 'customer_name', 'status', 'delivery_date'))
+
+    async def resync(self, initial: bool = False):
+        """与数据库对账：补上漏掉的信号（如批量更新），移除已关闭的订单"""
+        orders = await self._load_open_orders()
+        now = timezone.now()
+        seen = set()
+        for order in orders:
+            seen.add(order['id'])
+            tracked = self.orders.get(order['id'])
+            if tracked and tracked['delivery_date'] == order['delivery_date']:
+                continue
+            stages = self.schedule(order, now, emit_crossing=self.catch_up if initial else True)
+            for stage in stages:
+                await self.emit(self.orders[order['id']], stage)
+        for order_id in [order_id for order_id in self.orders if order_id not in seen]:
+            self.remove(order_id)
+        # 频繁更新会在堆里留下大量失效元素，对账时顺便压缩
+        if len(self.heap) > 4 * len(STAGES) * max(len(self.orders), 1):
+            self.heap = [item for item in self.heap
+                         if item[2] in self.orders and self.orders[item[2]]['generation'] == item[1]]
+            heapq.heapify(self.heap)
+        print(f"🔄 交期调度器对账完成：跟踪 {len(self.orders)} 个订单，堆中 {len(self.heap)} 个阈值")
+
+    async def handle_update(self, message: Dict[str, Any]):
+        order_id = message.get('order_id')
+        if order_id is None:
+            return
+        if message.get('deleted'):
+            self.remove(order_id)
+            return
+        delivery_date = message.get('delivery_date')
+        order = {
+            'id': order_id,
+            'order_no': message.get('order_no'),
+            'product_name': message.get('product_name'),
+            'customer_name': message.get('customer_name'),
+            'status': message.get('status'),
+            'delivery_date': datetime.fromisoformat(delivery_date) if delivery_date else None,
+        }
+        for stage in self.schedule(order, timezone.now()):
+            await self.emit(self.orders[order_id], stage)
+
+    # ---------- 推送 ----------
+
+    async def emit(self, order: Dict[str, Any], stage: str):
+        product_name = order.get('product_name') or '未命名产品'
+        data = {
+            'order_id': order['id'],
+            'order_no': order['order_no'],
+            'product_name': product_name,
+            'customer_name': order.get('customer_name'),
+            'stage': stage,
+            'stage_display': STAGE_TEXT[stage],
+            'delivery_date': order['delivery_date'].isoformat(),
+            'message': f"⏰ 订单 {order['order_no']}（{product_name}）{STAGE_TEXT[stage]}",
+            'timestamp': timezone.now().isoformat(),
+        }
+        try:
+            await self.channel_layer.group_send(ALERT_GROUP, {'type': 'deadline_alert', 'data': data})
+            self.alerts_sent += 1
+            print(f"📢 交期提醒: {data['message']}")
+        except Exception as e:
+            print(f"❌ 交期提醒发送失败: {e}")
+
+    async def publish_counts(self, force: bool = False):
+        """阶段数量变化或超过30秒时写入缓存（同时作为调度器心跳）"""
+        if not force and not self._counts_dirty and time.time() - self._counts_published_at < 30:
+            return
+        try:
+            await database_sync_to_async(cache.set)(STAGE_COUNTS_CACHE_KEY, self.stage_counts(), self.resync_interval * 2)
+            self._counts_published_at = time.time()
+            self._counts_dirty = False
+        except Exception as e:
+            print(f"⚠️ 发布交期统计失败: {e}")
+
+    # ---------- 主循环 ----------
+
+    async def _receive_updates(self):
+        """单独的任务从通道收消息，避免主循环超时取消 receive"""
+        while True:
+            message = await self.channel_layer.receive(SCHEDULER_CHANNEL)
+            await self._updates.put(message)
+
+    async def run(self):
+        if self.channel_layer is None:
+            raise RuntimeError('未配置 CHANNEL_LAYERS，无法运行交期调度器')
+
+        self._updates = asyncio.Queue()
+        receiver = asyncio.ensure_future(self._receive_updates())
+        try:
+            await self.resync(initial=True)
+            await self.publish_counts(force=True)
+            next_resync = time.time() + self.resync_interval
+
+            while True:
+                next_due = self.next_due_in()
+                timeout = min(next_due if next_due is not None else 30, max(next_resync - time.time(), 0), 30)
+                try:
+                    message = await asyncio.wait_for(self._updates.get(), timeout)
+                    await self.handle_update(message)
+                except asyncio.TimeoutError:
+                    pass
+
+                for order, stage in self.pop_due(time.time()):
+                    await self.emit(order, stage)
+
+                if receiver.done():
+                    # 通道异常（如 Redis 断开）时重启接收任务
+                    error = None if receiver.cancelled() else receiver.exception()
+                    print(f"⚠️ 交期调度器接收任务退出，重新启动: {error}")
+                    await asyncio.sleep(1)
+                    receiver = asyncio.ensure_future(self._receive_updates())
+
+                if time.time() >= next_resync:
+                    await self.resync()
+                    next_resync = time.time() + self.resync_interval
+
+                await self.publish_counts()
+        finally:
+            receiver.cancel()
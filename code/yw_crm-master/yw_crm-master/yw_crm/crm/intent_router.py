@@ -0,0 +1,419 @@
+"""
+规则意图路由
+用 Aho–Corasick 关键词自动机对用户问题做一次扫描，识别意图并抽取槽位
+（日期、订单状态、客户、业务员、生产步骤、订单号），直接编译成
+PrintOrderFlat / OrderProgress 查询。车间的常规问题不经过大模型，毫秒级返回；
+需要分析推理或无法完整理解的问题返回 None，交给大模型处理
+"""
+import re
+import time
+import threading
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import PrintOrderFlat, OrderProgress, OrderProgressTemplate
+from .data_version import get_order_data_version
+
+
+HELP_TEXT = "🤖 快速查询指南：\n📊 说「统计」查看概览\n📅 说「今天」查看今日订单\n⚡ 说「处理中」查看进行中订单\n🚨 说「紧急」查看急单\n🏭 说「印刷中的订单」查看某个步骤\n👤 说「张三的订单」「某客户本周的订单」按业务员/客户查询\n💬 说具体问题让AI详细回答"
+
+HELLO_TEXT = "👋 您好！我是订单管理AI助手\n\n💡 快速提示：\n• 「统计」- 查看数据概览\n• 「今天」- 今日订单\n• 「紧急」- 查看急单\n• 直接说订单号查询详情"
+
+
+# 静态词表：(关键词, (槽位类型, 值))
+STATIC_LEXICON = [
+    # 意图
+    (('统计', '概况', '总览', '汇总', '数据', '整体情况'), ('intent', 'stats')),
+    (('多少', '几个', '几单', '数量', '总数', '有几'), ('intent', 'count')),
+    (('帮助', 'help', '功能', '指令', '能做什么', '怎么用'), ('intent', 'help')),
+    (('你好', '您好', 'hi', 'hello', '嗨'), ('intent', 'hello')),
+    (('详情', '详细', '进度', '情况', '信息'), ('intent', 'detail')),
+    (('用料', '材料', '用纸', '纸张'), ('intent', 'materials')),
+    # 需要推理的问题，直接交给大模型
+    (('为什么', '为啥', '怎么办', '如何', '分析', '建议', '原因', '预测', '对比', '比较', '总结', '评估', '优化'), ('defer', True)),
+    # 日期
+    (('今天', '今日', '当天', '本日'), ('date', 'today')),
+    (('昨天', '昨日'), ('date', 'yesterday')),
+    (('明天', '明日'), ('date', 'tomorrow')),
+    (('本周', '这周', '一周', '七天', '这个星期', '本星期'), ('date', 'week')),
+    (('本月', '这月', '这个月', '一个月', '30天'), ('date', 'month')),
+    (('交货', '交期', '交付', '到期', '要交', '送货日期'), ('date_field', 'delivery')),
+    (('下单', '委印', '新增', '新订单', '新建', '接单'), ('date_field', 'order')),
+    # 订单状态
+    (('待处理', '未处理', '没处理', '未开始', '待开始', '等待'), ('status', 1)),
+    (('处理中', '进行中', '正在处理', '生产中', '在做', '正在做', '正在', '中'), ('status', 2)),
+    (('已完成', '完成', '完工', '做完', '完成的'), ('status', 3)),
+    (('已取消', '取消'), ('status', 4)),
+    (('未完成', '没完成', '未完工', '在产'), ('status', 'open')),
+    # 紧急/逾期
+    (('紧急', '急单', '加急', '快到期', '截止'), ('urgent', 'urgent')),
+    (('逾期', '超期', '延期', '过期', '拖期', '延误'), ('urgent', 'overdue')),
+    # 生产步骤的泛称
+    (('步骤', '工序', '环节', '车间', '机台'), ('step_scope', True)),
+    # 语气词、指代词等，不影响查询
+    (('订单', '工单', '单子', '的', '有', '哪些', '那些', '吗', '呢', '吧', '啊', '了', '查', '查询', '查看', '查一下',
+      '看', '看看', '一下', '请', '帮我', '帮忙', '给我', '我', '我们', '现在', '目前', '当前', '列出', '显示', '所有',
+      '全部', '是', '么', '什么', '还', '个', '下', '在', '都', '和', '与', '及', '客户', '业务员', '业务', '跟进', '负责',
+      '哪个', '哪几个', '共', '一共', '总共', '状态'), ('filler', True)),
+]
+
+# 近N天 / 最近N天 / 过去N天 / N天内
+DAYS_PATTERN = re.compile(r'(?:近|最近|过去|前)(\d{1,3})天|(\d{1,3})天[内以之]内?')
+# 订单号：字母前缀 + 至少3位数字；紧跟年/月/日/天/个/件等量词的数字不算
+ORDER_NO_PATTERN = re.compile(r'(?<![A-Za-z0-9])[A-Za-z]{0,6}\d{3,}[A-Za-z0-9-]*(?![A-Za-z0-9年月日号天个件张本])')
+# 统计未覆盖字符时忽略的标点和空白
+IGNORED_CHARS = set(' \t\r\n，。！？、,.!?;；:：“”"\'（）()【】[]「」~～…')
+# 客户名称去掉这些后缀后作为简称
+CUSTOMER_SUFFIXES = ('股份有限公司', '有限责任公司', '有限公司', '集团', '公司', '印刷厂', '印务', '出版社')
+
+STATUS_TEXT = {1: '待处理', 2: '处理中', 3: '已完成', 4: '已取消', 'open': '未完成'}
+DATE_TEXT = {'today': '今天', 'yesterday': '昨天', 'tomorrow': '明天', 'week': '一周', 'month': '30天'}
+
+
+class KeywordAutomaton:
+    """Aho–Corasick 多模式匹配自动机，构建后一次扫描找出所有关键词"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, Any]]] = [[]]
+        self._keywords: Dict[str, Any] = {}
+
+    def add(self, keyword: str, payload: Any):
+        """添加关键词；同一关键词只保留最先添加的载荷（静态词表优先于数据词表）"""
+        if not keyword or keyword in self._keywords:
+            return
+        self._keywords[keyword] = payload
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[node][char] = next_node
+            node = next_node
+        self._output[node].append((len(keyword), payload))
+
+    def build(self):
+        """按广度优先计算失败指针，并合并输出"""
+        queue = list(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        index = 0
+        while index < len(queue):
+            node = queue[index]
+            index += 1
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+        return self
+
+    def __len__(self):
+        return len(self._keywords)
+
+    def find_all(self, text: str) -> List[Tuple[int, int, Any]]:
+        """返回所有匹配 (start, end, payload)"""
+        hits = []
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, payload in self._output[node]:
+                hits.append((position + 1 - length, position + 1, payload))
+        return hits
+
+    def find(self, text: str) -> List[Tuple[int, int, Any]]:
+        """最左最长且互不重叠的匹配"""
+        hits = sorted(self.find_all(text), key=lambda hit: (hit[0], hit[0] - hit[1]))
+        selected = []
+        last_end = 0
+        for start, end, payload in hits:
+            if start >= last_end:
+                selected.append((start, end, payload))
+                last_end = end
+        return selected
+
+
+class RoutedIntent:
+    """一次路由的结果：意图 + 槽位"""
+
+    __slots__ = ('intent', 'slots', 'residual')
+
+    def __init__(self, intent: str, slots: Dict[str, Any], residual: int = 0):
+        self.intent = intent
+        self.slots = slots
+        self.residual = residual
+
+    def __repr__(self):
+        return f"RoutedIntent({self.intent}, {self.slots})"
+
+
+class IntentRouter:
+    """意图路由：识别 -> 编译查询 -> 执行格式化"""
+
+    def __init__(self, order_tool, max_residual: int = None, lexicon_ttl: int = None):
+        self.order_tool = order_tool
+        self.max_residual = max_residual if max_residual is not None else getattr(settings, 'AI_INTENT_MAX_RESIDUAL', 1)
+        self.lexicon_ttl = lexicon_ttl if lexicon_ttl is not None else getattr(settings, 'AI_INTENT_LEXICON_TTL', 300)
+        self._automaton: Optional[KeywordAutomaton] = None
+        self._built_at = 0.0
+        self._built_version = None
+        self._build_lock = threading.Lock()
+
+    # ---------- 词表 ----------
+
+    def _load_dynamic_terms(self) -> List[Tuple[str, Tuple[str, Any]]]:
+        """从数据库加载步骤名、客户名、业务员（只取去重后的名称列）"""
+        terms = []
+        step_names = set(OrderProgressTemplate.objects.values_list('step_name', flat=True))
+        step_names.update(OrderProgress.objects.values_list('step_name', flat=True).distinct())
+        for name in step_names:
+            if not name:
+                continue
+            terms.append((name.lower(), ('step', name)))
+            # 「配本(塑封)」同时支持「配本」「塑封」
+            for alias in re.split(r'[()（）]', name):
+                if alias and alias != name and len(alias) >= 2:
+                    terms.append((alias.lower(), ('step', alias)))
+
+        main_orders = PrintOrderFlat.objects.filter(detail_type=None)
+        for name in main_orders.exclude(customer_name__isnull=True).values_list('customer_name', flat=True).distinct():
+            name = name.strip()
+            if len(name) < 2:
+                continue
+            terms.append((name.lower(), ('customer', name)))
+            short_name = name
+            for suffix in CUSTOMER_SUFFIXES:
+                if short_name.endswith(suffix):
+                    short_name = short_name[:-len(suffix)]
+            if len(short_name) >= 2 and short_name != name:
+                terms.append((short_name.lower(), ('customer', short_name)))
+
+        for name in main_orders.exclude(salesman__isnull=True).values_list('salesman', flat=True).distinct():
+            name = name.strip()
+            if len(name) >= 2:
+                terms.append((name.lower(), ('salesman', name)))
+        return terms
+
+    def _build_automaton(self) -> KeywordAutomaton:
+        automaton = KeywordAutomaton()
+        for keywords, payload in STATIC_LEXICON:
+            for keyword in keywords:
+                automaton.add(keyword.lower(), payload)
+        try:
+            for keyword, payload in self._load_dynamic_terms():
+                automaton.add(keyword, payload)
+        except Exception as e:
+            print(f"⚠️ 意图路由加载数据词表失败，仅使用静态词表: {e}")
+        return automaton.build()
+
+    def get_automaton(self) -> KeywordAutomaton:
+        """词表按 TTL 刷新；TTL 到期且订单数据有变化时才重建"""
+        now = time.time()
+        if self._automaton is not None and now - self._built_at < self.lexicon_ttl:
+            return self._automaton
+        with self._build_lock:
+            if self._automaton is not None and now - self._built_at < self.lexicon_ttl:
+                return self._automaton
+            version = get_order_data_version()
+            if self._automaton is None or version != self._built_version:
+                self._automaton = self._build_automaton()
+                self._built_version = version
+            self._built_at = now
+            return self._automaton
+
+    def refresh(self):
+        """强制下次使用时重建词表"""
+        self._built_at = 0.0
+        self._built_version = None
+
+    # ---------- 识别 ----------
+
+    def route(self, message: str, strict: bool = True) -> Optional[RoutedIntent]:
+        """
+        识别意图和槽位
+        strict 为 True 时，存在推理类词语或未识别的字符超过 max_residual 就返回 None；
+        降级场景（大模型不可用）使用 strict=False，尽量给出最接近的查询结果
+        """
+        text = message.strip().lower()
+        if not text:
+            return None
+
+        covered = [False] * len(text)
+        slots: Dict[str, Any] = {}
+        intents = set()
+
+        def cover(start, end):
+            for index in range(start, end):
+                covered[index] = True
+
+        for match in DAYS_PATTERN.finditer(text):
+            slots['days'] = int(match.group(1) or match.group(2))
+            cover(match.start(), match.end())
+
+        order_match = ORDER_NO_PATTERN.search(text)
+        if order_match and not covered[order_match.start()]:
+            # 订单号按原始大小写取出
+            slots['order_no'] = message.strip()[order_match.start():order_match.end()]
+            cover(order_match.start(), order_match.end())
+
+        for start, end, (slot, value) in self.get_automaton().find(text):
+            if any(covered[start:end]):
+                continue
+            cover(start, end)
+            if slot == 'intent':
+                intents.add(value)
+            elif slot in ('filler', 'step_scope'):
+                if slot == 'step_scope':
+                    slots['step_scope'] = True
+            else:
+                slots.setdefault(slot, value)
+
+        residual = sum(1 for index, char in enumerate(text) if not covered[index] and char not in IGNORED_CHARS)
+        if strict and (slots.get('defer') or residual > self.max_residual):
+            return None
+        slots.pop('defer', None)
+
+        intent = self._resolve_intent(intents, slots)
+        if intent is None:
+            return None
+        return RoutedIntent(intent, slots, residual)
+
+    @staticmethod
+    def _resolve_intent(intents, slots) -> Optional[str]:
+        if 'order_no' in slots:
+            return 'materials' if 'materials' in intents else 'order_detail'
+        if 'step' in slots or slots.get('step_scope'):
+            return 'steps'
+        if any(key in slots for key in ('date', 'days', 'status', 'customer', 'salesman', 'urgent')):
+            return 'orders'
+        if slots.get('date_field') == 'delivery':
+            # 只问「交期」时按紧急订单处理
+            slots['urgent'] = 'urgent'
+            return 'orders'
+        if slots.get('date_field') == 'order':
+            # 只问「新增/新订单」时看今天的订单
+            slots['date'] = 'today'
+            return 'orders'
+        for intent in ('stats', 'count', 'help', 'hello'):
+            if intent in intents:
+                return 'stats' if intent == 'count' else intent
+        return None
+
+    # ---------- 编译查询 ----------
+
+    def _date_bounds(self, slots) -> Optional[Tuple[Any, Any]]:
+        """把日期槽位换算为闭区间；交货日期的「本周/近N天」向后看"""
+        today = timezone.localdate()
+        forward = slots.get('date_field') == 'delivery'
+        days = slots.get('days') or {'week': 7, 'month': 30}.get(slots.get('date'))
+        if days:
+            return (today, today + timedelta(days=days)) if forward else (today - timedelta(days=days), today)
+        offset = {'today': 0, 'yesterday': -1, 'tomorrow': 1}.get(slots.get('date'))
+        if offset is None:
+            return None
+        day = today + timedelta(days=offset)
+        return day, day
+
+    def compile_order_filters(self, slots, prefix: str = '') -> Dict[str, Any]:
+        """槽位 -> PrintOrderFlat 过滤条件（prefix 用于从 OrderProgress 关联过滤）"""
+        filters: Dict[str, Any] = {f'{prefix}detail_type': None}
+        bounds = self._date_bounds(slots)
+        if bounds:
+            field = 'delivery_date' if slots.get('date_field') == 'delivery' else 'order_date'
+            filters[f'{prefix}{field}__date__gte'] = bounds[0]
+            filters[f'{prefix}{field}__date__lte'] = bounds[1]
+        if 'customer' in slots:
+            filters[f'{prefix}customer_name__icontains'] = slots['customer']
+        if 'salesman' in slots:
+            filters[f'{prefix}salesman'] = slots['salesman']
+
+        urgent = slots.get('urgent')
+        if urgent:
+            filters[f'{prefix}delivery_date__isnull'] = False
+            filters[f'{prefix}status__in'] = [1, 2]
+            if urgent == 'overdue':
+                filters[f'{prefix}delivery_date__lt'] = timezone.now()
+            else:
+                filters[f'{prefix}delivery_date__lte'] = timezone.now() + timedelta(days=3)
+        elif prefix == '':
+            status = slots.get('status')
+            if status == 'open':
+                filters['status__in'] = [1, 2]
+            elif status:
+                filters['status'] = status
+        return filters
+
+    def compile(self, routed: RoutedIntent):
+        """编译为查询集：orders -> PrintOrderFlat，steps -> OrderProgress"""
+        slots = routed.slots
+        if routed.intent == 'orders':
+            return PrintOrderFlat.objects.filter(**self.compile_order_filters(slots))
+        if routed.intent == 'steps':
+            # 步骤查询中的状态词表示步骤状态，默认看进行中的
+            status = slots.get('status')
+            step_status = status if status in (1, 2, 3) else 2
+            queryset = OrderProgress.objects.filter(status=step_status, **self.compile_order_filters(slots, prefix='order__'))
+            if 'step' in slots:
+                queryset = queryset.filter(step_name__icontains=slots['step'])
+            return queryset
+        return None
+
+    @staticmethod
+    def describe(slots) -> str:
+        """把槽位转成可读的搜索条件"""
+        parts = []
+        if 'days' in slots or 'date' in slots:
+            field = '交货日期' if slots.get('date_field') == 'delivery' else '委印日期'
+            period = f"{slots['days']}天内" if 'days' in slots else DATE_TEXT.get(slots['date'], slots['date'])
+            parts.append(f"{field}：{period}")
+        if 'status' in slots and not slots.get('urgent'):
+            parts.append(f"状态：{STATUS_TEXT.get(slots['status'], slots['status'])}")
+        if 'customer' in slots:
+            parts.append(f"客户：{slots['customer']}")
+        if 'salesman' in slots:
+            parts.append(f"业务员：{slots['salesman']}")
+        if slots.get('urgent'):
+            parts.append('逾期未完成' if slots['urgent'] == 'overdue' else '3天内到交期')
+        return '，'.join(parts) or '全部订单'
+
+    # ---------- 执行 ----------
+
+    def execute(self, routed: RoutedIntent) -> str:
+        slots = routed.slots
+        if routed.intent == 'order_detail':
+            return self.order_tool.get_order_details(slots['order_no'])
+        if routed.intent == 'materials':
+            return self.order_tool.get_order_materials(slots['order_no'])
+        if routed.intent == 'stats':
+            return self.order_tool.get_statistics()
+        if routed.intent == 'help':
+            return HELP_TEXT
+        if routed.intent == 'hello':
+            return HELLO_TEXT
+        if routed.intent == 'steps':
+            status = slots.get('status')
+            step_status = status if status in (1, 2, 3) else 2
+            condition = self.describe(slots)
+            title = f"「{slots['step']}」" if 'step' in slots else "所有步骤"
+            if condition != '全部订单':
+                title = f"{title}（{condition}）"
+            return self.order_tool.format_steps(self.compile(routed), title, step_status)
+        return self.order_tool.format_orders(self.compile(routed), self.describe(slots))
+
+    def answer(self, message: str, strict: bool = True) -> Optional[str]:
+        """能直接回答时返回结果文本，否则返回 None"""
+        routed = self.route(message, strict=strict)
+        if routed is None:
+            return None
+        return self.execute(routed)
@@ -0,0 +1,373 @@
+"""
+大模型调用网关
+所有对大模型的调用都经过这里：全局并发上限 + 有界等待队列、按用户限流、
+排队耗时统计，以及连续失败后的熔断（熔断期间直接拒绝，由调用方降级）；
+调用耗时、token用量、失败/拒绝次数和排队长度同时输出到 /metrics
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+
+class LLMGatewayError(Exception):
+    """网关拒绝调用的基类，调用方据此降级到快速查询"""
+    reason = 'AI服务暂时不可用'
+
+
+class LLMBusyError(LLMGatewayError):
+    """并发已满且等待队列已满/等待超时"""
+    reason = 'AI助手当前繁忙'
+
+
+class LLMRateLimitError(LLMGatewayError):
+    """单个用户请求过于频繁"""
+    reason = '提问过于频繁，请稍后再试'
+
+
+class LLMCircuitOpenError(LLMGatewayError):
+    """连续失败，熔断中"""
+    reason = 'AI服务暂时不可用'
+
+
+def _set_waiter_done(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断，冷却后放行一次试探调用"""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' or (state == 'half_open' and self.trial_running):
+                raise LLMCircuitOpenError()
+            if state == 'half_open':
+                self.trial_running = True
+
+    def release_trial(self):
+        """试探调用没有真正发出（被限流/排队拒绝）时归还试探机会"""
+        with self._lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class LLMGateway:
+    """大模型调用网关（同步/异步调用共用同一组并发槽位）"""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.max_concurrency = getattr(settings, 'LLM_MAX_CONCURRENCY', 4)
+        self.max_queue = getattr(settings, 'LLM_MAX_QUEUE', 16)
+        self.queue_timeout = getattr(settings, 'LLM_QUEUE_TIMEOUT', 10)
+        self.user_rate_per_minute = getattr(settings, 'LLM_USER_RATE_PER_MINUTE', 30)
+        self.breaker = CircuitBreaker(
+            getattr(settings, 'LLM_BREAKER_FAILURES', 5),
+            getattr(settings, 'LLM_BREAKER_COOLDOWN', 30)
+        )
+
+        self._lock = threading.Lock()
+        self._slot_released = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._waiting = 0
+        self._user_calls: Dict[Any, deque] = {}
+        # 异步等待者：(事件循环, future)，释放槽位时唤醒一个，不必轮询
+        self._async_waiters: deque = deque()
+
+        # 统计
+        self._queue_waits = deque(maxlen=500)
+        self.total_calls = 0
+        self.failed_calls = 0
+        self.rejected = {'busy': 0, 'rate_limited': 0, 'circuit_open': 0}
+
+    @property
+    def available(self) -> bool:
+        return self.llm is not None
+
+    # ---------- 限流 ----------
+
+    def _check_rate_limit(self, user_id) -> Optional[float]:
+        """
+        滑动窗口：每个用户每分钟最多 user_rate_per_minute 次
+        通过时先占用一次额度并返回其时间戳，之后被熔断/排队拒绝的调用由 _refund 归还
+        """
+        if not self.user_rate_per_minute:
+            return None
+        now = time.time()
+        with self._lock:
+            calls = self._user_calls.setdefault(user_id, deque())
+            while calls and now - calls[0] > 60:
+                calls.popleft()
+            if len(calls) >= self.user_rate_per_minute:
+                self._reject('rate_limited')
+                raise LLMRateLimitError()
+            calls.append(now)
+            # 清理长时间不活跃的用户
+            if len(self._user_calls) > 1000:
+                for key in [key for key, value in self._user_calls.items() if not value or now - value[-1] > 60]:
+                    del self._user_calls[key]
+            return now
+
+    def _refund(self, user_id, stamp: Optional[float]):
+        """调用没有真正发出时归还占用的限流额度"""
+        if stamp is None:
+            return
+        with self._lock:
+            calls = self._user_calls.get(user_id)
+            if calls is not None:
+                try:
+                    calls.remove(stamp)
+                except ValueError:
+                    pass
+
+    def _admit(self, user_id) -> Optional[float]:
+        """调用前的检查：限流 -> 熔断，返回占用的限流额度"""
+        stamp = self._check_rate_limit(user_id)
+        try:
+            self.breaker.before_call()
+        except LLMCircuitOpenError:
+            with self._lock:
+                self._reject('circuit_open')
+            self._refund(user_id, stamp)
+            raise
+        return stamp
+
+    def _rejected_in_queue(self, user_id, stamp: Optional[float]):
+        """排队被拒绝：归还试探机会和限流额度"""
+        self.breaker.release_trial()
+        self._refund(user_id, stamp)
+
+    def _reject(self, reason):
+        """调用方持锁"""
+        self.rejected[reason] += 1
+        metrics.LLM_ERRORS.labels(reason).inc()
+
+    # ---------- 并发槽位 ----------
+
+    def _try_acquire(self) -> bool:
+        """调用方持锁"""
+        if self._in_flight < self.max_concurrency:
+            self._in_flight += 1
+            metrics.LLM_IN_FLIGHT.set(self._in_flight)
+            return True
+        return False
+
+    def _enter_queue(self):
+        """调用方持锁；队列已满时直接拒绝（背压）"""
+        if self._waiting >= self.max_queue:
+            self._reject('busy')
+            raise LLMBusyError()
+        self._waiting += 1
+        metrics.LLM_QUEUE_DEPTH.set(self._waiting)
+
+    def _acquire(self) -> float:
+        """同步获取槽位，返回排队耗时"""
+        start = time.time()
+        with self._lock:
+            if not self._try_acquire():
+                self._enter_queue()
+                try:
+                    deadline = start + self.queue_timeout
+                    while not self._try_acquire():
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._reject('busy')
+                            raise LLMBusyError()
+                        self._slot_released.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                    metrics.LLM_QUEUE_DEPTH.set(self._waiting)
+            waited = time.time() - start
+            self._queue_waits.append(waited)
+            self.total_calls += 1
+            return waited
+
+    async def _aacquire(self) -> float:
+        """异步获取槽位：在事件循环上等待释放通知，不占用线程"""
+        start = time.time()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            acquired = self._try_acquire()
+            if not acquired:
+                self._enter_queue()
+        if not acquired:
+            try:
+                deadline = start + self.queue_timeout
+                while True:
+                    with self._lock:
+                        if self._try_acquire():
+                            acquired = True
+                            break
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._reject('busy')
+                            raise LLMBusyError()
+                        waiter = loop.create_future()
+                        self._async_waiters.append((loop, waiter))
+                    try:
+                        await asyncio.wait_for(waiter, remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    metrics.LLM_QUEUE_DEPTH.set(self._waiting)
+                    # 被唤醒却超时/取消而放弃时，把通知转给下一个等待者
+                    if not acquired and self._in_flight < self.max_concurrency:
+                        self._wake_async_waiter()
+        with self._lock:
+            waited = time.time() - start
+            self._queue_waits.append(waited)
+            self.total_calls += 1
+        return waited
+
+    def _release(self, success: bool, mode: str, started: float):
+        metrics.LLM_REQUEST_SECONDS.labels(mode).observe(time.perf_counter() - started)
+        with self._lock:
+            self._in_flight -= 1
+            metrics.LLM_IN_FLIGHT.set(self._in_flight)
+            if not success:
+                self.failed_calls += 1
+                metrics.LLM_ERRORS.labels('upstream').inc()
+            # 同步等待者和异步等待者各唤醒一个，没抢到槽位的继续等待
+            self._slot_released.notify()
+            self._wake_async_waiter()
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _wake_async_waiter(self):
+        """调用方持锁；跳过已超时/取消的等待者"""
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if waiter.done() or loop.is_closed():
+                continue
+            loop.call_soon_threadsafe(_set_waiter_done, waiter)
+            return
+
+    @contextmanager
+    def _slot(self, user_id, mode):
+        stamp = self._admit(user_id)
+        try:
+            self._acquire()
+        except LLMBusyError:
+            self._rejected_in_queue(user_id, stamp)
+            raise
+        # 只有上游异常才计入失败；客户端断开（GeneratorExit/取消）不算
+        success = True
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            success = False
+            raise
+        finally:
+            self._release(success, mode, started)
+
+    # ---------- 调用入口 ----------
+
+    # llm 参数用于传入绑定了工具的模型等变体，默认使用网关自身的模型
+
+    def invoke(self, messages, user_id: Optional[int] = None, llm=None):
+        with self._slot(user_id, 'invoke'):
+            result = (llm or self.llm).invoke(messages)
+        metrics.record_llm_usage(result)
+        return result
+
+    def stream(self, messages, user_id: Optional[int] = None, llm=None):
+        with self._slot(user_id, 'stream'):
+            for chunk in (llm or self.llm).stream(messages):
+                metrics.record_llm_usage(chunk)
+                yield chunk
+
+    async def ainvoke(self, messages, user_id: Optional[int] = None, llm=None):
+        stamp = self._admit(user_id)
+        try:
+            await self._aacquire()
+        except LLMBusyError:
+            self._rejected_in_queue(user_id, stamp)
+            raise
+        success = True
+        started = time.perf_counter()
+        try:
+            result = await (llm or self.llm).ainvoke(messages)
+        except Exception:
+            success = False
+            raise
+        finally:
+            self._release(success, 'ainvoke', started)
+        metrics.record_llm_usage(result)
+        return result
+
+    async def astream(self, messages, user_id: Optional[int] = None, llm=None):
+        stamp = self._admit(user_id)
+        try:
+            await self._aacquire()
+        except LLMBusyError:
+            self._rejected_in_queue(user_id, stamp)
+            raise
+        success = True
+        started = time.perf_counter()
+        try:
+            async for chunk in (llm or self.llm).astream(messages):
+                metrics.record_llm_usage(chunk)
+                yield chunk
+        except Exception:
+            success = False
+            raise
+        finally:
+            self._release(success, 'astream', started)
+
+    def stats(self) -> Dict[str, Any]:
+        """网关运行状态（并发、排队、拒绝次数、熔断状态）"""
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            return {
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'total_calls': self.total_calls,
+                'failed_calls': self.failed_calls,
+                'rejected': dict(self.rejected),
+                'queue_wait_avg': round(sum(waits) / len(waits), 4) if waits else 0,
+                'queue_wait_p95': round(waits[int(len(waits) * 0.95) - 1], 4) if waits else 0,
+                'queue_wait_max': round(waits[-1], 4) if waits else 0,
+                'circuit': self.breaker.state,
+            }
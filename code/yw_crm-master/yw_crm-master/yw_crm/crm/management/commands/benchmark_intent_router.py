@@ -0,0 +1,90 @@
+"""
+意图路由基准测试：统计问题语料的命中率和路由耗时
+运行方式：python manage.py benchmark_intent_router --repeat 200
+         python manage.py benchmark_intent_router --corpus questions.txt --execute --verbose
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm.intent_router import IntentRouter
+
+
+# 默认语料：车间和业务日常的提问，以及少量应该交给大模型的问题
+DEFAULT_CORPUS = [
+    '统计', '今天', '紧急', '帮助', '你好', '处理中', '待处理', '已完成', '交期',
+    '今天有哪些订单', '今天新增了几个订单', '昨天的订单', '本周的订单有哪些', '这个月的订单',
+    '最近10天的订单', '近3天下单的订单', '有多少订单', '订单总数是多少', '现在有几个订单在处理中',
+    '未完成的订单', '还有哪些订单没完成', '已取消的订单', '紧急订单有几个', '有哪些急单',
+    '逾期的订单', '超期未完成的单子', '明天要交货的订单', '本周交货的订单', '7天内到期的订单',
+    '印刷中的订单', '现在在印刷的有哪些', '覆膜工序进行中的订单', '待开始的装订步骤', '打包完成的订单',
+    '哪些订单在送货', '切纸环节正在做的单子', 'CTP步骤有哪些在做',
+    'A20240101001', '查一下订单123456的详情', '订单ABC1234的进度', '订单ABC1234的用料',
+    '为什么最近订单变少了', '帮我分析一下本月的生产效率', '下周的排产应该怎么安排',
+    '哪个客户的订单最多', '给客户写一封催款邮件', '印刷机坏了怎么办', '今天和昨天相比怎么样',
+]
+
+
+class Command(BaseCommand):
+    help = '意图路由基准测试：命中率与耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='问题语料文件（每行一个问题），默认使用内置语料')
+        parser.add_argument('--repeat', type=int, default=100, help='每个问题重复路由的次数')
+        parser.add_argument('--execute', action='store_true', help='同时执行编译出的查询，统计端到端耗时')
+        parser.add_argument('--verbose', action='store_true', help='逐条输出路由结果')
+
+    def handle(self, *args, **options):
+        if options['corpus']:
+            with open(options['corpus'], encoding='utf-8') as f:
+                corpus = [line.strip() for line in f if line.strip()]
+        else:
+            corpus = DEFAULT_CORPUS
+
+        order_tool = None
+        if options['execute']:
+            from crm.conversation_ai import OrderQueryTool
+            order_tool = OrderQueryTool()
+        router = IntentRouter(order_tool)
+
+        build_start = time.perf_counter()
+        automaton = router.get_automaton()
+        build_ms = (time.perf_counter() - build_start) * 1000
+        self.stdout.write(f"词表构建：{len(automaton)} 个关键词，耗时 {build_ms:.1f}ms")
+
+        repeat = max(options['repeat'], 1)
+        route_times = []
+        execute_times = []
+        intents = {}
+        hits = 0
+        for question in corpus:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                routed = router.route(question)
+            route_times.append((time.perf_counter() - start) * 1000 / repeat)
+
+            intent = routed.intent if routed else 'llm'
+            intents[intent] = intents.get(intent, 0) + 1
+            if routed:
+                hits += 1
+                if options['execute']:
+                    start = time.perf_counter()
+                    router.execute(routed)
+                    execute_times.append((time.perf_counter() - start) * 1000)
+
+            if options['verbose']:
+                self.stdout.write(f"  {question[:30]:<30} -> {intent} {routed.slots if routed else ''}")
+
+        self.stdout.write(f"\n语料：{len(corpus)} 条，规则命中 {hits} 条，命中率 {hits / len(corpus):.1%}")
+        self.stdout.write('意图分布：' + '，'.join(f"{key} {value}" for key, value in sorted(intents.items(), key=lambda item: -item[1])))
+        self._report('路由耗时', route_times)
+        if execute_times:
+            self._report('查询执行耗时', execute_times)
+
+    def _report(self, title, samples):
+        samples = sorted(samples)
+        p50 = samples[len(samples) // 2]
+        p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+        self.stdout.write(
+            f"{title}：平均 {sum(samples) / len(samples):.3f}ms，p50 {p50:.3f}ms，p95 {p95:.3f}ms，最大 {samples[-1]:.3f}ms"
+        )
@@ -0,0 +1,72 @@
+"""
+XSS过滤基准测试：对比正则过滤与原来的 BeautifulSoup 过滤的耗时和结果
+运行方式：python manage.py benchmark_xss_filter --repeat 200
+         python manage.py benchmark_xss_filter --page templates/print_order_list.html
+"""
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from crm.middleware.crm_middleware import XSSFilter
+
+
+# 注入的脚本：一个应被删除，一个正常脚本应保留
+INJECTED = (
+    '<script type="text/javascript">alert("xss")</script>'
+    '<SCRIPT>console.log("ok")</SCRIPT>'
+)
+
+
+def beautifulsoup_filter(content):
+    """原来的实现：整页解析后删除含 alert 的 script"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, "html.parser")
+    for tag in soup.find_all():
+        if tag.name == 'script' and 'alert' in tag.get_text():
+            tag.decompose()
+    return soup.decode()
+
+
+class Command(BaseCommand):
+    help = 'XSS过滤基准测试：正则过滤 vs BeautifulSoup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', help='用于测试的HTML文件，默认 templates/layout.html')
+        parser.add_argument('--repeat', type=int, default=100, help='每种实现重复过滤的次数')
+
+    def handle(self, *args, **options):
+        path = options['page'] or os.path.join(settings.BASE_DIR, 'templates', 'layout.html')
+        with open(path, encoding='utf-8') as f:
+            page = f.read()
+        repeat = max(options['repeat'], 1)
+        xss_filter = XSSFilter()
+
+        cases = [
+            ('无脚本页面', '<html><body>' + '<p>订单列表</p>' * 2000 + '</body></html>'),
+            ('原始页面', page),
+            ('注入脚本', page.replace('</body>', INJECTED + '</body>') if '</body>' in page else page + INJECTED),
+        ]
+        for name, content in cases:
+            data = content.encode('utf-8')
+            self.stdout.write(f"\n{name}（{len(data) / 1024:.1f}KB）")
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                filtered = xss_filter.process_bytes(data)
+            regex_ms = (time.perf_counter() - start) * 1000 / repeat
+            removed = data.count(b'alert') - filtered.count(b'alert')
+            self.stdout.write(f"  正则过滤：{regex_ms:.3f}ms/次，删除含alert片段 {removed} 处")
+
+            try:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    legacy = beautifulsoup_filter(content)
+                legacy_ms = (time.perf_counter() - start) * 1000 / repeat
+            except ImportError:
+                self.stdout.write("  BeautifulSoup：未安装 bs4，跳过对比")
+                continue
+            removed = content.count('alert') - legacy.count('alert')
+            self.stdout.write(f"  BeautifulSoup：{legacy_ms:.3f}ms/次，删除含alert片段 {removed} 处")
+            self.stdout.write(self.style.SUCCESS(f"  加速 {legacy_ms / max(regex_ms, 1e-6):.0f} 倍"))
@@ -0,0 +1,30 @@
+"""
+清空 Prometheus 多进程模式的共享目录
+各进程的指标文件在服务重启后不会自动删除（计数会累加到新进程上，被强制结束的进程的连接数等仪表也不会清零），
+需在启动所有 ASGI 进程之前运行一次
+运行方式：python manage.py clear_metrics_dir
+"""
+import os
+import glob
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = '清空 Prometheus 多进程指标目录（在启动服务之前运行）'
+
+    def handle(self, *args, **options):
+        metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or getattr(settings, 'PROMETHEUS_MULTIPROC_DIR', None)
+        if not metrics_dir or not os.path.isdir(metrics_dir):
+            self.stdout.write('未配置或不存在多进程指标目录，无需清理')
+            return
+
+        removed = 0
+        for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                self.stderr.write(f'⚠️ 删除 {path} 失败: {e}')
+        self.stdout.write(self.style.SUCCESS(f'✅ 已清空 {metrics_dir}，删除 {removed} 个指标文件'))
@@ -0,0 +1,125 @@
+"""
+本地 OpenAI 兼容的大模型桩服务（用于测试和压测，不消耗真实额度）
+运行方式：python manage.py llm_stub_server --port 8765 --latency 0.5 --token-delay 0.02
+然后在 settings.py 中设置 DEEPSEEK_BASE_URL = 'http://127.0.0.1:8765/v1'
+"""
+import json
+import time
+import random
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+STUB_ANSWER = "📊 这是本地桩服务的回复。当前订单运行平稳，暂无需要特别关注的紧急订单。如需真实数据，请切换回正式的大模型服务。"
+
+
+def make_handler(latency, token_delay, fail_rate):
+    """根据命令行参数生成请求处理类"""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json(200, {'object': 'list', 'data': [{'id': 'stub-chat', 'object': 'model'}]})
+            else:
+                self._send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            time.sleep(latency)
+            if fail_rate and random.random() < fail_rate:
+                self._send_json(500, {'error': {'message': 'stub failure', 'type': 'server_error'}})
+                return
+
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            model = request.get('model', 'stub-chat')
+            created = int(time.time())
+
+            if not request.get('stream'):
+                self._send_json(200, {
+                    'id': completion_id,
+                    'object': 'chat.completion',
+                    'created': created,
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': STUB_ANSWER},
+                        'finish_reason': 'stop'
+                    }],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': len(STUB_ANSWER), 'total_tokens': len(STUB_ANSWER)}
+                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            def send_chunk(delta, finish_reason=None):
+                chunk = {
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': created,
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            send_chunk({'role': 'assistant', 'content': ''})
+            for i in range(0, len(STUB_ANSWER), 4):
+                send_chunk({'content': STUB_ANSWER[i:i + 4]})
+                time.sleep(token_delay)
+            send_chunk({}, 'stop')
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    help = '启动本地 OpenAI 兼容的大模型桩服务'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+        parser.add_argument('--port', type=int, default=8765, help='监听端口')
+        parser.add_argument('--latency', type=float, default=0.5, help='首个token前的延迟（秒）')
+        parser.add_argument('--token-delay', type=float, default=0.02, help='每个流式分块之间的延迟（秒）')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='随机返回500错误的比例（0~1），用于验证熔断')
+
+    def handle(self, *args, **options):
+        handler = make_handler(options['latency'], options['token_delay'], options['fail_rate'])
+        server = ThreadingHTTPServer((options['host'], options['port']), handler)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"🤖 大模型桩服务已启动：http://{options['host']}:{options['port']}/v1")
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(self.style.WARNING('桩服务已停止'))
@@ -0,0 +1,45 @@
+"""
+用当前向量化器重新计算对话记忆的嵌入向量
+运行方式：python manage.py reembed_conversations
+（更换向量化器或修改 CONVERSATION_EMBEDDING_DIM 后执行一次，然后重启服务进程）
+"""
+from django.core.management.base import BaseCommand
+from crm.conversation_memory import ConversationMemory
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '重新计算对话记忆的嵌入向量'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='每批处理的对话条数',
+        )
+        parser.add_argument(
+            '--db-path',
+            default=None,
+            help='对话记忆数据库路径，默认使用 crm/conversation_memory.db',
+        )
+
+    def handle(self, *args, **options):
+        memory = ConversationMemory(db_path=options.get('db_path'))
+        self.stdout.write(
+            self.style.SUCCESS(f'开始重新嵌入对话记忆（维度 {memory.embedding_model.dimension}）...')
+        )
+
+        try:
+            total = memory.reembed_conversations(batch_size=options['batch_size'])
+            self.stdout.write(
+                self.style.SUCCESS(f'✅ 已重新嵌入 {total} 条对话')
+            )
+            logger.info(f"对话记忆重新嵌入完成: {total} 条")
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'❌ 重新嵌入失败：{str(e)}')
+            )
+            logger.error(f"对话记忆重新嵌入异常: {str(e)}")
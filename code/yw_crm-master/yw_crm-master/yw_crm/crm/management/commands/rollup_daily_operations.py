@@ -0,0 +1,40 @@
+"""
+重算每日运营汇总并刷新当天的状态快照
+日常由步骤/订单信号增量更新，本命令用于首次初始化、批量导入（不触发信号）后的校正，
+以及定时刷新快照（建议每小时运行一次）
+运行方式：python manage.py rollup_daily_operations --days 2
+         python manage.py rollup_daily_operations --start 2025-01-01 --end 2025-06-30
+"""
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from crm import daily_rollup
+
+
+class Command(BaseCommand):
+    help = '重算每日运营汇总表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2, help='重算最近几天（含今天），默认2天')
+        parser.add_argument('--start', help='开始日期 YYYY-MM-DD（与 --end 一起使用时忽略 --days）')
+        parser.add_argument('--end', help='结束日期 YYYY-MM-DD，默认今天')
+        parser.add_argument('--snapshot-only', action='store_true', help='只刷新今天的状态快照')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if not options['snapshot_only']:
+            try:
+                end = date.fromisoformat(options['end']) if options['end'] else today
+                start = date.fromisoformat(options['start']) if options['start'] else end - timedelta(days=max(options['days'], 1) - 1)
+            except ValueError as e:
+                raise CommandError(f'日期格式错误：{e}')
+            if start > end:
+                raise CommandError('开始日期不能晚于结束日期')
+
+            rows = daily_rollup.rebuild_days(start, end)
+            self.stdout.write(self.style.SUCCESS(f'✅ 已重算 {start} ~ {end} 的运营汇总，共 {rows} 行'))
+
+        daily_rollup.refresh_snapshot(today)
+        self.stdout.write(self.style.SUCCESS(f'✅ 已刷新 {today} 的状态快照'))
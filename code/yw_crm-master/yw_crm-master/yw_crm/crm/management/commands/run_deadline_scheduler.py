@@ -0,0 +1,33 @@
+"""
+交期提醒调度器（常驻进程）
+订单跨过「3天内到交期」「今天到交期」「已逾期」时通过 WebSocket 推送提醒
+运行方式：python manage.py run_deadline_scheduler --resync-interval 600
+"""
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.deadline_scheduler import DeadlineScheduler
+
+
+class Command(BaseCommand):
+    help = '运行交期提醒调度器'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resync-interval', type=int, default=None, help='与数据库对账的间隔（秒），默认 DEADLINE_RESYNC_INTERVAL')
+        parser.add_argument('--catch-up', action='store_true', help='启动时对已处于紧急/逾期阶段的订单补发一次提醒')
+
+    def handle(self, *args, **options):
+        scheduler = DeadlineScheduler(
+            resync_interval=options['resync_interval'],
+            catch_up=options['catch_up']
+        )
+        self.stdout.write(self.style.SUCCESS('⏰ 交期提醒调度器已启动'))
+        try:
+            asyncio.run(scheduler.run())
+        except KeyboardInterrupt:
+            pass
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        finally:
+            self.stdout.write(self.style.WARNING(f'交期提醒调度器已停止，共推送 {scheduler.alerts_sent} 条提醒'))
@@ -0,0 +1,137 @@
+"""
+对话记忆的异步写入（write-behind）
+对话结束时只把问答放进队列，由后台线程攒批：批量向量化、判断对话类型、
+单个事务写入 ConversationMemory；达到条数或时间阈值即落盘，进程退出时排空；
+队列长度输出到 /metrics（crm_queue_depth{queue="conversation_memory"}）
+"""
+import time
+import queue
+import atexit
+import threading
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+
+
+_STOP = object()
+QUEUE_NAME = 'conversation_memory'
+
+
+class ConversationWriteBehind:
+    """对话记忆写入队列"""
+
+    def __init__(self, memory, classify: Callable[[str, str], str] = None,
+                 batch_size: int = None, flush_interval: float = None, max_pending: int = None):
+        self.memory = memory
+        self.classify = classify
+        self.batch_size = batch_size or getattr(settings, 'AI_MEMORY_BATCH_SIZE', 32)
+        self.flush_interval = flush_interval or getattr(settings, 'AI_MEMORY_FLUSH_INTERVAL', 2.0)
+        self._queue = queue.Queue(maxsize=max_pending or getattr(settings, 'AI_MEMORY_MAX_PENDING', 1000))
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self._batched = 0
+
+    def _ensure_started(self):
+        """第一次提交时才启动后台线程（管理命令等场景不产生多余线程）"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='conversation-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.drain)
+
+    def submit(self, user_message: str, ai_response: str, user_id: Optional[int] = None):
+        """提交一轮已完成的问答（不阻塞）"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait({
+                'user_message': user_message,
+                'ai_response': ai_response,
+                'user_id': user_id,
+                'timestamp': timezone.now().isoformat(),
+            })
+        except queue.Full:
+            self.dropped += 1
+            print("⚠️ 对话记忆写入队列已满，丢弃本轮对话")
+        self._report_depth()
+
+    def submit_call(self, func: Callable, *args):
+        """提交一个需要按顺序执行的写操作（如滚动摘要更新），在下一次落盘前执行"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            self.dropped += 1
+            print("⚠️ 对话记忆写入队列已满，丢弃写操作")
+        self._report_depth()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _report_depth(self):
+        """未落盘的条数 = 队列中的 + 正在攒批的"""
+        metrics.QUEUE_DEPTH.labels(QUEUE_NAME).set(self._queue.qsize() + self._batched)
+
+    def _run(self):
+        batch = []
+        deadline = 0.0
+        while True:
+            timeout = max(deadline - time.monotonic(), 0) if batch else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._write(batch)
+                return
+
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                self._batched = len(batch)
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+                self._batched = 0
+                self._report_depth()
+
+    def _write(self, batch):
+        """写入一批：先执行排队的写操作，再批量存储对话"""
+        calls = [item for item in batch if isinstance(item, tuple)]
+        batch = [item for item in batch if not isinstance(item, tuple)]
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"❌ 对话记忆写操作失败: {e}")
+        if not batch:
+            return
+        try:
+            if self.classify:
+                for turn in batch:
+                    turn['context_type'] = self.classify(turn['user_message'], turn['ai_response'])
+            self.memory.store_conversations_batch(batch)
+            self.written += len(batch)
+        except Exception as e:
+            print(f"❌ 对话记忆批量写入失败（{len(batch)} 条）: {e}")
+
+    def drain(self, timeout: float = 5.0):
+        """停止后台线程并写完队列中剩余的对话"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            print("⚠️ 对话记忆写入队列排空超时")
+            return
+        self._thread.join(timeout)
@@ -0,0 +1,139 @@
+"""
+Prometheus 指标
+HTTP 请求耗时、WebSocket 连接与推送、通道层发送耗时、大模型调用、队列长度和缓存命中，
+由 /metrics 以 Prometheus 文本格式输出。
+多个 ASGI 进程时使用 prometheus_client 的多进程模式：各进程把指标写入
+PROMETHEUS_MULTIPROC_DIR 下的共享文件，抓取时汇总（该目录应在服务启动前清空）。
+未安装 prometheus_client 时所有记录操作为空操作，/metrics 返回 503
+"""
+import os
+import atexit
+
+
+# 环境变量由 settings 在启动时设置（prometheus_client 导入时读取，未设置时各进程使用各自的内存值）
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    )
+except ImportError:
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+    CollectorRegistry = Counter = Gauge = Histogram = generate_latest = multiprocess = None
+
+METRICS_AVAILABLE = Counter is not None
+
+
+class _NoopMetric(object):
+    """未安装 prometheus_client 时的占位指标"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(metric_class, name, documentation, labelnames=(), **kwargs):
+    if not METRICS_AVAILABLE:
+        return _NoopMetric()
+    if metric_class is not Gauge:
+        kwargs.pop('multiprocess_mode', None)
+    return metric_class(name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+# ---------- HTTP ----------
+HTTP_REQUEST_SECONDS = _metric(
+    Histogram, 'crm_http_request_duration_seconds', '视图处理耗时（秒）',
+    ('view', 'method', 'status'), buckets=LATENCY_BUCKETS)
+HTTP_DB_SECONDS = _metric(
+    Histogram, 'crm_http_db_duration_seconds', '单个请求内SQL总耗时（秒）',
+    ('view',), buckets=LATENCY_BUCKETS)
+HTTP_DB_QUERIES = _metric(
+    Histogram, 'crm_http_db_queries', '单个请求内SQL条数',
+    ('view',), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+# ---------- WebSocket / 通道层 ----------
+WEBSOCKET_CONNECTIONS = _metric(
+    Gauge, 'crm_websocket_connections', '当前WebSocket连接数',
+    ('group',), multiprocess_mode='livesum')
+WEBSOCKET_MESSAGES_SENT = _metric(
+    Counter, 'crm_websocket_messages_sent_total', '推送给WebSocket客户端的消息数',
+    ('group',))
+CHANNEL_SEND_SECONDS = _metric(
+    Histogram, 'crm_channel_layer_send_duration_seconds', '通道层 group_send 耗时（秒）',
+    ('type',), buckets=LATENCY_BUCKETS)
+CHANNEL_SEND_ERRORS = _metric(
+    Counter, 'crm_channel_layer_send_errors_total', '通道层发送失败次数', ('type',))
+
+# ---------- 大模型 ----------
+LLM_REQUEST_SECONDS = _metric(
+    Histogram, 'crm_llm_request_duration_seconds', '大模型调用耗时（秒，不含排队）',
+    ('mode',), buckets=LLM_BUCKETS)
+LLM_TOKENS = _metric(
+    Counter, 'crm_llm_tokens_total', '大模型消耗的token数', ('kind',))
+LLM_ERRORS = _metric(
+    Counter, 'crm_llm_errors_total', '大模型调用失败/被网关拒绝次数', ('reason',))
+LLM_IN_FLIGHT = _metric(
+    Gauge, 'crm_llm_in_flight', '正在进行的大模型调用数', multiprocess_mode='livesum')
+LLM_QUEUE_DEPTH = _metric(
+    Gauge, 'crm_llm_queue_depth', '等待大模型并发名额的调用数', multiprocess_mode='livesum')
+
+# ---------- 队列 / 缓存 ----------
+QUEUE_DEPTH = _metric(
+    Gauge, 'crm_queue_depth', '后台写入队列长度', ('queue',), multiprocess_mode='livesum')
+CACHE_REQUESTS = _metric(
+    Counter, 'crm_cache_requests_total', '缓存查询次数（按结果 hit/miss，命中率用 PromQL 计算）',
+    ('cache', 'result'))
+
+
+def status_class(status_code):
+    return f'{status_code // 100}xx'
+
+
+def record_cache(cache_name, hit):
+    CACHE_REQUESTS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+def record_llm_usage(message):
+    """累计 langchain 消息上的 token 用量（usage_metadata，流式时通常只在最后一个分块上）"""
+    usage = getattr(message, 'usage_metadata', None)
+    if not usage:
+        return
+    if usage.get('input_tokens'):
+        LLM_TOKENS.labels('input').inc(usage['input_tokens'])
+    if usage.get('output_tokens'):
+        LLM_TOKENS.labels('output').inc(usage['output_tokens'])
+
+
+def render_latest():
+    """
+    输出 Prometheus 文本格式；多进程模式下汇总所有进程写入的指标
+    :return: (内容, Content-Type)，未安装 prometheus_client 时内容为 None
+    """
+    if not METRICS_AVAILABLE:
+        return None, CONTENT_TYPE_LATEST
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+if METRICS_AVAILABLE and MULTIPROC_DIR:
+    # 进程退出时清除它的 livesum 仪表值（连接数、队列长度等），避免已退出进程的值被累加
+    atexit.register(multiprocess.mark_process_dead, os.getpid())
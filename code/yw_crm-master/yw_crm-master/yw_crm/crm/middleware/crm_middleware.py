@@ -1,14 +1,39 @@
+import re
 from django.utils.deprecation import MiddlewareMixin
-from django.shortcuts import HttpResponse
-from bs4 import BeautifulSoup
+
 
 class XssMiddleware(MiddlewareMixin):
+    """
+    过滤响应中的可疑 <script>
+    只处理非流式的 text/html 响应：SSE对话、导出文件、JSON、图片等原样返回，
+    状态码和响应头保持不变
+    """
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.xss_filter = XSSFilter()
 
     def process_response(self,request,response):
-        response=XSSFilter().process(str(response.content,encoding='utf-8'))
-        return HttpResponse(response)
+        if getattr(response, 'streaming', False):
+            return response
+        content_type = response.get('Content-Type', '')
+        if not content_type.startswith('text/html') or response.get('Content-Encoding'):
+            return response
+
+        content = response.content
+        filtered = self.xss_filter.process_bytes(content)
+        if filtered is not content:
+            response.content = filtered
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(filtered))
+        return response
+
 
 class XSSFilter(object):
+    """
+    删除正文中包含可疑内容（如 alert）的 <script> 元素
+    用预编译正则定位 <script> 元素，页面中没有 <script 时不做任何处理
+    """
 
     def __init__(self):
         self.not_valid_name=[
@@ -20,12 +45,27 @@ class XSSFilter(object):
         self.exclude_name=[
             'alert'
         ]
+        names = '|'.join(re.escape(name) for name in self.not_valid_name)
+        # 元素到结束标签为止；没有结束标签时到文档末尾（与html解析器的处理一致）
+        self._tag_pattern = re.compile(
+            (r'<(%s)\b[^>]*>(.*?)(?:</\1\s*>|\Z)' % names).encode('ascii'), re.IGNORECASE | re.DOTALL
+        )
+        self._marker_pattern = re.compile(('<(?:%s)' % names).encode('ascii'), re.IGNORECASE)
+        self._exclude = [name.encode('utf-8') for name in self.exclude_name]
+
+    def _replace(self, match):
+        body = match.group(2)
+        for exclude_name in self._exclude:
+            if exclude_name in body:
+                return b''
+        return match.group(0)
+
+    def process_bytes(self, content):
+        """过滤字节形式的HTML，未发现可疑元素时返回原对象"""
+        if not self._marker_pattern.search(content):
+            return content
+        filtered = self._tag_pattern.sub(self._replace, content)
+        return content if filtered == content else filtered
 
     def process(self,content):
-        soup=BeautifulSoup(content,"html.parser")
-        for tag in soup.find_all():
-            if tag.name in self.not_valid_name:
-                for exclude_name in self.exclude_name:
-                    if exclude_name in tag.get_text():
-                        tag.decompose()
-        return soup.decode()
+        return self.process_bytes(content.encode('utf-8')).decode('utf-8')
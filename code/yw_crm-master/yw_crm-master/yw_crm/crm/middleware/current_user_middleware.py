@@ -0,0 +1,15 @@
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from crm.utils import load_current_user
+
+
+class CurrentUserMiddleware(MiddlewareMixin):
+    """
+    把当前登录用户挂到 request.current_user 上（惰性加载，同一请求只查询一次，
+    部门和角色一并取出），工具函数、权限装饰器和视图共用
+    """
+
+    def process_request(self, request):
+        request.current_user = SimpleLazyObject(lambda: load_current_user(request))
+        return None
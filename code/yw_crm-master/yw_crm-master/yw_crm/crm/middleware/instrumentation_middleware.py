@@ -0,0 +1,226 @@
+"""
+请求性能统计中间件
+记录每个视图的耗时、SQL条数和SQL耗时，
+同一形状的SQL在一个请求中重复多次时标记为疑似 N+1，
+通过 Server-Timing 响应头返回给浏览器开发者工具，并在进程内按视图汇总，
+root 用户可在 /api/perf/stats/ 查看；耗时直方图同时输出到 /metrics。
+当前请求的记录器放在 contextvar 中，每个数据库连接建立时挂上同一个执行包装器，
+因此 database_sync_to_async（包括 thread_sensitive=False）和上下文收集线程池中的查询也计入请求
+"""
+import re
+import time
+import logging
+import threading
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from crm import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# SQL 形状：去掉字面量，便于识别同一语句的重复执行
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def sql_shape(sql):
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+class QueryRecorder(object):
+    """记录一个请求内的SQL条数、耗时和形状（请求的查询可能来自多个线程）"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            shape = sql_shape(sql)
+            with self._lock:
+                self.duration += elapsed
+                self.count += 1
+                self.shapes[shape] += 1
+
+    def repeated(self, threshold):
+        """重复次数达到阈值的SQL形状（疑似 N+1）"""
+        return [(shape, times) for shape, times in self.shapes.most_common() if times >= threshold]
+
+
+# 当前请求的记录器；asgiref 的 sync_to_async 会把 contextvar 带到执行线程
+_current_recorder = ContextVar('crm_query_recorder', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    """所有连接共用的执行包装器，不在请求内时直接执行"""
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(db_connection):
+    if _record_query not in db_connection.execute_wrappers:
+        db_connection.execute_wrappers.append(_record_query)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+connection_created.connect(_on_connection_created, dispatch_uid='crm_instrumentation_query_recorder')
+
+
+class ViewStats(object):
+    """进程内按视图汇总的统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self.started_at = time.time()
+
+    def record(self, view_name, total_ms, db_count, db_ms, status_code, repeated):
+        with self._lock:
+            stats = self._views.get(view_name)
+            if stats is None:
+                stats = self._views[view_name] = {
+                    'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'db_queries': 0, 'db_max_queries': 0, 'db_ms': 0.0,
+                    'n_plus_one': 0, 'n_plus_one_sql': '',
+                }
+            stats['requests'] += 1
+            stats['errors'] += status_code >= 500
+            stats['total_ms'] += total_ms
+            stats['max_ms'] = max(stats['max_ms'], total_ms)
+            stats['db_queries'] += db_count
+            stats['db_max_queries'] = max(stats['db_max_queries'], db_count)
+            stats['db_ms'] += db_ms
+            if repeated:
+                stats['n_plus_one'] += 1
+                stats['n_plus_one_sql'] = f"{repeated[0][1]}× {repeated[0][0][:300]}"
+
+    def snapshot(self):
+        """按平均耗时降序返回各视图的统计"""
+        with self._lock:
+            views = {name: dict(stats) for name, stats in self._views.items()}
+        result = []
+        for name, stats in views.items():
+            requests = stats['requests']
+            result.append({
+                'view': name,
+                'requests': requests,
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_ms'] / requests, 2),
+                'max_ms': round(stats['max_ms'], 2),
+                'avg_db_queries': round(stats['db_queries'] / requests, 1),
+                'max_db_queries': stats['db_max_queries'],
+                'avg_db_ms': round(stats['db_ms'] / requests, 2),
+                'n_plus_one_requests': stats['n_plus_one'],
+                'n_plus_one_sql': stats['n_plus_one_sql'],
+            })
+        return sorted(result, key=lambda item: item['avg_ms'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self.started_at = time.time()
+
+
+view_stats = ViewStats()
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+class InstrumentationMiddleware(object):
+    """
+    请求性能统计中间件（同步/异步两用），建议放在 MIDDLEWARE 靠前的位置，
+    这样权限、登录等中间件的耗时和查询也计入请求
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'PERF_INSTRUMENTATION_ENABLED', True)
+        self.n_plus_one_threshold = getattr(settings, 'PERF_N_PLUS_ONE_THRESHOLD', 5)
+        self.slow_request_ms = getattr(settings, 'PERF_SLOW_REQUEST_MS', 1000)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _skip(self, request):
+        return not self.enabled or request.path_info.startswith(settings.STATIC_URL)
+
+    def _start(self):
+        # 中间件加载前已建立的连接收不到 connection_created，这里补挂
+        install_query_recorder(connection)
+        recorder = QueryRecorder()
+        return recorder, _current_recorder.set(recorder), time.perf_counter()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if self._skip(request):
+            return self.get_response(request)
+
+        recorder, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        return self._finish(request, response, recorder, start)
+
+    async def __acall__(self, request):
+        if self._skip(request):
+            return await self.get_response(request)
+
+        recorder, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_recorder.reset(token)
+        return self._finish(request, response, recorder, start)
+
+    def _finish(self, request, response, recorder, start):
+        total_ms = (time.perf_counter() - start) * 1000
+        db_ms = recorder.duration * 1000
+
+        view_name = get_view_name(request)
+        repeated = recorder.repeated(self.n_plus_one_threshold)
+        view_stats.record(view_name, total_ms, recorder.count, db_ms, response.status_code, repeated)
+        metrics.HTTP_REQUEST_SECONDS.labels(view_name, request.method, metrics.status_class(response.status_code)).observe(total_ms / 1000)
+        metrics.HTTP_DB_SECONDS.labels(view_name).observe(db_ms / 1000)
+        metrics.HTTP_DB_QUERIES.labels(view_name).observe(recorder.count)
+
+        # 流式响应只统计到响应对象返回为止
+        response['Server-Timing'] = (
+            f'total;dur={total_ms:.1f}, '
+            f'db;dur={db_ms:.1f};desc="{recorder.count} queries"'
+        )
+        if repeated:
+            logger.warning('疑似N+1查询 %s: %s 次 %s', view_name, repeated[0][1], repeated[0][0][:200])
+        if total_ms >= self.slow_request_ms:
+            logger.warning('慢请求 %s %s: %.0fms，SQL %s 条 %.0fms', view_name, request.path_info, total_ms, recorder.count, db_ms)
+        return response
@@ -5,7 +5,7 @@ class LoginRequiredMiddleware(MiddlewareMixin):
     def process_request(self, request):
         # 白名单：登录页、重置页、验证码、静态资源、根路径
         white_list = [
-            '/', '/login/', '/reset/', '/verify_code/'
+            '/', '/login/', '/reset/', '/verify_code/', '/metrics/'
         ]
         if request.path in white_list or request.path.startswith('/static/'):
             return None
@@ -0,0 +1,290 @@
+"""
+采样性能分析中间件（默认关闭，PROFILING_ENABLED 开启）
+按路径正则 + 采样率、指定用户或 root 用户带 X-Profile 请求头选中请求，
+请求期间由后台线程定时抓取调用栈：WSGI 请求只采处理该请求的线程；
+ASGI 请求的视图在事件循环和线程池之间切换，无法区分属于哪个请求，只能采整个进程的所有线程，
+这类结果标记为 scope=process（同一时间其它请求的栈也会混入），
+结果按折叠栈（collapsed stack）保存到本地目录并自动轮转，
+root 用户可在 /api/perf/profiles/ 下载 collapsed 或 speedscope 格式用于生成火焰图
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIRequest
+
+from crm.utils import get_current_user
+from crm.middleware.instrumentation_middleware import get_view_name
+
+
+PROFILE_NAME_RE = re.compile(r'^[\w.-]+\.json$')
+# 栈顶位于这些模块时视为空闲等待（线程池、事件循环等），不计入样本
+IDLE_MODULES = ('threading.py', 'selectors.py', 'queue.py', 'socket.py', 'concurrent/futures/thread.py', 'concurrent/futures/_base.py')
+MAX_STACK_DEPTH = 128
+
+logger = logging.getLogger(__name__)
+
+
+def get_profile_dir():
+    return getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler(object):
+    """
+    后台线程按固定间隔抓取调用栈，累计为折叠栈计数
+    thread_ids 为 None 时采样进程内所有线程
+    """
+
+    def __init__(self, interval=None, max_seconds=None, thread_ids=None):
+        self.interval = interval or getattr(settings, 'PROFILING_INTERVAL', 0.005)
+        self.max_seconds = max_seconds or getattr(settings, 'PROFILING_MAX_SECONDS', 60)
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.started_at = None
+        self.duration = 0.0
+
+    @property
+    def scope(self):
+        return 'process' if self.thread_ids is None else 'thread'
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.time() - self.started_at
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.time() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                if frame.f_code.co_filename.replace('\\', '/').endswith(IDLE_MODULES):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(f"thread {names.get(thread_id, thread_id)}")
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+
+def save_profile(sampler, request, view_name, status_code):
+    """保存一次采样结果，超过 PROFILING_MAX_FILES 时删除最旧的文件"""
+    profile_dir = get_profile_dir()
+    os.makedirs(profile_dir, exist_ok=True)
+    duration_ms = int(sampler.duration * 1000)
+    safe_view = re.sub(r'[^\w.-]+', '_', view_name)[:60]
+    name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(sampler.started_at))}-{safe_view}-{duration_ms}ms-{random.randrange(16 ** 4):04x}.json"
+    user = get_current_user(request)
+    data = {
+        'path': request.path_info,
+        'method': request.method,
+        'view': view_name,
+        'status': status_code,
+        # thread：只含处理该请求的线程；process：进程内所有线程（ASGI请求）
+        'scope': sampler.scope,
+        'user_id': user.id if user else None,
+        'started_at': sampler.started_at,
+        'duration_ms': duration_ms,
+        # 实际采样间隔（抓取调用栈本身也要时间），用于换算各栈的耗时
+        'interval_ms': round(sampler.duration * 1000 / sampler.samples, 3) if sampler.samples else sampler.interval * 1000,
+        'samples': sampler.samples,
+        'stacks': dict(sampler.stacks),
+    }
+    with open(os.path.join(profile_dir, name), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+    max_files = getattr(settings, 'PROFILING_MAX_FILES', 200)
+    files = list_profiles()
+    for old in files[max_files:]:
+        try:
+            os.remove(os.path.join(profile_dir, old))
+        except OSError:
+            pass
+    logger.info('已保存性能采样 %s（%s 次采样，范围 %s）', name, sampler.samples, sampler.scope)
+    return name
+
+
+def list_profiles():
+    """已保存的采样文件名，最新的在前"""
+    profile_dir = get_profile_dir()
+    if not os.path.isdir(profile_dir):
+        return []
+    files = [entry for entry in os.listdir(profile_dir) if PROFILE_NAME_RE.match(entry)]
+    return sorted(files, key=lambda entry: os.path.getmtime(os.path.join(profile_dir, entry)), reverse=True)
+
+
+def load_profile(name):
+    """读取一份采样结果；文件名不合法或不存在时返回 None"""
+    if not PROFILE_NAME_RE.match(name):
+        return None
+    path = os.path.join(get_profile_dir(), name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+PROCESS_SCOPE_NOTE = ' [进程内所有线程]'
+
+
+def to_collapsed(profile):
+    """折叠栈文本（flamegraph.pl / inferno 等工具的输入），每行：栈;栈 次数"""
+    return '\n'.join(f"{stack} {count}" for stack, count in
+                     sorted(profile['stacks'].items(), key=lambda item: -item[1])) + '\n'
+
+
+def to_speedscope(profile):
+    """speedscope 的 sampled 格式，每个不同的栈作为一个样本，权重为采样次数 × 间隔"""
+    frames, frame_index = [], {}
+    samples, weights = [], []
+    for stack, count in profile['stacks'].items():
+        indexes = []
+        for label in stack.split(';'):
+            if label not in frame_index:
+                frame_index[label] = len(frames)
+                frames.append({'name': label})
+            indexes.append(frame_index[label])
+        samples.append(indexes)
+        weights.append(round(count * profile['interval_ms'], 3))
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': f"{profile['method']} {profile['path']} ({profile['view']}){PROCESS_SCOPE_NOTE if profile.get('scope') == 'process' else ''}",
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+        'name': profile['view'],
+        'exporter': 'yw_crm profiling_middleware',
+    }
+
+
+class ProfilingMiddleware(object):
+    """
+    采样性能分析中间件（同步/异步两用），放在 SessionMiddleware 之后（按用户选择请求时要读取session）；
+    PROFILING_ENABLED 关闭时不加载，不影响 ASGI 下异步视图的调用链
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.path_patterns = [re.compile(pattern) for pattern in getattr(settings, 'PROFILING_PATH_PATTERNS', [])]
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.05)
+        self.user_ids = set(getattr(settings, 'PROFILING_USER_IDS', []))
+        self.header = 'HTTP_' + getattr(settings, 'PROFILING_HEADER', 'X-Profile').upper().replace('-', '_')
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def should_profile(self, request):
+        if request.META.get(self.header):
+            user = get_current_user(request)
+            return bool(user) and user.username == 'root'
+        if self.user_ids and request.session.get('user_id') in self.user_ids:
+            return True
+        return (any(pattern.search(request.path_info) for pattern in self.path_patterns)
+                and random.random() < self.sample_rate)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        sampler = StackSampler(thread_ids=[threading.get_ident()])
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            sampler.stop()
+            raise
+        return self._finish(sampler, request, response)
+
+    async def __acall__(self, request):
+        # 读取session/用户会访问数据库，放到线程中执行
+        if not await sync_to_async(self.should_profile)(request):
+            return await self.get_response(request)
+
+        # ASGI 请求无法确定属于本请求的线程，只能按进程采样
+        thread_ids = None if isinstance(request, ASGIRequest) else [threading.get_ident()]
+        sampler = StackSampler(thread_ids=thread_ids)
+        sampler.start()
+        try:
+            response = await self.get_response(request)
+        except Exception:
+            sampler.stop()
+            raise
+        if getattr(response, 'streaming', False):
+            return self._finish(sampler, request, response)
+        await sync_to_async(self._finish)(sampler, request, response)
+        return response
+
+    def _finish(self, sampler, request, response):
+        def finish():
+            sampler.stop()
+            try:
+                save_profile(sampler, request, get_view_name(request), response.status_code)
+            except Exception:
+                logger.exception('保存性能采样失败')
+
+        if getattr(response, 'streaming', False):
+            # 流式响应（如SSE对话）要采样到响应体发送完毕
+            response.streaming_content = self._wrap_streaming(response, finish)
+        else:
+            finish()
+        return response
+
+    @staticmethod
+    def _wrap_streaming(response, finish):
+        content = response.streaming_content
+        if getattr(response, 'is_async', False):
+            async def wrapped():
+                try:
+                    async for chunk in content:
+                        yield chunk
+                finally:
+                    await sync_to_async(finish)()
+        else:
+            def wrapped():
+                try:
+                    for chunk in content:
+                        yield chunk
+                finally:
+                    finish()
+        return wrapped()
@@ -1,39 +1,178 @@
 """
 WebSocket认证中间件
+连接时按 session_key 解析用户：
+1. 带有效的签名令牌（上次连接成功时下发）时直接使用令牌中的用户，不查数据库
+2. 进程内短时缓存 session_key -> 用户快照，重连时直接命中
+3. 缓存未命中的连接在很短的窗口内合并，一次查询 Session、一次查询 UserInfo
 """
+import time
+import asyncio
+import hashlib
+from urllib.parse import parse_qs
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sessions.models import Session
+from django.core import signing
 from django.utils import timezone
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
+from crm import metrics
 from crm.models import UserInfo
 
 
-@database_sync_to_async
-def get_user_from_session(session_key):
-    """从session获取用户信息"""
+TOKEN_SALT = 'crm.websocket-auth'
+# 用户快照包含的字段（消费者只用到这些）
+SNAPSHOT_FIELDS = ('id', 'username', 'name')
+
+
+def _session_digest(session_key):
+    """令牌只记录 session_key 的摘要，用于确认令牌和当前 cookie 属于同一会话"""
+    return hashlib.sha256(session_key.encode('utf-8')).hexdigest()[:16]
+
+
+def user_from_snapshot(snapshot):
+    if not snapshot:
+        return AnonymousUser()
+    return UserInfo(**snapshot)
+
+
+def make_token(session_key, snapshot):
+    """为已认证的连接生成签名令牌，客户端重连时通过 ?token= 带上"""
+    return signing.dumps({'s': _session_digest(session_key), 'u': snapshot}, salt=TOKEN_SALT, compress=True)
+
+
+def read_token(token, session_key):
+    """校验令牌，返回用户快照；过期、被篡改或与当前会话不符时返回 None"""
+    max_age = getattr(settings, 'WS_AUTH_TOKEN_MAX_AGE', 600)
+    if not max_age or not token:
+        return None
     try:
-        session = Session.objects.get(session_key=session_key)
-        if session.expire_date < timezone.now():
-            return AnonymousUser()
-        
-        session_data = session.get_decoded()
-        user_id = session_data.get('user_id')
-        
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    if payload.get('s') != _session_digest(session_key):
+        return None
+    return payload.get('u')
+
+
+@database_sync_to_async
+def get_users_from_sessions(session_keys):
+    """批量从session获取用户快照：{session_key: snapshot 或 None}"""
+    result = dict.fromkeys(session_keys)
+    user_ids = {}
+    for session in Session.objects.filter(session_key__in=session_keys, expire_date__gt=timezone.now()):
+        user_id = session.get_decoded().get('user_id')
         if user_id:
-            user = UserInfo.objects.get(id=user_id)
-            return user
-        else:
-            return AnonymousUser()
-            
-    except (Session.DoesNotExist, UserInfo.DoesNotExist):
-        return AnonymousUser()
+            user_ids[session.session_key] = user_id
+
+    if user_ids:
+        users = {row['id']: row for row in UserInfo.objects.filter(
+            id__in=set(user_ids.values())
+        ).values(*SNAPSHOT_FIELDS)}
+        for session_key, user_id in user_ids.items():
+            result[session_key] = users.get(user_id)
+    return result
+
+
+class SessionUserResolver(object):
+    """
+    session_key -> 用户快照 的短时缓存 + 合并查询
+    同一 session_key 并发连接共用一次解析；不同 session_key 在 batch_window 内合并为一次批量查询
+    """
+
+    def __init__(self, ttl=None, anonymous_ttl=5, batch_window=0.02, max_batch=200, max_size=5000):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'WS_AUTH_CACHE_TTL', 60)
+        self.anonymous_ttl = anonymous_ttl
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_size = max_size
+        self._cache = {}
+        self._pending = {}
+        self._flush_handle = None
+        self.hits = 0
+        self.queries = 0
+
+    def _get_cached(self, session_key):
+        entry = self._cache.get(session_key)
+        if entry is None:
+            return False, None
+        expires_at, snapshot = entry
+        if expires_at < time.monotonic():
+            self._cache.pop(session_key, None)
+            return False, None
+        return True, snapshot
+
+    def _set_cached(self, session_key, snapshot):
+        if len(self._cache) >= self.max_size:
+            now = time.monotonic()
+            for key in [key for key, entry in self._cache.items() if entry[0] < now]:
+                del self._cache[key]
+            if len(self._cache) >= self.max_size:
+                self._cache.clear()
+        ttl = self.ttl if snapshot else self.anonymous_ttl
+        self._cache[session_key] = (time.monotonic() + ttl, snapshot)
+
+    def invalidate(self, session_key):
+        self._cache.pop(session_key, None)
+
+    async def resolve(self, session_key):
+        found, snapshot = self._get_cached(session_key)
+        if found:
+            self.hits += 1
+            metrics.record_cache('ws_session', True)
+            return snapshot
+
+        metrics.record_cache('ws_session', False)
+
+        future = self._pending.get(session_key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[session_key] = future
+            if len(self._pending) >= self.max_batch:
+                self._flush_now()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_now)
+        return await asyncio.shield(future)
+
+    def _flush_now(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            asyncio.ensure_future(self._flush(pending))
+
+    async def _flush(self, pending):
+        try:
+            self.queries += 1
+            snapshots = await get_users_from_sessions(list(pending))
+        except Exception as e:
+            print(f"❌ WebSocket批量认证失败: {e}")
+            for future in pending.values():
+                if not future.done():
+                    future.set_result(None)
+            return
+        for session_key, future in pending.items():
+            snapshot = snapshots.get(session_key)
+            self._set_cached(session_key, snapshot)
+            if not future.done():
+                future.set_result(snapshot)
+        if len(pending) > 1:
+            print(f"🔐 WebSocket认证合并查询: {len(pending)} 个会话")
+
+
+resolver = SessionUserResolver()
+
+
+async def get_user_from_session(session_key):
+    """从session获取用户信息"""
+    return user_from_snapshot(await resolver.resolve(session_key))
 
 
 class SessionAuthMiddleware(BaseMiddleware):
     """基于Django session的WebSocket认证中间件"""
-    
+
     async def __call__(self, scope, receive, send):
         # 只处理WebSocket连接
         if scope["type"] == "websocket":
@@ -46,17 +185,24 @@ class SessionAuthMiddleware(BaseMiddleware):
                         if "=" in cookie:
                             key, value = cookie.strip().split("=", 1)
                             cookies[key] = value
-            
-            session_key = cookies.get("sessionid")
-            
+
+            session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+
             if session_key:
-                scope["user"] = await get_user_from_session(session_key)
+                query = parse_qs(scope.get("query_string", b"").decode())
+                snapshot = read_token(query.get("token", [None])[0], session_key)
+                if snapshot is None:
+                    snapshot = await resolver.resolve(session_key)
+                    # 只在经过session确认后签发新令牌，令牌不会无限续期
+                    if snapshot and getattr(settings, 'WS_AUTH_TOKEN_MAX_AGE', 600):
+                        scope["ws_token"] = make_token(session_key, snapshot)
+                scope["user"] = user_from_snapshot(snapshot)
             else:
                 scope["user"] = AnonymousUser()
-        
+
         return await super().__call__(scope, receive, send)
 
 
 def SessionAuthMiddlewareStack(inner):
     """创建session认证中间件堆栈"""
-    return SessionAuthMiddleware(inner) 
\ No newline at end of file
+    return SessionAuthMiddleware(inner)
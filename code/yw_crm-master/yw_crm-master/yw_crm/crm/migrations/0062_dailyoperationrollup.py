@@ -0,0 +1,62 @@
+# Generated by Django 4.2.8
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("crm", "0061_aiassistantmemory"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyOperationRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(verbose_name="日期")),
+                (
+                    "step_name",
+                    models.CharField(
+                        blank=True, default="", max_length=100, verbose_name="步骤名称"
+                    ),
+                ),
+                ("orders_created", models.IntegerField(default=0, verbose_name="新增订单数")),
+                ("steps_started", models.IntegerField(default=0, verbose_name="开始步骤数")),
+                ("steps_completed", models.IntegerField(default=0, verbose_name="完成步骤数")),
+                ("steps_skipped", models.IntegerField(default=0, verbose_name="跳过步骤数")),
+                (
+                    "duration_seconds",
+                    models.BigIntegerField(default=0, verbose_name="完成步骤总耗时(秒)"),
+                ),
+                (
+                    "duration_max_seconds",
+                    models.BigIntegerField(default=0, verbose_name="单步最长耗时(秒)"),
+                ),
+                ("pending_count", models.IntegerField(default=0, verbose_name="待处理数")),
+                ("processing_count", models.IntegerField(default=0, verbose_name="处理中数")),
+                ("completed_count", models.IntegerField(default=0, verbose_name="已完成数")),
+                ("cancelled_count", models.IntegerField(default=0, verbose_name="已取消数")),
+                ("overdue_count", models.IntegerField(default=0, verbose_name="逾期/停滞数")),
+                (
+                    "snapshot_time",
+                    models.DateTimeField(blank=True, null=True, verbose_name="快照时间"),
+                ),
+                ("updated_time", models.DateTimeField(auto_now=True, verbose_name="更新时间")),
+            ],
+            options={
+                "verbose_name": "每日运营汇总",
+                "verbose_name_plural": "每日运营汇总",
+                "ordering": ["-date", "step_name"],
+                "unique_together": {("date", "step_name")},
+            },
+        ),
+    ]
@@ -604,5 +604,42 @@ class OrderProgress(models.Model):
         self.save()
 
 
+class DailyOperationRollup(models.Model):
+    """
+    每日运营汇总（按 日期 + 步骤 累计）
+    step_name 为空的行是订单级汇总；由步骤/订单信号增量累加，
+    rollup_daily_operations 命令可按原始数据重算并刷新状态快照
+    """
+    date = models.DateField(verbose_name='日期')
+    step_name = models.CharField(max_length=100, verbose_name='步骤名称', blank=True, default='')
+
+    # 当天发生的事件（增量累加）
+    orders_created = models.IntegerField(verbose_name='新增订单数', default=0)
+    steps_started = models.IntegerField(verbose_name='开始步骤数', default=0)
+    steps_completed = models.IntegerField(verbose_name='完成步骤数', default=0)
+    steps_skipped = models.IntegerField(verbose_name='跳过步骤数', default=0)
+    duration_seconds = models.BigIntegerField(verbose_name='完成步骤总耗时(秒)', default=0)
+    duration_max_seconds = models.BigIntegerField(verbose_name='单步最长耗时(秒)', default=0)
+
+    # 刷新时刻的状态快照（只在当天刷新，历史日期保留最后一次快照）
+    pending_count = models.IntegerField(verbose_name='待处理数', default=0)
+    processing_count = models.IntegerField(verbose_name='处理中数', default=0)
+    completed_count = models.IntegerField(verbose_name='已完成数', default=0)
+    cancelled_count = models.IntegerField(verbose_name='已取消数', default=0)
+    overdue_count = models.IntegerField(verbose_name='逾期/停滞数', default=0)
+    snapshot_time = models.DateTimeField(verbose_name='快照时间', null=True, blank=True)
 
+    updated_time = models.DateTimeField(verbose_name='更新时间', auto_now=True)
+
+    class Meta:
+        ordering = ['-date', 'step_name']
+        unique_together = ['date', 'step_name']
+        verbose_name = '每日运营汇总'
+        verbose_name_plural = '每日运营汇总'
+
+    def __str__(self):
+        return f"{self.date}-{self.step_name or '订单'}"
 
+    @property
+    def avg_duration_seconds(self):
+        return self.duration_seconds // self.steps_completed if self.steps_completed else 0
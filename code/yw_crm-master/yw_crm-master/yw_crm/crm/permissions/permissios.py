@@ -1,17 +1,17 @@
-from django.conf import settings
 from stark.service.base_stark import BaseStark
+from rbac.services.permission_cache import get_permission_names
 
 
 class Permissions(object):
 
     def get_add_btn(self,request,*args,**kwargs):
-        permission_dict = self.request.session[settings.PERMISSION_SESSION_KEY]
+        permission_dict = get_permission_names(self.request)
         name="%s:%s"%(self.site.namespace,self.get_add_url_name)
         if name in permission_dict:
             return super().get_add_btn(request,*args,**kwargs)
 
     def get_list_display(self):
-        permission_dict = self.request.session[settings.PERMISSION_SESSION_KEY]
+        permission_dict = get_permission_names(self.request)
         val=super().get_list_display()
         edit_name="%s:%s"%(self.site.namespace,self.get_edit_url_name)
         del_name="%s:%s"%(self.site.namespace,self.get_del_url_name)
@@ -0,0 +1,165 @@
+"""
+按token预算组装提示词
+用本地分词器计算长度，在输入预算内依次放入：数据上下文、最近的多轮对话、
+较早对话的滚动摘要、按相似度排序的历史对话片段
+"""
+import re
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+
+# 每条消息在对话格式中的额外开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """token计数：优先使用 tiktoken，不可用时按字符估算"""
+
+    _encoding = None
+    _loaded = False
+
+    @classmethod
+    def _get_encoding(cls):
+        if not cls._loaded:
+            cls._loaded = True
+            try:
+                import tiktoken
+                cls._encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                print(f"⚠️ tiktoken 不可用，改用估算计数: {e}")
+                cls._encoding = None
+        return cls._encoding
+
+    @classmethod
+    def count(cls, text: str) -> int:
+        if not text:
+            return 0
+        encoding = cls._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        # 估算：中文约1字1token，其它约4字符1token
+        cjk = len(re.findall(r'[\u4e00-\u9fa5]', text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    @classmethod
+    def truncate(cls, text: str, max_tokens: int, keep_tail: bool = False) -> str:
+        """截断到 max_tokens 以内；keep_tail 为 True 时保留末尾"""
+        if max_tokens <= 0 or not text:
+            return ''
+        if cls.count(text) <= max_tokens:
+            return text
+        encoding = cls._get_encoding()
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            tokens = tokens[-max_tokens:] if keep_tail else tokens[:max_tokens]
+            return encoding.decode(tokens)
+        # 估算模式按比例截取字符
+        ratio = max_tokens / cls.count(text)
+        length = max(int(len(text) * ratio) - 1, 0)
+        return text[-length:] if keep_tail else text[:length]
+
+
+class PromptBuilder:
+    """在输入token预算内组装发给大模型的消息"""
+
+    def __init__(self, budget: int = None, summary_budget: int = None):
+        self.budget = budget or getattr(settings, 'AI_PROMPT_TOKEN_BUDGET', 3000)
+        self.summary_budget = summary_budget or getattr(settings, 'AI_SUMMARY_MAX_TOKENS', 300)
+        self.counter = TokenCounter
+
+    def _message_tokens(self, text: str) -> int:
+        return self.counter.count(text) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, system_prompt: str, user_message: str, data_context: str = '',
+              fragments: Sequence = (), history: Sequence[BaseMessage] = (), summary: str = '') -> List[BaseMessage]:
+        """
+        组装消息列表
+        fragments: ConversationFragment 列表（带 score）；history: 当前会话的多轮消息（旧→新）
+        """
+        question = f"\n用户问题：{user_message}\n\n请基于以上数据简洁回答。"
+        remaining = self.budget - self._message_tokens(system_prompt) - self._message_tokens(question)
+
+        # 1. 数据上下文（最多占剩余预算的一半）
+        data_context = self.counter.truncate(data_context, max(remaining // 2, 0))
+        remaining -= self.counter.count(data_context)
+
+        # 2. 最近的多轮对话，从新到旧按整轮放入
+        kept_history: List[BaseMessage] = []
+        pairs = self._pair_history(history)
+        for pair in reversed(pairs):
+            cost = sum(self._message_tokens(message.content) for message in pair)
+            if cost > remaining:
+                break
+            kept_history = list(pair) + kept_history
+            remaining -= cost
+
+        # 3. 较早对话的滚动摘要
+        summary_block = ''
+        if summary and remaining > 0:
+            summary = self.counter.truncate(summary, min(self.summary_budget, remaining), keep_tail=True)
+            summary_block = f"\n<conversation_summary>\n较早对话摘要：\n{summary}\n</conversation_summary>\n"
+            remaining -= self.counter.count(summary_block)
+
+        # 4. 历史对话片段，按相似度从高到低放入
+        fragment_lines = []
+        for fragment in sorted(fragments, key=lambda f: f.score or 0, reverse=True):
+            line = self._format_fragment(len(fragment_lines) + 1, fragment)
+            cost = self.counter.count(line)
+            if cost > remaining:
+                continue
+            fragment_lines.append(line)
+            remaining -= cost
+        fragment_block = ''
+        if fragment_lines:
+            fragment_block = "\n<conversation_history>\n相关历史对话：\n" + ''.join(fragment_lines) + "</conversation_history>\n"
+
+        return [
+            SystemMessage(content=system_prompt),
+            *kept_history,
+            HumanMessage(content=f"{data_context}{summary_block}{fragment_block}{question}")
+        ]
+
+    @staticmethod
+    def _pair_history(history: Sequence[BaseMessage]) -> List[Tuple[BaseMessage, ...]]:
+        """把历史消息按（问, 答）分组，保证不会只留下半轮"""
+        pairs = []
+        current = []
+        for message in history:
+            if isinstance(message, HumanMessage) and current:
+                pairs.append(tuple(current))
+                current = []
+            current.append(message)
+        if current:
+            pairs.append(tuple(current))
+        return pairs
+
+    @staticmethod
+    def _format_fragment(index: int, fragment) -> str:
+        is_today = (timezone.now() - fragment.timestamp.replace(tzinfo=timezone.get_current_timezone())).days == 0
+        time_desc = "今天" if is_today else "最近"
+        answer = fragment.ai_response.replace('\n', ' ')[:80]
+        return f"{index}. {time_desc}: 问「{fragment.user_message[:50]}」答「{answer}」\n"
+
+    def compact(self, summary: str, dropped_turns: Iterable[Tuple[str, str]]) -> str:
+        """把移出会话窗口的问答追加进滚动摘要，超出摘要预算时丢弃最早的内容"""
+        lines = [line for line in (summary or '').split('\n') if line]
+        question: Optional[str] = None
+        for role, content in dropped_turns:
+            if role == 'human':
+                question = content.strip().replace('\n', ' ')[:60]
+                continue
+            # 回答只保留第一句
+            answer = re.split(r'[。！？\n]', content.strip(), maxsplit=1)[0][:80]
+            lines.append(f"• 问：{question or '（无）'}；答：{answer}")
+            question = None
+        if question:
+            lines.append(f"• 问：{question}")
+
+        compacted = '\n'.join(lines)
+        while lines and self.counter.count(compacted) > self.summary_budget:
+            lines.pop(0)
+            compacted = '\n'.join(lines)
+        return compacted
@@ -0,0 +1,177 @@
+"""
+AI回复缓存
+以「规范化问题 + 用户 + 订单数据版本」为键缓存LLM回复，带TTL和LRU淘汰；
+回复由该用户的会话历史、摘要和RAG记忆参与生成，不能在用户之间共用，
+用户清除对话历史后递增其缓存版本（各进程共享），旧回复随之失效；
+可选按问题向量相似度命中相近的问法
+"""
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from utils.cache import shared_cache
+from . import metrics
+from .conversation_memory import HashingEmbedding
+
+
+# 依赖上下文的追问不能跨会话复用
+FOLLOW_UP_MARKERS = ('这个', '那个', '这些', '那些', '上面', '刚才', '之前', '继续', '第一个', '第二个', '第三个', '它们')
+# 每个用户的回复缓存版本（清除对话历史时递增）
+USER_VERSION_CACHE_KEY = 'crm:ai_response_user_version:%s'
+
+
+@dataclass
+class CachedResponse:
+    """缓存条目"""
+    question: str
+    response: str
+    version: str
+    expires_at: float
+    embedding: Optional[np.ndarray] = None
+
+
+class ResponseCache:
+    """进程内的AI回复缓存（线程安全）"""
+
+    def __init__(self, max_size: int = None, ttl: int = None, similarity_threshold: float = None):
+        self.max_size = max_size or getattr(settings, 'AI_RESPONSE_CACHE_SIZE', 256)
+        self.ttl = ttl or getattr(settings, 'AI_RESPONSE_CACHE_TTL', 600)
+        # None 表示只做精确匹配
+        if similarity_threshold is None:
+            similarity_threshold = getattr(settings, 'AI_RESPONSE_CACHE_SIMILARITY', None)
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = HashingEmbedding() if similarity_threshold else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 共享缓存不可用时退回进程内的用户版本
+        self._local_user_versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        """规范化问题：全角转半角、小写、去掉标点和空白"""
+        text = unicodedata.normalize('NFKC', question or '').lower()
+        return re.sub(r'[^\u4e00-\u9fa5a-z0-9]+', '', text)
+
+    def is_cacheable(self, question: str) -> bool:
+        """判断问题能否使用缓存"""
+        normalized = self.normalize(question)
+        return bool(normalized) and not any(marker in normalized for marker in FOLLOW_UP_MARKERS)
+
+    def _user_version(self, user_id: Optional[int]) -> str:
+        local = self._local_user_versions.get(user_id, 0)
+        try:
+            version = shared_cache.get(USER_VERSION_CACHE_KEY % user_id)
+        except Exception as e:
+            print(f"⚠️ 读取用户回复缓存版本失败: {e}")
+            version = None
+        return f"{version or 0}.{local}"
+
+    def _key(self, normalized: str, version: str, user_id: Optional[int]):
+        # 回答里常有「今天」「本周」，日期变化后不能复用
+        return (normalized, user_id, version, self._user_version(user_id), timezone.localdate().isoformat())
+
+    def get(self, question: str, version: str, user_id: Optional[int] = None) -> Optional[str]:
+        """查找该用户的缓存，未命中返回 None"""
+        if not self.is_cacheable(question):
+            return None
+
+        normalized = self.normalize(question)
+        key = self._key(normalized, version, user_id)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.record_cache('ai_response', True)
+                return entry.response
+            if entry is not None:
+                del self._entries[key]
+
+            if self.embedding_model is not None:
+                response = self._similar_lookup(normalized, key, now)
+                if response is not None:
+                    self.hits += 1
+                    metrics.record_cache('ai_response', True)
+                    return response
+
+            self.misses += 1
+            metrics.record_cache('ai_response', False)
+            return None
+
+    def _similar_lookup(self, normalized: str, key, now: float) -> Optional[str]:
+        """在同一用户、同一数据版本的缓存中找最相近的问法（调用方持锁）"""
+        candidates = [
+            (entry_key, entry) for entry_key, entry in self._entries.items()
+            if entry_key[1:] == key[1:] and entry.expires_at > now and entry.embedding is not None
+        ]
+        if not candidates:
+            return None
+
+        query = self.embedding_model.encode(normalized)
+        scores = np.stack([entry.embedding for _, entry in candidates]) @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+
+        entry_key, entry = candidates[best]
+        self._entries.move_to_end(entry_key)
+        return entry.response
+
+    def set(self, question: str, version: str, response: str, user_id: Optional[int] = None):
+        """写入该用户的缓存"""
+        if not response or not self.is_cacheable(question):
+            return
+
+        normalized = self.normalize(question)
+        embedding = self.embedding_model.encode(normalized) if self.embedding_model is not None else None
+        entry = CachedResponse(
+            question=normalized,
+            response=response,
+            version=version,
+            expires_at=time.time() + self.ttl,
+            embedding=embedding
+        )
+
+        key = self._key(normalized, version, user_id)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: Optional[int] = None):
+        """使该用户的全部缓存回复失效（包括其它进程中的）"""
+        with self._lock:
+            self._local_user_versions[user_id] = self._local_user_versions.get(user_id, 0) + 1
+            for key in [key for key in self._entries if key[1] == user_id]:
+                del self._entries[key]
+        key = USER_VERSION_CACHE_KEY % user_id
+        try:
+            shared_cache.incr(key)
+        except ValueError:
+            # 键不存在
+            shared_cache.add(key, 1, None)
+        except Exception as e:
+            print(f"⚠️ 更新用户回复缓存版本失败: {e}")
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """命中统计"""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
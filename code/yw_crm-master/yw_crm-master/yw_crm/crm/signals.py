@@ -1,10 +1,16 @@
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from .models import PrintOrderFlat, OrderProgress
+from .data_version import bump_order_data_version
+from . import daily_rollup, metrics
+from .deadline_scheduler import notify_order_changed, get_stage_counts
 from django.utils import timezone
 import json
+import time
 
 
 def send_websocket_notification(group_name, notification_type, data):
@@ -20,16 +26,45 @@ def send_websocket_notification(group_name, notification_type, data):
                 'data': data
             }
             print(f"📨 发送消息: {message}")
+            start = time.perf_counter()
             async_to_sync(channel_layer.group_send)(group_name, message)
+            metrics.CHANNEL_SEND_SECONDS.labels(notification_type).observe(time.perf_counter() - start)
             print(f"✅ WebSocket通知发送成功: {notification_type}")
         else:
             print("❌ 通道层为空，无法发送WebSocket通知")
     except Exception as e:
+        metrics.CHANNEL_SEND_ERRORS.labels(notification_type).inc()
         print(f"❌ WebSocket通知发送失败: {e}")
         import traceback
         traceback.print_exc()
 
 
+def update_daily_rollup(before, after):
+    """
+    增量更新每日运营汇总：在事务提交后再累加，回滚的保存不会留下差值；
+    失败不影响保存（可用 rollup_daily_operations 命令重算）
+    """
+    def apply():
+        try:
+            daily_rollup.apply_change(before, after)
+        except Exception as e:
+            print(f"⚠️ 每日运营汇总更新失败: {e}")
+    
+    transaction.on_commit(apply)
+
+
+@receiver(pre_save, sender=PrintOrderFlat)
+def print_order_before_save(sender, instance, **kwargs):
+    """
+    记录保存前的委印日期、交期和状态，用于计算汇总差值和通知交期调度器
+    """
+    instance._rollup_before = None
+    if instance.pk and instance.detail_type is None:
+        instance._rollup_before = sender.objects.filter(pk=instance.pk).values(
+            'detail_type', 'order_date', 'delivery_date', 'status'
+        ).first()
+
+
 @receiver(post_save, sender=PrintOrderFlat)
 def print_order_updated(sender, instance, created, **kwargs):
     """
@@ -39,6 +74,19 @@ def print_order_updated(sender, instance, created, **kwargs):
     if instance.detail_type is not None:
         return
     
+    before = getattr(instance, '_rollup_before', None)
+    update_daily_rollup(
+        daily_rollup.order_contribution(before),
+        daily_rollup.order_contribution(daily_rollup.order_values(instance))
+    )
+    
+    # 交期或状态变化时通知交期调度器
+    if not before or before['delivery_date'] != instance.delivery_date or before['status'] != instance.status:
+        notify_order_changed(instance)
+    
+    # 使AI上下文/回复缓存失效
+    bump_order_data_version()
+    
     # 准备通知数据
     notification_data = {
         'order_id': instance.id,
@@ -77,6 +125,12 @@ def print_order_deleted(sender, instance, **kwargs):
     if instance.detail_type is not None:
         return
     
+    update_daily_rollup(daily_rollup.order_contribution(daily_rollup.order_values(instance)), {})
+    notify_order_changed(instance, deleted=True)
+    
+    # 使AI上下文/回复缓存失效
+    bump_order_data_version()
+    
     # 准备通知数据
     notification_data = {
         'order_id': instance.id,
@@ -102,6 +156,18 @@ def print_order_deleted(sender, instance, **kwargs):
     )
 
 
+@receiver(pre_save, sender=OrderProgress)
+def order_progress_before_save(sender, instance, **kwargs):
+    """
+    记录保存前的步骤状态、时间和所属订单类型，用于计算汇总差值
+    """
+    instance._rollup_before = None
+    if instance.pk:
+        instance._rollup_before = sender.objects.filter(pk=instance.pk).values(
+            'status', 'step_name', 'start_time', 'end_time', detail_type=F('order__detail_type')
+        ).first()
+
+
 @receiver(post_save, sender=OrderProgress)
 def order_progress_updated(sender, instance, created, **kwargs):
     """
@@ -110,6 +176,15 @@ def order_progress_updated(sender, instance, created, **kwargs):
     print(f"🔥 信号触发: OrderProgress {instance.id} ({instance.step_name}) - {'创建' if created else '更新'}")
     print(f"   订单: {instance.order.order_no}, 状态: {instance.status} ({instance.get_status_display()})")
     
+    # 步骤状态流转计入每日运营汇总
+    update_daily_rollup(
+        daily_rollup.step_contribution(getattr(instance, '_rollup_before', None)),
+        daily_rollup.step_contribution(daily_rollup.step_values(instance))
+    )
+    
+    # 使AI上下文/回复缓存失效
+    bump_order_data_version()
+    
     # 准备通知数据
     notification_data = {
         'progress_id': instance.id,
@@ -149,6 +224,11 @@ def order_progress_deleted(sender, instance, **kwargs):
     """
     当OrderProgress模型被删除时触发
     """
+    update_daily_rollup(daily_rollup.step_contribution(daily_rollup.step_values(instance)), {})
+    
+    # 使AI上下文/回复缓存失效
+    bump_order_data_version()
+    
     # 准备通知数据
     notification_data = {
         'progress_id': instance.id,
@@ -201,13 +281,17 @@ def calculate_dashboard_stats():
             order__status=2  # 订单处理中
         ).count()
         
-        # 获取需要紧急处理的订单数量
-        urgent_orders_count = PrintOrderFlat.objects.filter(
-            detail_type=None,
-            status__in=[1, 2],
-            delivery_date__isnull=False,
-            delivery_date__lte=timezone.now() + timedelta(days=3)  # 3天内到期
-        ).count()
+        # 获取需要紧急处理的订单数量（交期调度器在运行时直接读它发布的计数）
+        stage_counts = get_stage_counts()
+        if stage_counts is not None:
+            urgent_orders_count = stage_counts['urgent_total']
+        else:
+            urgent_orders_count = PrintOrderFlat.objects.filter(
+                detail_type=None,
+                status__in=[1, 2],
+                delivery_date__isnull=False,
+                delivery_date__lte=timezone.now() + timedelta(days=3)  # 3天内到期
+            ).count()
         
         return {
             'total_orders': total_orders,
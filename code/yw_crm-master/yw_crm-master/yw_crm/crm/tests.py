@@ -1,3 +1,1590 @@
-from django.test import TestCase
+import io
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.db import transaction
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+
+from crm import context_gathering, daily_rollup, deadline_scheduler
+from crm.ai_assistant import AIAssistant
+from crm.context_gathering import ContextSource, gather_context
+from crm.conversation_ai import OrderQueryTool, conversation_ai
+from crm.conversation_memory import ConversationFragment, ConversationMemory, HashingEmbedding, _EmbeddingIndex
+from crm.conversation_sessions import ConversationSessionStore
+from crm.data_version import VersionedLRUCache, bump_order_data_version, get_order_data_version
+from crm.deadline_scheduler import DeadlineScheduler, current_stage, notify_order_changed
+from crm.intent_router import IntentRouter, KeywordAutomaton
+from crm.llm_gateway import (
+    CircuitBreaker, LLMGateway, LLMBusyError, LLMCircuitOpenError, LLMRateLimitError,
+)
+from crm.memory_writer import ConversationWriteBehind
+from crm.middleware import websocket_auth_middleware
+from crm.middleware.crm_middleware import XSSFilter, XssMiddleware
+from crm.middleware.current_user_middleware import CurrentUserMiddleware
+from crm.middleware.instrumentation_middleware import InstrumentationMiddleware, sql_shape
+from crm.middleware.profiling_middleware import (
+    ProfilingMiddleware, list_profiles, load_profile, to_collapsed, to_speedscope,
+)
+from crm.models import DailyOperationRollup, DepartMent, OrderProgress, PrintOrderFlat, UserInfo
+from crm.prompt_builder import PromptBuilder, TokenCounter
+from crm.response_cache import ResponseCache
+from crm.utils import classify_user_agent, get_current_user, get_device_info, is_mobile_device, is_root_user
+from rbac.decorators import require_role
+from rbac.models import Role
+from utils import code
+import views
+
+
+class HashingEmbeddingTests(SimpleTestCase):
+    """哈希向量化：确定性、归一化、相近文本相似度更高"""
+
+    def setUp(self):
+        self.model = HashingEmbedding(dimension=256)
+
+    def test_shape_and_dtype(self):
+        matrix = self.model.encode_many(['今天的订单', '紧急订单'])
+        self.assertEqual(matrix.shape, (2, 256))
+        self.assertEqual(matrix.dtype, np.float32)
+
+    def test_deterministic(self):
+        first = HashingEmbedding(dimension=256).encode('查询订单 PO-1001 的进度')
+        second = HashingEmbedding(dimension=256).encode('查询订单 PO-1001 的进度')
+        np.testing.assert_array_equal(first, second)
+
+    def test_unit_norm(self):
+        vector = self.model.encode('本周完成了多少个步骤')
+        self.assertAlmostEqual(float(np.linalg.norm(vector)), 1.0, places=5)
+
+    def test_empty_text_is_zero_vector(self):
+        for text in ('', '！！？？', None):
+            self.assertFalse(self.model.encode(text).any())
+
+    def test_encode_matches_encode_many(self):
+        texts = ['印刷订单统计', '装订步骤进行中']
+        matrix = self.model.encode_many(texts)
+        for i, text in enumerate(texts):
+            np.testing.assert_allclose(self.model.encode(text), matrix[i])
+
+    def test_similar_texts_score_higher(self):
+        query = self.model.encode('今天有哪些紧急订单')
+        similar = self.model.encode('今天的紧急订单有哪些')
+        unrelated = self.model.encode('装订机维修记录')
+        self.assertGreater(float(query @ similar), float(query @ unrelated))
+
+    def test_keywords_drop_stop_words_and_punctuation(self):
+        self.assertEqual(self.model._extract_keywords('我的订单，很 急'), ['我的订单'])
+
+
+class EmbeddingIndexTests(SimpleTestCase):
+    """内存向量索引：按对话ID覆盖、扩容、top-k"""
+
+    def setUp(self):
+        self.model = HashingEmbedding(dimension=64)
+        self.index = _EmbeddingIndex(64, capacity=2)
+
+    def test_replaced_row_kept_once(self):
+        self.index.add(1, 'a', self.model.encode('紧急订单'))
+        self.index.add(2, 'b', self.model.encode('装订机维修'))
+        # INSERT OR REPLACE 后同一ID以新 rowid 再次同步
+        self.index.add(3, 'a', self.model.encode('紧急订单'))
+        self.assertEqual((self.index.size, self.index.last_rowid), (2, 3))
+        hits = self.index.search(self.model.encode('紧急订单'), 5, -1)
+        self.assertEqual(sorted(conversation_id for _, conversation_id in hits), ['a', 'b'])
+
+    def test_grows_and_skips_invalid_vectors(self):
+        for i in range(5):
+            self.index.add(i + 1, str(i), self.model.encode(f'订单 PO{i}'))
+        self.index.add(6, 'zero', np.zeros(64, dtype=np.float32))
+        self.index.add(7, 'other-dim', np.ones(32, dtype=np.float32))
+        self.assertEqual(self.index.size, 5)
+        self.assertGreaterEqual(self.index.matrix.shape[0], 5)
+
+    def test_top_k_sorted_and_thresholded(self):
+        for i, text in enumerate(['今天的紧急订单', '今天订单', '装订机维修']):
+            self.index.add(i + 1, text, self.model.encode(text))
+        hits = self.index.search(self.model.encode('今天的紧急订单'), 2, 0.05)
+        self.assertEqual([conversation_id for _, conversation_id in hits], ['今天的紧急订单', '今天订单'])
+        self.assertGreater(hits[0][0], hits[1][0])
+
+
+@override_settings(CONVERSATION_EMBEDDING_DIM=128)
+class ConversationMemoryTests(SimpleTestCase):
+    """对话记忆：批量写入、重复写入不重复命中、每线程连接、重新嵌入"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.db_path = os.path.join(directory, 'memory.db')
+        self.memory = ConversationMemory(db_path=self.db_path)
+
+    def test_rewritten_turn_retrieved_once(self):
+        turn = {'user_message': '今天有哪些紧急订单', 'ai_response': '有3个', 'user_id': 1,
+                'timestamp': '2026-01-01T10:00:00+08:00'}
+        self.memory.store_conversations_batch([turn])
+        self.memory.retrieve_relevant_conversations('紧急订单', user_id=1)
+        self.memory.store_conversations_batch([turn])
+        hits = self.memory.retrieve_relevant_conversations('紧急订单', user_id=1, limit=5)
+        self.assertEqual(len(hits), 1)
+
+    def test_users_are_isolated(self):
+        self.memory.store_conversations_batch([
+            {'user_message': '紧急订单', 'ai_response': '有3个', 'user_id': 1},
+            {'user_message': '紧急订单', 'ai_response': '有5个', 'user_id': 2},
+        ])
+        hits = self.memory.retrieve_relevant_conversations('紧急订单', user_id=2, limit=5)
+        self.assertEqual([fragment.ai_response for fragment in hits], ['有5个'])
+        self.assertEqual(len(self.memory.retrieve_relevant_conversations('紧急订单', limit=5)), 2)
+
+    def test_each_thread_has_own_wal_connection(self):
+        connections = {}
+
+        def worker():
+            connections['worker'] = self.memory._get_connection()
+            self.memory.store_conversation('装订进度', '已完成', user_id=1)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        main = self.memory._get_connection()
+        self.assertIsNot(main, connections['worker'])
+        self.assertIs(main, self.memory._get_connection())
+        self.assertEqual(main.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(len(self.memory.retrieve_relevant_conversations('装订进度', user_id=1)), 1)
+
+    def test_reembed_command_updates_dimension(self):
+        self.memory.store_conversation('今天的紧急订单', '有3个', user_id=1)
+        with override_settings(CONVERSATION_EMBEDDING_DIM=256):
+            call_command('reembed_conversations', db_path=self.db_path, batch_size=1, stdout=io.StringIO())
+            memory = ConversationMemory(db_path=self.db_path)
+            blob = memory._get_connection().execute('SELECT embedding FROM conversations').fetchone()[0]
+            self.assertEqual(len(blob), 256 * 4)
+            self.assertEqual(len(memory.retrieve_relevant_conversations('紧急订单', user_id=1)), 1)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@override_settings(CONVERSATION_EMBEDDING_DIM=128)
+class ConversationWriteBehindTests(SimpleTestCase):
+    """对话记忆写入队列：攒批、按时间落盘、排空、写入失败不影响后续批次"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.memory = ConversationMemory(db_path=os.path.join(directory, 'memory.db'))
+
+    def rows(self):
+        return self.memory._get_connection().execute(
+            'SELECT user_id, user_message, context_type FROM conversations ORDER BY user_message'
+        ).fetchall()
+
+    def test_batches_and_drains_on_shutdown(self):
+        writer = ConversationWriteBehind(self.memory, lambda question, answer: 'order_query',
+                                         batch_size=2, flush_interval=60)
+        for i in range(3):
+            writer.submit(f'问题{i}', f'回答{i}', user_id=1)
+        # 满一批立即落盘，剩下的一条等待时间阈值
+        self.assertTrue(wait_for(lambda: writer.written == 2))
+        self.assertEqual(len(self.rows()), 2)
+
+        writer.drain()
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(self.rows(), [(1, f'问题{i}', 'order_query') for i in range(3)])
+
+    def test_flushes_after_interval(self):
+        writer = ConversationWriteBehind(self.memory, batch_size=100, flush_interval=0.05)
+        self.addCleanup(writer.drain)
+        writer.submit('问题', '回答', user_id=2)
+        self.assertTrue(wait_for(lambda: writer.written == 1))
+        self.assertEqual(self.rows(), [(2, '问题', 'general')])
+
+    def test_calls_run_before_batch(self):
+        order = []
+        writer = ConversationWriteBehind(self.memory, batch_size=100, flush_interval=60)
+        writer.submit('问题', '回答')
+        writer.submit_call(lambda: order.append(len(self.rows())))
+        writer.drain()
+        self.assertEqual((order, len(self.rows())), ([0], 1))
+
+    def test_failed_batch_does_not_stop_writer(self):
+        memory = mock.Mock()
+        memory.store_conversations_batch.side_effect = [RuntimeError('disk full'), None]
+        writer = ConversationWriteBehind(memory, batch_size=1, flush_interval=60)
+        writer.submit_call(mock.Mock(side_effect=RuntimeError('summary failed')))
+        writer.submit('问题1', '回答1')
+        writer.submit('问题2', '回答2')
+        writer.drain()
+        self.assertEqual((memory.store_conversations_batch.call_count, writer.written), (2, 1))
+
+    def test_drain_without_writes_is_noop(self):
+        writer = ConversationWriteBehind(self.memory)
+        writer.drain()
+        self.assertIsNone(writer._thread)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    """AI回复缓存：按用户、数据版本和日期隔离"""
+
+    def setUp(self):
+        self.cache = ResponseCache(max_size=3, ttl=60, similarity_threshold=0)
+
+    def test_hit_after_set_with_normalized_question(self):
+        self.cache.set('今天有多少订单？', 'v1', '12个', user_id=1)
+        self.assertEqual(self.cache.get('今天 有多少订单', 'v1', user_id=1), '12个')
+
+    def test_not_shared_between_users(self):
+        self.cache.set('我的订单有哪些', 'v1', '用户1的订单', user_id=1)
+        self.assertIsNone(self.cache.get('我的订单有哪些', 'v1', user_id=2))
+        self.assertIsNone(self.cache.get('我的订单有哪些', 'v1'))
+        self.assertEqual(self.cache.get('我的订单有哪些', 'v1', user_id=1), '用户1的订单')
+
+    def test_similar_lookup_stays_within_user(self):
+        cache = ResponseCache(max_size=10, ttl=60, similarity_threshold=0.5)
+        cache.set('今天有哪些紧急订单', 'v1', '用户1的急单', user_id=1)
+        self.assertEqual(cache.get('今天的紧急订单有哪些', 'v1', user_id=1), '用户1的急单')
+        self.assertIsNone(cache.get('今天的紧急订单有哪些', 'v1', user_id=2))
+
+    def test_data_version_change_misses(self):
+        self.cache.set('订单统计', 'v1', '旧数据', user_id=1)
+        self.assertIsNone(self.cache.get('订单统计', 'v2', user_id=1))
+
+    def test_date_change_misses(self):
+        self.cache.set('今天的订单', 'v1', '回答', user_id=1)
+        with mock.patch('crm.response_cache.timezone.localdate') as localdate:
+            localdate.return_value.isoformat.return_value = '2099-01-01'
+            self.assertIsNone(self.cache.get('今天的订单', 'v1', user_id=1))
+
+    def test_expired_entry_misses(self):
+        self.cache.set('订单统计', 'v1', '回答', user_id=1)
+        with mock.patch('crm.response_cache.time.time', return_value=10 ** 12):
+            self.assertIsNone(self.cache.get('订单统计', 'v1', user_id=1))
+
+    def test_follow_up_questions_not_cached(self):
+        self.cache.set('刚才那个订单呢', 'v1', '回答', user_id=1)
+        self.assertIsNone(self.cache.get('刚才那个订单呢', 'v1', user_id=1))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_invalidate_user_drops_only_that_user(self):
+        self.cache.set('订单统计', 'v1', '用户1', user_id=1)
+        self.cache.set('订单统计', 'v1', '用户2', user_id=2)
+        self.cache.invalidate_user(1)
+        self.assertIsNone(self.cache.get('订单统计', 'v1', user_id=1))
+        self.assertEqual(self.cache.get('订单统计', 'v1', user_id=2), '用户2')
+        self.cache.set('订单统计', 'v1', '新回答', user_id=1)
+        self.assertEqual(self.cache.get('订单统计', 'v1', user_id=1), '新回答')
+
+    def test_invalidate_user_reaches_other_processes(self):
+        # 另一个进程中的缓存实例：只通过共享缓存中的用户版本得知失效
+        other = ResponseCache(max_size=3, ttl=60, similarity_threshold=0)
+        other.set('订单统计', 'v1', '旧回答', user_id=1)
+        self.cache.invalidate_user(1)
+        self.assertIsNone(other.get('订单统计', 'v1', user_id=1))
+
+    def test_clear_history_invalidates_cached_answers(self):
+        conversation_ai.response_cache.set('订单统计', 'v1', '旧回答', user_id=7)
+        with mock.patch.object(conversation_ai, 'memory', None):
+            conversation_ai.clear_history(7)
+        self.assertIsNone(conversation_ai.response_cache.get('订单统计', 'v1', user_id=7))
+
+    def test_evicts_least_recently_used(self):
+        for i in range(3):
+            self.cache.set(f'问题{i}', 'v1', f'回答{i}', user_id=1)
+        self.cache.get('问题0', 'v1', user_id=1)
+        self.cache.set('问题3', 'v1', '回答3', user_id=1)
+        self.assertEqual(self.cache.get('问题0', 'v1', user_id=1), '回答0')
+        self.assertIsNone(self.cache.get('问题1', 'v1', user_id=1))
+
+
+class FakeLLM:
+    """测试用模型：可设置为失败，或阻塞到 release 事件"""
+
+    def __init__(self, fail=False, delay=0):
+        self.fail = fail
+        self.delay = delay
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+    def invoke(self, messages):
+        self.entered.set()
+        if self.delay:
+            self.release.wait(self.delay)
+        if self.fail:
+            raise RuntimeError('upstream error')
+        return 'ok'
+
+    async def ainvoke(self, messages):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('upstream error')
+        return 'ok'
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """熔断器：连续失败打开，冷却后只放行一次试探"""
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=30)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(LLMCircuitOpenError):
+            breaker.before_call()
+
+    def test_half_open_allows_single_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+        breaker.record_failure()
+        with mock.patch('crm.llm_gateway.time.time', return_value=breaker.opened_at + 31):
+            self.assertEqual(breaker.state, 'half_open')
+            breaker.before_call()
+            with self.assertRaises(LLMCircuitOpenError):
+                breaker.before_call()
+            breaker.release_trial()
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=30)
+        for _ in range(3):
+            breaker.record_failure()
+        opened_at = breaker.opened_at
+        with mock.patch('crm.llm_gateway.time.time', return_value=opened_at + 31):
+            breaker.before_call()
+            breaker.record_failure()
+            self.assertEqual(breaker.opened_at, opened_at + 31)
+            self.assertEqual(breaker.state, 'open')
+
+
+@override_settings(LLM_MAX_CONCURRENCY=1, LLM_MAX_QUEUE=1, LLM_QUEUE_TIMEOUT=2,
+                   LLM_USER_RATE_PER_MINUTE=2, LLM_BREAKER_FAILURES=2, LLM_BREAKER_COOLDOWN=30)
+class LLMGatewayTests(SimpleTestCase):
+    """大模型网关：按用户限流、熔断、排队背压和异步唤醒"""
+
+    def test_rate_limit_per_user(self):
+        gateway = LLMGateway(FakeLLM())
+        gateway.invoke([], user_id=1)
+        gateway.invoke([], user_id=1)
+        with self.assertRaises(LLMRateLimitError):
+            gateway.invoke([], user_id=1)
+        self.assertEqual(gateway.invoke([], user_id=2), 'ok')
+        self.assertEqual(gateway.stats()['rejected']['rate_limited'], 1)
+
+    def test_upstream_failures_open_circuit(self):
+        gateway = LLMGateway(FakeLLM(fail=True))
+        for user_id in (1, 2):
+            with self.assertRaises(RuntimeError):
+                gateway.invoke([], user_id=user_id)
+        with self.assertRaises(LLMCircuitOpenError):
+            gateway.invoke([], user_id=3)
+        stats = gateway.stats()
+        self.assertEqual(stats['circuit'], 'open')
+        self.assertEqual(stats['failed_calls'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_circuit_rejection_refunds_rate_quota(self):
+        gateway = LLMGateway(FakeLLM())
+        gateway.breaker.opened_at = 10 ** 12
+        for _ in range(3):
+            with self.assertRaises(LLMCircuitOpenError):
+                gateway.invoke([], user_id=1)
+        gateway.breaker.record_success()
+        gateway.invoke([], user_id=1)
+        gateway.invoke([], user_id=1)
+
+    def test_full_queue_rejects_and_refunds(self):
+        llm = FakeLLM(delay=5)
+        gateway = LLMGateway(llm)
+        gateway.max_queue = 0
+        worker = threading.Thread(target=gateway.invoke, args=([], 1))
+        worker.start()
+        llm.entered.wait(2)
+        try:
+            with self.assertRaises(LLMBusyError):
+                gateway.invoke([], user_id=2)
+        finally:
+            llm.release.set()
+            worker.join()
+        self.assertEqual(gateway.stats()['rejected']['busy'], 1)
+        # 被拒绝的调用不占用户额度
+        gateway.invoke([], user_id=2)
+        gateway.invoke([], user_id=2)
+
+    def test_async_waiter_woken_on_release(self):
+        gateway = LLMGateway(FakeLLM(delay=0.05))
+
+        async def run():
+            return await asyncio.gather(gateway.ainvoke([], user_id=1), gateway.ainvoke([], user_id=2))
+
+        self.assertEqual(asyncio.run(run()), ['ok', 'ok'])
+        stats = gateway.stats()
+        self.assertEqual(stats['total_calls'], 2)
+        self.assertEqual(stats['rejected']['busy'], 0)
+        self.assertLess(stats['queue_wait_max'], 1)
+
+
+class KeywordAutomatonTests(SimpleTestCase):
+    """Aho–Corasick 自动机：重叠匹配与最左最长选择"""
+
+    def setUp(self):
+        self.automaton = KeywordAutomaton()
+        for keyword in ('he', 'she', 'his', 'hers'):
+            self.automaton.add(keyword, keyword)
+        self.automaton.build()
+
+    def test_find_all_reports_overlapping_matches(self):
+        hits = {(start, end, payload) for start, end, payload in self.automaton.find_all('ushers')}
+        self.assertEqual(hits, {(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')})
+
+    def test_find_selects_leftmost_longest_without_overlap(self):
+        self.assertEqual(self.automaton.find('ushers'), [(1, 4, 'she')])
+        self.assertEqual(self.automaton.find('hershis'), [(0, 4, 'hers'), (4, 7, 'his')])
+
+    def test_first_payload_wins(self):
+        automaton = KeywordAutomaton()
+        automaton.add('完成', ('status', 3))
+        automaton.add('完成', ('step', '完成'))
+        automaton.add('', ('filler', True))
+        automaton.build()
+        self.assertEqual(len(automaton), 1)
+        self.assertEqual(automaton.find('已完成'), [(1, 3, ('status', 3))])
+
+
+class IntentRouterTests(SimpleTestCase):
+    """意图路由：静态词表 + 固定的数据词表，不访问数据库"""
+
+    def setUp(self):
+        self.router = IntentRouter(order_tool=None, max_residual=1)
+        dynamic_terms = [('印刷', ('step', '印刷')), ('华东印务有限公司', ('customer', '华东印务有限公司')),
+                         ('华东', ('customer', '华东')), ('张三', ('salesman', '张三'))]
+        patcher = mock.patch.object(IntentRouter, '_load_dynamic_terms', return_value=dynamic_terms)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_date_and_status_slots(self):
+        routed = self.router.route('近7天完成的订单')
+        self.assertEqual(routed.intent, 'orders')
+        self.assertEqual(routed.slots['days'], 7)
+        self.assertEqual(routed.slots['status'], 3)
+
+    def test_step_query(self):
+        routed = self.router.route('印刷中的订单有哪些')
+        self.assertEqual(routed.intent, 'steps')
+        self.assertEqual(routed.slots['step'], '印刷')
+        self.assertEqual(routed.slots['status'], 2)
+
+    def test_customer_and_salesman(self):
+        routed = self.router.route('张三负责的华东本周的订单')
+        self.assertEqual(routed.slots['salesman'], '张三')
+        self.assertEqual(routed.slots['customer'], '华东')
+        self.assertEqual(routed.slots['date'], 'week')
+
+    def test_order_number_keeps_original_case(self):
+        routed = self.router.route('PO20250101 详情')
+        self.assertEqual(routed.intent, 'order_detail')
+        self.assertEqual(routed.slots['order_no'], 'PO20250101')
+
+    def test_reasoning_question_deferred_unless_degraded(self):
+        self.assertIsNone(self.router.route('为什么订单逾期了'))
+        routed = self.router.route('为什么订单逾期了', strict=False)
+        self.assertEqual(routed.slots['urgent'], 'overdue')
+
+    def test_unrecognized_text_deferred(self):
+        self.assertIsNone(self.router.route('帮我写一封给客户的道歉信'))
+        self.assertIsNone(self.router.route(''))
+
+    def test_compile_urgent_filters(self):
+        filters = self.router.compile_order_filters({'urgent': 'overdue', 'status': 3})
+        self.assertEqual(filters['status__in'], [1, 2])
+        self.assertIn('delivery_date__lt', filters)
+        self.assertNotIn('status', filters)
+
+    def test_delivery_week_looks_forward(self):
+        routed = self.router.route('本周要交货的订单')
+        start, end = self.router._date_bounds(routed.slots)
+        self.assertEqual((end - start).days, 7)
+        filters = self.router.compile_order_filters(routed.slots)
+        self.assertIn('delivery_date__date__gte', filters)
+
+
+class DeadlineSchedulerTests(SimpleTestCase):
+    """交期调度器：阶段判断、堆的到点弹出和失效元素"""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.scheduler = DeadlineScheduler(resync_interval=600)
+
+    def order(self, order_id=1, days=4.0, status=1):
+        return {'id': order_id, 'order_no': f'PO{order_id:05d}', 'product_name': '画册', 'customer_name': '华东',
+                'status': status, 'delivery_date': self.now + timedelta(days=days)}
+
+    def test_current_stage(self):
+        self.assertIsNone(current_stage(self.now + timedelta(days=5), self.now))
+        self.assertEqual(current_stage(self.now + timedelta(days=2), self.now), 'urgent')
+        self.assertEqual(current_stage(self.now - timedelta(minutes=1), self.now), 'overdue')
+
+    def test_new_urgent_order_alerts_immediately(self):
+        self.assertEqual(self.scheduler.schedule(self.order(days=2), self.now), ['urgent'])
+        self.assertEqual(self.scheduler.schedule(self.order(order_id=2, days=2), self.now, emit_crossing=False), [])
+
+    def test_closed_orders_not_tracked(self):
+        self.scheduler.schedule(self.order(), self.now)
+        self.scheduler.schedule(self.order(status=3), self.now)
+        self.assertNotIn(1, self.scheduler.orders)
+        self.assertEqual(self.scheduler.pop_due(time.time() + 10 * 86400), [])
+
+    def test_pop_due_reports_most_severe_stage(self):
+        self.scheduler.schedule(self.order(days=4), self.now)
+        self.assertEqual(self.scheduler.pop_due(self.now.timestamp()), [])
+        due = self.scheduler.pop_due((self.now + timedelta(days=1, hours=1)).timestamp())
+        self.assertEqual([(order['id'], stage) for order, stage in due], [(1, 'urgent')])
+        due = self.scheduler.pop_due((self.now + timedelta(days=5)).timestamp())
+        self.assertEqual([(order['id'], stage) for order, stage in due], [(1, 'overdue')])
+        self.assertEqual(self.scheduler.stage_counts()['overdue'], 1)
+
+    def test_midnight_delivery_date_becomes_overdue(self):
+        # 只填日期的交期保存为当地 00:00，today 与 overdue 阈值相同
+        midnight = timezone.localtime(self.now).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=5)
+        order = dict(self.order(), delivery_date=midnight)
+        self.scheduler.schedule(order, self.now)
+        self.assertEqual(current_stage(midnight, midnight), 'overdue')
+
+        due = self.scheduler.pop_due(midnight.timestamp())
+        self.assertEqual([(order['id'], stage) for order, stage in due], [(1, 'overdue')])
+        counts = self.scheduler.stage_counts()
+        self.assertEqual((counts['today'], counts['overdue']), (0, 1))
+
+    def test_rescheduled_order_drops_stale_thresholds(self):
+        self.scheduler.schedule(self.order(days=4), self.now)
+        self.scheduler.schedule(self.order(days=20), self.now)
+        self.assertEqual(self.scheduler.pop_due((self.now + timedelta(days=5)).timestamp()), [])
+        self.assertGreater(self.scheduler.next_due_in(), 0)
+
+    def test_earlier_deadline_escalates(self):
+        self.scheduler.schedule(self.order(days=2), self.now)
+        self.assertEqual(self.scheduler.schedule(self.order(days=2), self.now), [])
+        self.assertEqual(self.scheduler.schedule(self.order(days=-1), self.now), ['overdue'])
+
+    def test_stage_counts_include_all_urgent_stages(self):
+        self.scheduler.schedule(self.order(1, days=2), self.now)
+        self.scheduler.schedule(self.order(2, days=-1), self.now)
+        self.scheduler.schedule(self.order(3, days=10), self.now)
+        counts = self.scheduler.stage_counts()
+        self.assertEqual((counts['urgent'], counts['overdue'], counts['urgent_total'], counts['tracked']), (1, 1, 2, 3))
+
+
+class NotifyOrderChangedTests(SimpleTestCase):
+    """只有调度器心跳有效时才向调度器通道发送"""
+
+    def setUp(self):
+        self.instance = SimpleNamespace(id=1, order_no='PO00001', product_name='画册', customer_name='华东',
+                                        status=1, delivery_date=timezone.now())
+        self.channel_layer = mock.Mock()
+        self.channel_layer.send = mock.AsyncMock()
+        patcher = mock.patch.object(deadline_scheduler, 'get_channel_layer', return_value=self.channel_layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_skipped_without_heartbeat(self):
+        with mock.patch.object(deadline_scheduler, 'get_stage_counts', return_value=None):
+            notify_order_changed(self.instance)
+        self.channel_layer.send.assert_not_called()
+
+    def test_sent_while_scheduler_running(self):
+        with mock.patch.object(deadline_scheduler, 'get_stage_counts', return_value={'updated_at': time.time()}):
+            notify_order_changed(self.instance, deleted=True)
+        channel, message = self.channel_layer.send.call_args.args
+        self.assertEqual(channel, deadline_scheduler.SCHEDULER_CHANNEL)
+        self.assertEqual((message['order_id'], message['deleted']), (1, True))
+
+
+def legacy_is_mobile(user_agent, accept=''):
+    """改写前 is_mobile_device 的逐个子串判断，用于对照"""
+    user_agent = user_agent.lower()
+    for agent in ('windows nt', 'win64', 'win32', 'x86_64', 'amd64', 'macintosh', 'mac os x', 'intel mac',
+                  'linux', 'x11', 'ubuntu', 'fedora', 'centos'):
+        if agent in user_agent and 'mobile' not in user_agent and 'mobi' not in user_agent:
+            return False
+    for agent in ('android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone', 'mobile', 'mobi', 'samsung',
+                  'huawei', 'xiaomi', 'oppo', 'vivo', 'oneplus', 'nokia', 'motorola', 'lg', 'htc', 'sony', 'meizu',
+                  'lenovo', 'tablet', 'kindle', 'silk', 'opera mini', 'opera mobi', 'webos', 'palm', 'symbian',
+                  'fennec', 'maemo'):
+        if agent in user_agent:
+            return True
+    if 'application/vnd.wap.xhtml+xml' in accept:
+        return True
+    return 'screen' in user_agent and any(size in user_agent for size in ('320x', '240x', '176x', '128x'))
+
+
+class UserAgentClassificationTests(SimpleTestCase):
+    """设备分类：与改写前的判断结果一致，并识别平板和浏览器"""
+
+    USER_AGENTS = [
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36 Edg/120.0',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+        'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (Linux; Android 11; SM-G991B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0 Mobile Safari/537.36',
+        'Mozilla/5.0 (Linux; Android 10; HUAWEI P30) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0 Mobile Safari/537.36 MicroMessenger/8.0.40',
+        'Mozilla/5.0 (Linux; Android 12; SM-T870) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0 Safari/537.36',
+        'Mozilla/5.0 (iPad; CPU OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1',
+        'Opera/9.80 (J2ME/MIDP; Opera Mini/9.80) Presto/2.5.25 Version/10.54',
+        'Nokia6300/2.0 Profile/MIDP-2.0 screen 240x320',
+        'SomeDevice/1.0 screen 320x480',
+        'curl/8.4.0',
+        '',
+    ]
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_matches_legacy_detection(self):
+        for user_agent in self.USER_AGENTS:
+            for accept in ('text/html', 'application/vnd.wap.xhtml+xml'):
+                request = self.factory.get('/', HTTP_USER_AGENT=user_agent, HTTP_ACCEPT=accept)
+                with self.subTest(user_agent=user_agent, accept=accept):
+                    self.assertEqual(is_mobile_device(request), legacy_is_mobile(user_agent, accept))
+
+    def test_form_factor_and_browser(self):
+        ua = self.USER_AGENTS
+        self.assertEqual(classify_user_agent(ua[0]), ('desktop', 'desktop', 'chrome'))
+        self.assertEqual(classify_user_agent(ua[1]).browser, 'edge')
+        self.assertEqual(classify_user_agent(ua[3]).browser, 'firefox')
+        self.assertEqual(classify_user_agent(ua[4]), ('mobile', 'mobile', 'safari'))
+        self.assertEqual(classify_user_agent(ua[6]).browser, 'wechat')
+        # 不带 Mobile 的安卓平板 UA 含 Linux，与改写前一样按桌面端处理
+        self.assertEqual(classify_user_agent(ua[7]).device_type, 'desktop')
+        self.assertEqual(classify_user_agent(ua[8]).form_factor, 'tablet')
+        self.assertEqual(classify_user_agent(ua[12]), ('desktop', 'desktop', 'other'))
+
+    def test_classified_once_per_request(self):
+        request = self.factory.get('/', HTTP_USER_AGENT=self.USER_AGENTS[4])
+        info = get_device_info(request)
+        request.META['HTTP_USER_AGENT'] = self.USER_AGENTS[0]
+        self.assertIs(get_device_info(request), info)
+        self.assertTrue(is_mobile_device(request))
+
+
+class XSSFilterTests(SimpleTestCase):
+    """XSS过滤：只删除含可疑内容的 <script>，其余内容按字节原样保留"""
+
+    def setUp(self):
+        self.xss_filter = XSSFilter()
+
+    def test_removes_suspicious_script(self):
+        content = '<body><p>订单</p><SCRIPT type="text/javascript">alert(1)</Script ><p>完</p></body>'.encode('utf-8')
+        self.assertEqual(self.xss_filter.process_bytes(content), '<body><p>订单</p><p>完</p></body>'.encode('utf-8'))
+
+    def test_keeps_benign_script(self):
+        content = b'<script src="/static/js/app.js"></script><script>init();</script>'
+        self.assertIs(self.xss_filter.process_bytes(content), content)
+
+    def test_unclosed_script_removed_to_end(self):
+        self.assertEqual(self.xss_filter.process_bytes(b'<p>a</p><script>alert(1)'), b'<p>a</p>')
+
+    def test_page_without_script_returned_as_is(self):
+        content = '<p>没有脚本</p>'.encode('gbk')
+        self.assertIs(self.xss_filter.process_bytes(content), content)
+
+    def test_text_api(self):
+        self.assertEqual(self.xss_filter.process('<div>交期<script>alert("x")</script></div>'), '<div>交期</div>')
+
+
+class XssMiddlewareTests(SimpleTestCase):
+    """XSS中间件：只处理非流式 text/html，状态码和响应头不变"""
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+
+    def run_middleware(self, response):
+        return XssMiddleware(lambda request: response)(self.request)
+
+    def test_filters_html_and_keeps_status_and_headers(self):
+        response = HttpResponse('<p>x</p><script>alert(1)</script>', status=404)
+        response['X-Custom'] = '1'
+        response['Content-Length'] = str(len(response.content))
+        result = self.run_middleware(response)
+        self.assertEqual(result.status_code, 404)
+        self.assertEqual(result['X-Custom'], '1')
+        self.assertEqual(result.content, b'<p>x</p>')
+        self.assertEqual(result['Content-Length'], '8')
+
+    def test_skips_non_html_and_encoded_responses(self):
+        payload = '<script>alert(1)</script>'
+        json_response = JsonResponse({'html': payload})
+        self.assertIn(b'alert', self.run_middleware(json_response).content)
+        gzipped = HttpResponse(b'\x1f\x8b<script>alert(1)</script>', content_type='text/html')
+        gzipped['Content-Encoding'] = 'gzip'
+        self.assertIn(b'alert', self.run_middleware(gzipped).content)
+
+    def test_streaming_response_untouched(self):
+        chunks = [b'data: <script>alert(1)</script>\n\n']
+        response = StreamingHttpResponse(iter(chunks), content_type='text/html')
+        result = self.run_middleware(response)
+        self.assertEqual(b''.join(result.streaming_content), chunks[0])
+
+
+class SqlShapeTests(SimpleTestCase):
+    """SQL形状：去掉字面量后同一语句的不同参数归为一类"""
+
+    def test_literals_replaced(self):
+        self.assertEqual(
+            sql_shape("SELECT * FROM crm_order WHERE id = 12 AND name = 'O''Brien'  AND price > 3.5"),
+            'SELECT * FROM crm_order WHERE id = ? AND name = ? AND price > ?'
+        )
+
+    def test_in_lists_collapsed(self):
+        self.assertEqual(sql_shape('SELECT 1 FROM t WHERE id IN (%s, %s, %s)'), sql_shape('SELECT 1 FROM t WHERE id IN (%s)'))
+        self.assertEqual(sql_shape('SELECT 1 FROM t WHERE id IN (?, ?)'), 'SELECT ? FROM t WHERE id IN (...)')
+
+    def test_identifiers_with_digits_kept(self):
+        self.assertEqual(sql_shape('SELECT "t1"."col2" FROM t1'), 'SELECT "t1"."col2" FROM t1')
+
+
+def run_query():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    return 1
+
+
+class InstrumentationMiddlewareTests(SimpleTestCase):
+    """请求SQL统计：同步/异步请求，以及其它线程中执行的查询"""
+
+    databases = {'default'}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    @staticmethod
+    def query_count(response):
+        return int(response['Server-Timing'].split('desc="')[1].split(' ')[0])
+
+    def test_sync_request_counts_pool_queries(self):
+        def view(request):
+            run_query()
+            gather_context({'pooled': ContextSource(run_query, 5, None)})
+            return HttpResponse('ok')
+
+        response = InstrumentationMiddleware(view)(self.factory.get('/sync/'))
+        self.assertEqual(self.query_count(response), 2)
+
+    def test_async_request_counts_queries_in_worker_threads(self):
+        async def view(request):
+            await database_sync_to_async(run_query)()
+            await database_sync_to_async(run_query, thread_sensitive=False)()
+            return HttpResponse('ok')
+
+        middleware = InstrumentationMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(self.factory.get('/async/')))
+        self.assertEqual(self.query_count(response), 2)
+
+    def test_queries_outside_request_not_counted(self):
+        def view(request):
+            return HttpResponse('ok')
+
+        run_query()
+        response = InstrumentationMiddleware(view)(self.factory.get('/idle/'))
+        self.assertEqual(self.query_count(response), 0)
+
+
+def busy_view(request):
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    return HttpResponse('ok')
+
+
+class ProfilingMiddlewareTests(SimpleTestCase):
+    """采样性能分析：关闭时不加载，同步/异步请求的采样与火焰图导出"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir, True)
+        override = override_settings(
+            PROFILING_ENABLED=True, PROFILING_DIR=self.profile_dir, PROFILING_PATH_PATTERNS=[r'^/busy/'],
+            PROFILING_SAMPLE_RATE=1.0, PROFILING_INTERVAL=0.001,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def make_request(self, path='/busy/'):
+        request = self.factory.get(path)
+        request.session = {}
+        return request
+
+    @override_settings(PROFILING_ENABLED=False)
+    def test_not_used_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(busy_view)
+
+    def test_unselected_request_not_profiled(self):
+        ProfilingMiddleware(busy_view)(self.make_request('/other/'))
+        self.assertEqual(list_profiles(), [])
+
+    def test_sync_request_samples_own_thread(self):
+        response = ProfilingMiddleware(busy_view)(self.make_request())
+        self.assertEqual(response.content, b'ok')
+        profile = load_profile(list_profiles()[0])
+        self.assertEqual((profile['path'], profile['scope'], profile['status']), ('/busy/', 'thread', 200))
+        self.assertGreater(profile['samples'], 0)
+        self.assertTrue(any('busy_view' in stack for stack in profile['stacks']))
+
+    def test_async_chain_stays_async(self):
+        async def view(request):
+            await asyncio.sleep(0.02)
+            return HttpResponse('ok')
+
+        middleware = ProfilingMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(self.make_request()))
+        self.assertEqual(response.content, b'ok')
+        self.assertEqual(len(list_profiles()), 1)
+
+    def test_async_streaming_profiled_until_body_sent(self):
+        async def chunks():
+            yield b'a'
+            yield b'b'
+
+        async def view(request):
+            return StreamingHttpResponse(chunks())
+
+        response = asyncio.run(ProfilingMiddleware(view)(self.make_request()))
+        self.assertEqual(list_profiles(), [])
+
+        async def consume():
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(asyncio.run(consume()), b'ab')
+        self.assertEqual(len(list_profiles()), 1)
+
+    def test_flamegraph_exports(self):
+        profile = {'method': 'GET', 'path': '/busy/', 'view': 'busy', 'scope': 'process', 'interval_ms': 2.0,
+                   'stacks': {'thread main;view;query': 3, 'thread main;view': 1}}
+        self.assertEqual(to_collapsed(profile), 'thread main;view;query 3\nthread main;view 1\n')
+
+        speedscope = to_speedscope(profile)
+        frames = [frame['name'] for frame in speedscope['shared']['frames']]
+        self.assertEqual(frames, ['thread main', 'view', 'query'])
+        sampled = speedscope['profiles'][0]
+        self.assertEqual(sampled['samples'], [[0, 1, 2], [0, 1]])
+        self.assertEqual((sampled['weights'], sampled['endValue']), ([6.0, 2.0], 8.0))
+        self.assertTrue(sampled['name'].endswith('[进程内所有线程]'))
+
+    def test_rotation_keeps_newest_files(self):
+        with override_settings(PROFILING_MAX_FILES=2):
+            for _ in range(3):
+                ProfilingMiddleware(busy_view)(self.make_request())
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+
+class DailyRollupTests(TestCase):
+    """每日运营汇总：信号增量累加、按原始数据重算，两者结果一致"""
+
+    def setUp(self):
+        self.day = timezone.localdate() - timedelta(days=3)
+        self.noon = timezone.make_aware(datetime.combine(self.day, datetime.min.time())) + timedelta(hours=12)
+
+    def create_order(self, order_no='PO00001', **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return PrintOrderFlat.objects.create(order_no=order_no, order_date=self.noon, **kwargs)
+
+    def save(self, instance, **fields):
+        for name, value in fields.items():
+            setattr(instance, name, value)
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save()
+        return instance
+
+    def row(self, step_name=daily_rollup.ORDER_ROW):
+        return DailyOperationRollup.objects.get(date=self.day, step_name=step_name)
+
+    def test_apply_change_accumulates_deltas(self):
+        key = (self.day, '印刷')
+        daily_rollup.apply_change({}, {key: {'steps_started': 1}})
+        daily_rollup.apply_change({}, {key: {'steps_completed': 1, 'duration_seconds': 600}})
+        daily_rollup.apply_change({}, {key: {'steps_completed': 1, 'duration_seconds': 300}})
+        # 完成改回进行中：扣掉之前的贡献，最长耗时保持不变
+        daily_rollup.apply_change({key: {'steps_completed': 1, 'duration_seconds': 300}}, {})
+        row = self.row('印刷')
+        self.assertEqual((row.steps_started, row.steps_completed, row.duration_seconds, row.duration_max_seconds),
+                         (1, 1, 600, 600))
+
+    def test_step_transitions_update_rollup(self):
+        order = self.create_order()
+        self.assertEqual(self.row().orders_created, 1)
+
+        step = self.save(OrderProgress(order=order, step_name='印刷', step_order=1), status=2, start_time=self.noon)
+        self.assertEqual(self.row('印刷').steps_started, 1)
+
+        self.save(step, status=3, end_time=self.noon + timedelta(hours=2))
+        row = self.row('印刷')
+        self.assertEqual((row.steps_started, row.steps_completed, row.duration_seconds, row.duration_max_seconds),
+                         (1, 1, 7200, 7200))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            step.delete()
+        row = self.row('印刷')
+        self.assertEqual((row.steps_started, row.steps_completed, row.duration_seconds), (0, 0, 0))
+
+    def test_rolled_back_save_not_counted(self):
+        order = self.create_order()
+        step = self.save(OrderProgress(order=order, step_name='印刷', step_order=1), status=2, start_time=self.noon)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    step.status, step.end_time = 3, self.noon + timedelta(hours=1)
+                    step.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.row('印刷').steps_completed, 0)
+
+    def test_detail_rows_ignored(self):
+        order = self.create_order('PO00002-印刷', detail_type='印刷')
+        self.save(OrderProgress(order=order, step_name='印刷', step_order=1), status=2, start_time=self.noon)
+        self.assertFalse(DailyOperationRollup.objects.filter(date=self.day).exists())
+
+    def test_rebuild_matches_incremental(self):
+        order = self.create_order()
+        self.save(OrderProgress(order=order, step_name='印刷', step_order=1),
+                  status=3, start_time=self.noon, end_time=self.noon + timedelta(minutes=30))
+        self.save(OrderProgress(order=order, step_name='覆膜', step_order=2), status=4, end_time=self.noon)
+        incremental = list(DailyOperationRollup.objects.filter(date=self.day).order_by('step_name')
+                           .values_list('step_name', *daily_rollup.EVENT_FIELDS))
+
+        DailyOperationRollup.objects.filter(date=self.day).update(orders_created=5, steps_completed=7)
+        daily_rollup.rebuild_days(self.day, self.day)
+        rebuilt = list(DailyOperationRollup.objects.filter(date=self.day).order_by('step_name')
+                       .values_list('step_name', *daily_rollup.EVENT_FIELDS))
+        self.assertEqual(rebuilt, incremental)
+        self.assertEqual(self.row().orders_created, 1)
+        self.assertEqual((self.row('覆膜').steps_skipped, self.row('印刷').duration_seconds), (1, 1800))
+
+    def test_daily_report_uses_current_open_counts(self):
+        assistant = AIAssistant()
+        self.create_order('PO00001')
+        self.assertEqual(assistant.generate_daily_report()['data']['pending_orders'], 1)
+        self.create_order('PO00002')
+        self.create_order('PO00003', status=2)
+        data = assistant.generate_daily_report()['data']
+        self.assertEqual((data['pending_orders'], data['processing_orders']), (2, 1))
+
+
+class ConversationStreamAPITests(SimpleTestCase):
+    """流式对话接口：ASGI下异步转发 achat_stream，WSGI下同步转发 chat_stream（不被整体缓冲）"""
+
+    events = [{'type': 'chunk', 'content': '你好'}, {'type': 'complete'}, {'type': 'chunk', 'content': '多余'}]
+
+    def setUp(self):
+        patcher = mock.patch.object(views.ConversationStreamAPI, '_check_access', return_value=(True, 1))
+        self.check_access = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.view = views.ConversationStreamAPI.as_view()
+
+    def sync_events(self, user_message, user_id):
+        yield from self.events
+
+    async def async_events(self, user_message, user_id):
+        for event in self.events:
+            yield event
+
+    @staticmethod
+    def parse(body):
+        return [json.loads(line[len('data: '):]) for line in body.decode().splitlines() if line.startswith('data: ')]
+
+    def test_wsgi_streams_sync_generator(self):
+        request = RequestFactory().get('/api/conversation/stream/', {'message': '今天的订单'})
+        with mock.patch.object(conversation_ai, 'chat_stream', side_effect=self.sync_events) as chat_stream:
+            response = asyncio.run(self.view(request))
+            self.assertFalse(response.is_async)
+            body = b''.join(response.streaming_content)
+        chat_stream.assert_called_once_with('今天的订单', 1)
+        types = [event.get('type') for event in self.parse(body)]
+        self.assertEqual(types, ['start', 'chunk', 'complete', 'end'])
+
+    def test_asgi_streams_async_generator(self):
+        request = AsyncRequestFactory().get('/api/conversation/stream/', {'message': '今天的订单'})
+
+        async def run():
+            response = await self.view(request)
+            return response, b''.join([chunk async for chunk in response.streaming_content])
+
+        with mock.patch.object(conversation_ai, 'achat_stream', side_effect=self.async_events):
+            response, body = asyncio.run(run())
+        self.assertTrue(response.is_async)
+        self.assertEqual([event.get('type') for event in self.parse(body)], ['start', 'chunk', 'complete', 'end'])
+
+    def test_stream_error_closes_connection(self):
+        def broken(user_message, user_id):
+            yield {'type': 'chunk', 'content': '你'}
+            raise RuntimeError('boom')
+
+        request = RequestFactory().get('/api/conversation/stream/', {'message': '今天的订单'})
+        with mock.patch.object(conversation_ai, 'chat_stream', side_effect=broken):
+            body = b''.join(asyncio.run(self.view(request)).streaming_content).decode()
+        self.assertIn('boom', body)
+        self.assertTrue(body.endswith('event: close\ndata: {}\n\n'))
+
+    def test_requires_root_and_message(self):
+        self.check_access.return_value = (False, 2)
+        response = asyncio.run(self.view(RequestFactory().get('/', {'message': 'hi'})))
+        self.assertEqual(response.status_code, 403)
+        self.check_access.return_value = (True, 1)
+        response = asyncio.run(self.view(RequestFactory().get('/')))
+        self.assertEqual(response.status_code, 400)
+
+
+class VersionedLRUCacheTests(SimpleTestCase):
+    """按订单数据版本失效的进程内缓存"""
+
+    def setUp(self):
+        self.cache = VersionedLRUCache('test', max_size=2, ttl=60)
+        self.calls = []
+
+    def produce(self, value):
+        def producer():
+            self.calls.append(value)
+            return value
+        return producer
+
+    def test_reused_until_version_bumped(self):
+        self.assertEqual(self.cache.get_or_set('stats', self.produce(1)), 1)
+        self.assertEqual(self.cache.get_or_set('stats', self.produce(2)), 1)
+        version = get_order_data_version()
+        bump_order_data_version()
+        self.assertNotEqual(get_order_data_version(), version)
+        self.assertEqual(self.cache.get_or_set('stats', self.produce(3)), 3)
+        self.assertEqual(self.calls, [1, 3])
+
+    def test_ttl_and_lru_eviction(self):
+        self.cache.get_or_set('a', self.produce('a'))
+        with mock.patch('crm.data_version.time.time', return_value=10 ** 12):
+            self.assertEqual(self.cache.get_or_set('a', self.produce('a2')), 'a2')
+        self.cache.get_or_set('b', self.produce('b'))
+        self.cache.get_or_set('c', self.produce('c'))
+        self.cache.get_or_set('a', self.produce('a3'))
+        self.assertEqual(self.calls, ['a', 'a2', 'b', 'c', 'a3'])
+
+
+class OrderDataVersionSignalTests(TestCase):
+    """订单/进度保存和删除时递增数据版本，统计信息随之重新计算"""
+
+    def test_order_changes_bump_version(self):
+        version = get_order_data_version()
+        order = PrintOrderFlat.objects.create(order_no='PO00001')
+        after_create = get_order_data_version()
+        self.assertNotEqual(after_create, version)
+        OrderProgress.objects.create(order=order, step_name='印刷', step_order=1)
+        self.assertNotEqual(get_order_data_version(), after_create)
+
+    def test_statistics_cached_between_changes(self):
+        tool = OrderQueryTool()
+        PrintOrderFlat.objects.create(order_no='PO00001')
+        first = tool.get_statistics()
+        with self.assertNumQueries(0):
+            self.assertEqual(tool.get_statistics(), first)
+        PrintOrderFlat.objects.create(order_no='PO00002')
+        self.assertNotEqual(tool.get_statistics(), first)
+
+
+class ConversationSessionStoreTests(SimpleTestCase):
+    """对话会话：按用户隔离、按轮数/字符数截断、LRU和空闲淘汰、共享后端"""
+
+    def test_users_isolated(self):
+        store = ConversationSessionStore(backend='local')
+        store.append(1, '问题1', '回答1')
+        store.append(2, '问题2', '回答2')
+        self.assertEqual(store.human_messages(1), ['问题1'])
+        self.assertEqual([message.content for message in store.get_messages(2)], ['问题2', '回答2'])
+        store.clear(1)
+        self.assertEqual((store.human_messages(1), store.human_messages(2)), ([], ['问题2']))
+
+    def test_trims_to_max_turns_and_returns_dropped(self):
+        store = ConversationSessionStore(max_turns=2, max_chars=1000, backend='local')
+        store.append(1, 'q1', 'a1')
+        store.append(1, 'q2', 'a2')
+        dropped = store.append(1, 'q3', 'a3')
+        self.assertEqual(dropped, [('human', 'q1'), ('ai', 'a1')])
+        self.assertEqual(store.human_messages(1), ['q2', 'q3'])
+
+    def test_trims_by_characters_without_leading_answer(self):
+        store = ConversationSessionStore(max_turns=10, max_chars=12, backend='local')
+        store.append(1, '短问题', '一个很长很长的回答')
+        store.append(1, '问题二', '回答二')
+        messages = store.get_messages(1)
+        self.assertEqual([message.content for message in messages], ['问题二', '回答二'])
+
+    def test_lru_and_idle_eviction(self):
+        store = ConversationSessionStore(max_sessions=2, idle_timeout=60, backend='local')
+        for user_id in (1, 2):
+            store.append(user_id, '问题', '回答')
+        store.human_messages(1)
+        store.append(3, '问题', '回答')
+        self.assertEqual((store.human_messages(1), store.human_messages(2)), (['问题'], []))
+        with mock.patch('crm.conversation_sessions.time.time', return_value=time.time() + 120):
+            self.assertEqual(store.human_messages(1), [])
+
+    def test_cache_backend_shared_between_instances(self):
+        first = ConversationSessionStore(backend='cache')
+        second = ConversationSessionStore(backend='cache')
+        first.clear(42)
+        self.addCleanup(first.clear, 42)
+        first.append(42, '问题1', '回答1')
+        second.append(42, '问题2', '回答2')
+        self.assertEqual(first.human_messages(42), ['问题1', '问题2'])
+
+    def test_concurrent_appends_not_lost(self):
+        store = ConversationSessionStore(max_turns=100, max_chars=10 ** 6, backend='cache')
+        store.clear(43)
+        self.addCleanup(store.clear, 43)
+        threads = [threading.Thread(target=store.append, args=(43, f'问题{i}', '回答')) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(store.human_messages(43)), 8)
+
+
+class ScriptedGateway:
+    """测试用网关：每轮按脚本返回消息，脚本项为异常时在该处抛出"""
+
+    available = True
+
+    def __init__(self, *rounds):
+        self.rounds = list(rounds)
+        self.calls = []
+
+    def invoke(self, messages, user_id=None, llm=None):
+        self.calls.append((llm, list(messages)))
+        return self.rounds.pop(0)
+
+    def stream(self, messages, user_id=None, llm=None):
+        self.calls.append((llm, list(messages)))
+        for chunk in self.rounds.pop(0):
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+class ToolCallingLoopTests(SimpleTestCase):
+    """工具调用循环：执行工具后进入下一轮，最后一轮强制作答；流式中途失败只发送中断事件"""
+
+    def setUp(self):
+        self.tool_llm, self.answer_llm = object(), object()
+        self.executor = mock.Mock()
+        self.executor.run.return_value = '订单统计：共3个'
+        self.finish_chat = mock.Mock()
+        for name, value in (('tool_llm', self.tool_llm), ('answer_llm', self.answer_llm), ('max_tool_rounds', 1),
+                            ('tool_executor', self.executor), ('_finish_chat', self.finish_chat)):
+            patcher = mock.patch.object(conversation_ai, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_gateway(self, *rounds):
+        gateway = ScriptedGateway(*rounds)
+        patcher = mock.patch.object(conversation_ai, 'gateway', gateway)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return gateway
+
+    @staticmethod
+    def tool_call_chunk():
+        return AIMessageChunk(content='', tool_call_chunks=[
+            {'name': 'get_statistics', 'args': '{}', 'id': 'call_1', 'index': 0},
+        ])
+
+    def run_stream(self):
+        with mock.patch.object(conversation_ai, '_prepare_chat', return_value={
+            'kind': 'llm', 'messages': [HumanMessage(content='订单统计')], 'data_version': 'v1',
+        }):
+            return list(conversation_ai.chat_stream('订单统计', 1))
+
+    def test_invoke_runs_tools_then_answers(self):
+        gateway = self.use_gateway(
+            AIMessage(content='', tool_calls=[{'name': 'get_statistics', 'args': {}, 'id': 'call_1'}]),
+            AIMessage(content='共有3个订单'),
+        )
+        self.assertEqual(conversation_ai._invoke_with_tools([HumanMessage(content='订单统计')], 1), '共有3个订单')
+        self.executor.run.assert_called_once_with('get_statistics', {})
+        self.assertEqual([llm for llm, _ in gateway.calls], [self.tool_llm, self.answer_llm])
+        tool_message = gateway.calls[1][1][-1]
+        self.assertIsInstance(tool_message, ToolMessage)
+        self.assertEqual((tool_message.content, tool_message.tool_call_id), ('订单统计：共3个', 'call_1'))
+
+    def test_last_round_forced_to_answer(self):
+        # 最后一轮仍返回工具调用时不再执行
+        gateway = self.use_gateway(
+            AIMessage(content='', tool_calls=[{'name': 'get_statistics', 'args': {}, 'id': 'call_1'}]),
+            AIMessage(content='', tool_calls=[{'name': 'get_statistics', 'args': {}, 'id': 'call_2'}]),
+        )
+        self.assertEqual(conversation_ai._invoke_with_tools([HumanMessage(content='订单统计')], 1), '')
+        self.assertEqual(len(gateway.calls), 2)
+        self.assertEqual(gateway.calls[-1][0], self.answer_llm)
+
+    def test_stream_executes_tool_round_then_streams_answer(self):
+        gateway = self.use_gateway(
+            [self.tool_call_chunk()],
+            [AIMessageChunk(content='共有'), AIMessageChunk(content='3个订单')],
+        )
+        events = self.run_stream()
+        self.assertEqual([event['type'] for event in events], ['content', 'content', 'complete'])
+        self.executor.run.assert_called_once_with('get_statistics', {})
+        self.assertIsInstance(gateway.calls[1][1][-1], ToolMessage)
+        self.finish_chat.assert_called_once_with('订单统计', 1, '共有3个订单', 'v1')
+
+    def test_mid_stream_failure_yields_interrupted(self):
+        self.use_gateway([AIMessageChunk(content='共有'), RuntimeError('connection reset')])
+        with mock.patch.object(conversation_ai, '_invoke_with_tools') as invoke:
+            events = self.run_stream()
+        self.assertEqual(events[0]['content'], '共有')
+        self.assertTrue(events[-1]['interrupted'])
+        # 不整段重发，也不计入历史和缓存
+        invoke.assert_not_called()
+        self.finish_chat.assert_not_called()
+
+    def test_gateway_error_before_output_degrades(self):
+        self.use_gateway([LLMBusyError()])
+        with mock.patch.object(conversation_ai, '_gateway_fallback', return_value='快速查询结果') as fallback:
+            events = self.run_stream()
+        fallback.assert_called_once()
+        self.assertEqual(''.join(event['content'] for event in events[:-1]), '快速查询结果')
+        self.assertTrue(events[-1]['degraded'])
+        self.finish_chat.assert_not_called()
+
+    def test_other_error_before_output_falls_back_to_invoke(self):
+        self.use_gateway([RuntimeError('stream unsupported')], AIMessage(content='共有3个订单'))
+        events = self.run_stream()
+        self.assertEqual(''.join(event.get('content', '') for event in events), '共有3个订单')
+        self.assertEqual(events[-1]['type'], 'complete')
+        self.finish_chat.assert_called_once_with('订单统计', 1, '共有3个订单', 'v1')
+
+
+class PromptBuilderTests(SimpleTestCase):
+    """提示词组装：不超过token预算，历史按整轮保留，片段按相似度放入，摘要有上限"""
+
+    def setUp(self):
+        self.builder = PromptBuilder(budget=300, summary_budget=40)
+
+    def total_tokens(self, messages):
+        return sum(self.builder._message_tokens(message.content) for message in messages)
+
+    @staticmethod
+    def make_fragment(message, score):
+        return ConversationFragment(
+            id=message, user_id=1, user_message=message, ai_response='回答' + message,
+            timestamp=datetime.now(), context_type='general', keywords=[], score=score,
+        )
+
+    def test_stays_within_budget(self):
+        history = []
+        for i in range(20):
+            history += [HumanMessage(content=f'第{i}个问题' * 5), AIMessage(content=f'第{i}个回答' * 10)]
+        messages = self.builder.build('系统提示', '订单统计', data_context='订单数据' * 200, history=history,
+                                      summary='摘要' * 100, fragments=[self.make_fragment('历史问题', 0.9)])
+        self.assertLessEqual(self.total_tokens(messages), 300)
+        self.assertIsInstance(messages[0], SystemMessage)
+        self.assertIn('用户问题：订单统计', messages[-1].content)
+
+    def test_keeps_newest_whole_turns(self):
+        history = []
+        for i in range(10):
+            history += [HumanMessage(content=f'问题{i}' * 10), AIMessage(content=f'回答{i}' * 10)]
+        messages = self.builder.build('系统提示', '订单统计', history=history)
+        kept = messages[1:-1]
+        self.assertTrue(kept)
+        self.assertLess(len(kept), len(history))
+        self.assertEqual(len(kept) % 2, 0)
+        self.assertIsInstance(kept[0], HumanMessage)
+        self.assertEqual(kept[-1].content, history[-1].content)
+
+    def test_fragments_ordered_by_score(self):
+        fragments = [self.make_fragment('较远的问题', 0.3), self.make_fragment('最相关的问题', 0.9)]
+        content = self.builder.build('系统提示', '订单统计', fragments=fragments)[-1].content
+        self.assertIn('<conversation_history>', content)
+        self.assertLess(content.index('最相关的问题'), content.index('较远的问题'))
+
+    def test_compact_appends_turns_and_drops_oldest(self):
+        summary = self.builder.compact('', [('human', '今天的订单'), ('ai', '今天有3个订单。其中1个紧急。')])
+        self.assertEqual(summary, '• 问：今天的订单；答：今天有3个订单')
+        for i in range(10):
+            summary = self.builder.compact(summary, [('human', f'问题{i}'), ('ai', f'回答{i}')])
+        self.assertLessEqual(TokenCounter.count(summary), 40)
+        self.assertTrue(summary.endswith('• 问：问题9；答：回答9'))
+        self.assertNotIn('今天的订单', summary)
+
+
+class GatherContextTests(SimpleTestCase):
+    """上下文并发收集：各来源独立超时，出错或线程池已满时使用默认值"""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.wait_idle)
+        self.addCleanup(self.release.set)
+
+    @staticmethod
+    def wait_idle():
+        wait_for(lambda: context_gathering._in_flight == 0)
+
+    def slow(self):
+        self.release.wait(2)
+        return '慢'
+
+    def test_slow_source_times_out_alone(self):
+        start = time.monotonic()
+        results = gather_context({
+            'slow': ContextSource(self.slow, 0.1, '默认'),
+            'fast': ContextSource(lambda: '快', 1, '默认'),
+        })
+        self.assertEqual(results, {'slow': '默认', 'fast': '快'})
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_error_falls_back_to_default(self):
+        def broken():
+            raise RuntimeError('db down')
+
+        results = gather_context({
+            'pooled': ContextSource(broken, 1, []),
+            'inline': ContextSource(broken, 0, '', inline=True),
+        })
+        self.assertEqual(results, {'pooled': [], 'inline': ''})
+
+    def test_inline_source_runs_in_calling_thread(self):
+        results = gather_context({
+            'inline': ContextSource(threading.current_thread, 0, None, inline=True),
+            'pooled': ContextSource(threading.current_thread, 1, None),
+        })
+        self.assertIs(results['inline'], threading.current_thread())
+        self.assertIsNot(results['pooled'], threading.current_thread())
+
+    def test_full_pool_skips_source(self):
+        func = mock.Mock(return_value='值')
+        with mock.patch.object(context_gathering, '_in_flight', context_gathering.MAX_WORKERS):
+            results = gather_context({'pooled': ContextSource(func, 1, '默认')})
+        self.assertEqual(results, {'pooled': '默认'})
+        func.assert_not_called()
+
+    def test_timed_out_task_holds_slot_until_done(self):
+        gather_context({'slow': ContextSource(self.slow, 0.05, None)})
+        self.assertEqual(context_gathering._in_flight, 1)
+        self.release.set()
+        self.assertTrue(wait_for(lambda: context_gathering._in_flight == 0))
+
+
+class WebSocketAuthTests(TestCase):
+    """WebSocket认证：签名令牌免查数据库，缓存未命中的连接合并为一次批量查询"""
+
+    def setUp(self):
+        department = DepartMent.objects.create(name='生产部')
+        self.users = [
+            UserInfo.objects.create(username=username, password='x', email='', name=username, phone='', gender=1, department=department)
+            for username in ('alice', 'bob')
+        ]
+        self.session_keys = [self.create_session(user.id) for user in self.users]
+        self.resolver = websocket_auth_middleware.SessionUserResolver(batch_window=0.01)
+        patcher = mock.patch.object(websocket_auth_middleware, 'resolver', self.resolver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def create_session(user_id):
+        session = SessionStore()
+        session['user_id'] = user_id
+        session.create()
+        return session.session_key
+
+    def connect(self, session_key, token=None):
+        """经过中间件建立一次连接，返回内层应用收到的scope"""
+        seen = {}
+
+        async def inner(scope, receive, send):
+            seen.update(scope)
+
+        scope = {
+            'type': 'websocket',
+            'headers': [(b'cookie', f'sessionid={session_key}'.encode())],
+            'query_string': f'token={token}'.encode() if token else b'',
+        }
+        # async_to_sync 让数据库访问回到当前线程，测试事务内的数据可见
+        async_to_sync(websocket_auth_middleware.SessionAuthMiddleware(inner))(scope, None, None)
+        return seen
+
+    def test_token_round_trip(self):
+        snapshot = {'id': 1, 'username': 'alice', 'name': 'alice'}
+        token = websocket_auth_middleware.make_token('key-1', snapshot)
+        self.assertEqual(websocket_auth_middleware.read_token(token, 'key-1'), snapshot)
+        # 其它会话、篡改过的令牌都无效
+        self.assertIsNone(websocket_auth_middleware.read_token(token, 'key-2'))
+        self.assertIsNone(websocket_auth_middleware.read_token(token[:-2] + 'xx', 'key-1'))
+        with override_settings(WS_AUTH_TOKEN_MAX_AGE=0):
+            self.assertIsNone(websocket_auth_middleware.read_token(token, 'key-1'))
+
+    def test_session_connect_issues_token_and_reconnect_skips_database(self):
+        scope = self.connect(self.session_keys[0])
+        self.assertEqual(scope['user'].username, 'alice')
+        self.assertTrue(scope['ws_token'])
+
+        self.resolver.invalidate(self.session_keys[0])
+        with self.assertNumQueries(0):
+            scope = self.connect(self.session_keys[0], token=scope['ws_token'])
+        self.assertEqual(scope['user'].id, self.users[0].id)
+        # 令牌不续期
+        self.assertNotIn('ws_token', scope)
+
+    def test_reconnect_hits_cache(self):
+        self.connect(self.session_keys[0])
+        with self.assertNumQueries(0):
+            scope = self.connect(self.session_keys[0])
+        self.assertEqual(scope['user'].username, 'alice')
+        self.assertEqual(self.resolver.hits, 1)
+
+    def test_unknown_session_is_anonymous(self):
+        scope = self.connect('missing-session')
+        self.assertFalse(scope['user'].is_authenticated)
+        self.assertNotIn('ws_token', scope)
+
+    def test_concurrent_misses_resolved_in_one_batch(self):
+        async def resolve_all():
+            keys = self.session_keys + [self.session_keys[0]]
+            return await asyncio.gather(*(self.resolver.resolve(key) for key in keys))
+
+        with self.assertNumQueries(2):
+            snapshots = async_to_sync(resolve_all)()
+        self.assertEqual([snapshot['username'] for snapshot in snapshots], ['alice', 'bob', 'alice'])
+        self.assertEqual(self.resolver.queries, 1)
+
+
+class CurrentUserTests(TestCase):
+    """当前用户：中间件惰性加载，同一请求内的工具函数和装饰器共用一次查询"""
+
+    def setUp(self):
+        department = DepartMent.objects.create(name='办公室')
+        self.user = UserInfo.objects.create(username='root', password='x', email='', name='管理员', phone='', gender=1, department=department)
+        self.user.roles.add(Role.objects.create(title='老板'))
+
+    def make_request(self, session):
+        request = RequestFactory().get('/')
+        request.session = session
+        CurrentUserMiddleware(lambda request: HttpResponse()).process_request(request)
+        return request
+
+    def test_loaded_once_per_request(self):
+        request = self.make_request({'user_id': self.user.id})
+        view = require_role('老板')(lambda request: HttpResponse(request.current_user.department.name))
+        # 用户+部门一次，角色一次
+        with self.assertNumQueries(2):
+            self.assertTrue(is_root_user(request))
+            self.assertEqual(get_current_user(request).id, self.user.id)
+            self.assertEqual(view(request).content.decode(), '办公室')
+
+    def test_lazy_until_used(self):
+        with self.assertNumQueries(0):
+            self.make_request({'user_id': self.user.id})
+
+    def test_anonymous_and_missing_user(self):
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_current_user(self.make_request({})))
+        request = self.make_request({'user_id': self.user.id + 100})
+        self.assertIsNone(get_current_user(request))
+        self.assertFalse(is_root_user(request))
+        self.assertEqual(json.loads(require_role('老板')(HttpResponse)(request).content)['error_code'], 'USER_NOT_FOUND')
+
+
+
+class CaptchaPoolTests(SimpleTestCase):
+    """验证码池：每张只使用一次，低于低水位时后台补充，池空时现场生成"""
+
+    def setUp(self):
+        self.real_generate = code.generate_captcha
+        counter = iter(range(10 ** 6))
+        patcher = mock.patch.object(code, 'generate_captcha', side_effect=lambda: (f'{next(counter):04d}', b'png'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_generate_captcha_returns_png(self):
+        answer, image = self.real_generate()
+        self.assertEqual(len(answer), 4)
+        self.assertTrue(set(answer) <= set(code.CODE_CHARS))
+        self.assertTrue(image.startswith(b'\x89PNG'))
+
+    def test_each_captcha_served_once_and_refilled(self):
+        pool = code.CaptchaPool(size=5, low_water=2)
+        first = pool.get()
+        self.assertEqual(pool.inline, 1)
+        self.assertTrue(wait_for(lambda: len(pool._items) == 5))
+
+        answers = [pool.get()[0] for _ in range(4)]
+        self.assertEqual(pool.served, 4)
+        self.assertEqual(len(set(answers + [first[0]])), 5)
+        # 低于低水位后补满
+        self.assertTrue(wait_for(lambda: len(pool._items) == 5))
+
+    def test_view_stores_answer_in_session(self):
+        pool = code.CaptchaPool(size=1, low_water=1)
+        request = RequestFactory().get('/')
+        request.session = {}
+        with mock.patch.object(code, 'captcha_pool', pool), mock.patch.object(pool, 'get', return_value=('AB12', b'png')):
+            response = code.get_verify_code(request)
+        self.assertEqual((response['Content-Type'], response.content), ('image/png', b'png'))
+        self.assertEqual(request.session['verifycode'], 'AB12')
+
+
+@override_settings(METRICS_AUTH_TOKEN='s3cret-token')
+class MetricsViewTests(SimpleTestCase):
+    """/metrics：Bearer令牌或root用户才能抓取"""
+
+    def get(self, session=None, **headers):
+        request = RequestFactory().get('/metrics', **headers)
+        request.session = session or {}
+        return views.MetricsView.as_view()(request)
+
+    def test_missing_token_rejected(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="metrics"')
+
+    def test_wrong_token_rejected(self):
+        for header in ('Bearer wrong-token', 'Basic s3cret-token', 's3cret-token'):
+            self.assertEqual(self.get(HTTP_AUTHORIZATION=header).status_code, 401, header)
+
+    def test_valid_token_allowed(self):
+        response = self.get(HTTP_AUTHORIZATION='Bearer s3cret-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('text/plain', response['Content-Type'])
+
+    def test_root_user_allowed_without_token(self):
+        self.assertEqual(self.get(session={'user_info': {'username': 'root'}}).status_code, 200)
+
+    @override_settings(METRICS_AUTH_TOKEN='')
+    def test_empty_setting_disables_token(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+    def test_prometheus_missing_returns_503(self):
+        with mock.patch('crm.metrics.render_latest', return_value=(None, 'text/plain')):
+            self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer s3cret-token').status_code, 503)
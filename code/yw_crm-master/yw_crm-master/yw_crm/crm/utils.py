@@ -2,7 +2,107 @@
 CRM工具函数
 """
 import re
+from collections import namedtuple
+from functools import lru_cache
 from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject
+
+
+# 桌面系统标识
+DESKTOP_AGENTS = (
+    'windows nt', 'win64', 'win32', 'x86_64', 'amd64',
+    'macintosh', 'mac os x', 'intel mac',
+    'linux', 'x11', 'ubuntu', 'fedora', 'centos'
+)
+
+# 移动设备User-Agent特征
+MOBILE_AGENTS = (
+    'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone',
+    'mobile', 'mobi', 'samsung', 'huawei', 'xiaomi', 'oppo', 'vivo', 
+    'oneplus', 'nokia', 'motorola', 'lg', 'htc', 'sony', 'meizu', 
+    'lenovo', 'tablet', 'kindle', 'silk', 'opera mini', 'opera mobi',
+    'webos', 'palm', 'symbian', 'fennec', 'maemo'
+)
+
+# 关键字合并成一个正则，一次扫描完成匹配
+DESKTOP_RE = re.compile('|'.join(re.escape(agent) for agent in DESKTOP_AGENTS))
+MOBILE_RE = re.compile('|'.join(re.escape(agent) for agent in MOBILE_AGENTS))
+TABLET_RE = re.compile(r'ipad|tablet|kindle|silk|playbook|sm-t\d|android(?!.*mobi)')
+SMALL_SCREEN_RE = re.compile(r'(?:320|240|176|128)x')
+
+# 浏览器识别，按顺序取第一个匹配（Edge/Opera/微信等的UA中也带有chrome、safari）
+BROWSER_PATTERNS = (
+    ('wechat', re.compile(r'micromessenger')),
+    ('edge', re.compile(r'edg(?:e|a|ios)?/')),
+    ('opera', re.compile(r'opr/|opera')),
+    ('firefox', re.compile(r'firefox|fxios')),
+    ('chrome', re.compile(r'chrome|crios|chromium')),
+    ('safari', re.compile(r'safari')),
+)
+
+
+class DeviceInfo(namedtuple('DeviceInfo', ['device_type', 'form_factor', 'browser'])):
+    """
+    设备分类结果
+    device_type: 'mobile' 或 'desktop'（页面路由用，平板按手机端处理）
+    form_factor: 'mobile'、'tablet' 或 'desktop'
+    browser: 浏览器类型，如 'chrome'、'wechat'，无法识别时为 'other'
+    """
+
+    @property
+    def is_mobile(self):
+        return self.device_type == 'mobile'
+
+
+@lru_cache(maxsize=256)
+def classify_user_agent(user_agent: str) -> DeviceInfo:
+    """
+    按User-Agent分类设备，结果按原始UA字符串缓存（车间设备的UA种类很少）
+    
+    Args:
+        user_agent: User-Agent字符串
+        
+    Returns:
+        DeviceInfo: 设备分类结果
+    """
+    user_agent = user_agent.lower()
+    browser = next((name for name, pattern in BROWSER_PATTERNS if pattern.search(user_agent)), 'other')
+
+    # 首先检查明确的桌面系统标识，排除移动版本的桌面浏览器
+    is_mobile = False
+    if not DESKTOP_RE.search(user_agent) or 'mobi' in user_agent:
+        if MOBILE_RE.search(user_agent):
+            is_mobile = True
+        elif 'screen' in user_agent and SMALL_SCREEN_RE.search(user_agent):
+            # 检查是否提到小屏幕
+            is_mobile = True
+
+    if not is_mobile:
+        return DeviceInfo('desktop', 'desktop', browser)
+    form_factor = 'tablet' if TABLET_RE.search(user_agent) else 'mobile'
+    return DeviceInfo('mobile', form_factor, browser)
+
+
+def get_device_info(request: HttpRequest) -> DeviceInfo:
+    """
+    获取当前请求的设备分类，结果挂在 request.device_info 上，同一请求只计算一次
+    
+    Args:
+        request: Django请求对象
+        
+    Returns:
+        DeviceInfo: 设备分类结果
+    """
+    info = getattr(request, 'device_info', None)
+    if info is None:
+        info = classify_user_agent(request.META.get('HTTP_USER_AGENT', ''))
+        # 检查Accept头（明确的桌面系统除外）
+        if not info.is_mobile and 'application/vnd.wap.xhtml+xml' in request.META.get('HTTP_ACCEPT', ''):
+            user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
+            if not DESKTOP_RE.search(user_agent) or 'mobi' in user_agent:
+                info = DeviceInfo('mobile', 'mobile', info.browser)
+        request.device_info = info
+    return info
 
 
 def is_mobile_device(request: HttpRequest) -> bool:
@@ -15,49 +115,44 @@ def is_mobile_device(request: HttpRequest) -> bool:
     Returns:
         bool: True表示移动设备，False表示PC设备
     """
-    user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
-    
-    # 首先检查明确的桌面系统标识 - 如果匹配则直接返回False
-    desktop_agents = [
-        'windows nt', 'win64', 'win32', 'x86_64', 'amd64',
-        'macintosh', 'mac os x', 'intel mac',
-        'linux', 'x11', 'ubuntu', 'fedora', 'centos'
-    ]
-    
-    for agent in desktop_agents:
-        if agent in user_agent:
-            # 额外检查：排除移动版本的桌面浏览器
-            if 'mobile' not in user_agent and 'mobi' not in user_agent:
-                return False
-    
-    # 移动设备User-Agent特征
-    mobile_agents = [
-        'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone',
-        'mobile', 'mobi', 'samsung', 'huawei', 'xiaomi', 'oppo', 'vivo', 
-        'oneplus', 'nokia', 'motorola', 'lg', 'htc', 'sony', 'meizu', 
-        'lenovo', 'tablet', 'kindle', 'silk', 'opera mini', 'opera mobi',
-        'webos', 'palm', 'symbian', 'fennec', 'maemo'
-    ]
-    
-    # 检查User-Agent是否包含移动设备特征
-    for agent in mobile_agents:
-        if agent in user_agent:
-            return True
-    
-    # 检查Accept头
-    accept = request.META.get('HTTP_ACCEPT', '')
-    if 'application/vnd.wap.xhtml+xml' in accept:
-        return True
+    return get_device_info(request).is_mobile
+
+
+def load_current_user(request: HttpRequest):
+    """
+    按 session 中的 user_id 加载当前用户（同时取出部门和角色），同一请求只查询一次
     
-    # 检查屏幕尺寸相关（如果有）
-    if 'screen' in user_agent:
-        # 检查是否提到小屏幕
-        small_screen_indicators = ['320x', '240x', '176x', '128x']
-        for indicator in small_screen_indicators:
-            if indicator in user_agent:
-                return True
+    Args:
+        request: Django请求对象
+        
+    Returns:
+        UserInfo 或 None
+    """
+    if not hasattr(request, '_current_user_cache'):
+        user = None
+        user_id = request.session.get('user_id')
+        if user_id:
+            from crm.models import UserInfo
+            user = UserInfo.objects.select_related('department').prefetch_related('roles').filter(id=user_id).first()
+        request._current_user_cache = user
+    return request._current_user_cache
+
+
+def get_current_user(request: HttpRequest):
+    """
+    获取当前用户：优先使用 CurrentUserMiddleware 挂在 request 上的 current_user
     
-    return False
+    Args:
+        request: Django请求对象
+        
+    Returns:
+        UserInfo 或 None
+    """
+    user = getattr(request, 'current_user', None)
+    if user is not None and not isinstance(user, SimpleLazyObject):
+        return user
+    # 中间件挂的惰性对象与这里共用同一份请求内缓存，直接返回真实对象
+    return load_current_user(request)
 
 
 def is_root_user(request: HttpRequest) -> bool:
@@ -78,16 +173,8 @@ def is_root_user(request: HttpRequest) -> bool:
         return True
     
     # 方式2：新的移动端系统 - user_id
-    user_id = request.session.get('user_id')
-    if user_id:
-        try:
-            from crm.models import UserInfo
-            user = UserInfo.objects.get(id=user_id)
-            return user.username == 'root'
-        except:
-            pass
-    
-    return False
+    user = get_current_user(request)
+    return bool(user) and user.username == 'root'
 
 
 def get_user_info(request: HttpRequest) -> dict:
@@ -113,7 +200,7 @@ def get_device_type(request: HttpRequest) -> str:
     Returns:
         str: 'mobile' 或 'desktop'
     """
-    return 'mobile' if is_mobile_device(request) else 'desktop'
+    return get_device_info(request).device_type
 
 
 def get_user_type(request: HttpRequest) -> str:
@@ -186,28 +273,15 @@ def test_device_detection(user_agent_string: str) -> dict:
     user_agent_lower = user_agent_string.lower()
     
     # 检查桌面系统标识
-    desktop_agents = [
-        'windows nt', 'win64', 'win32', 'x86_64', 'amd64',
-        'macintosh', 'mac os x', 'intel mac',
-        'linux', 'x11', 'ubuntu', 'fedora', 'centos'
-    ]
-    
-    desktop_matches = [agent for agent in desktop_agents if agent in user_agent_lower]
+    desktop_matches = [agent for agent in DESKTOP_AGENTS if agent in user_agent_lower]
     
     # 检查移动设备标识
-    mobile_agents = [
-        'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone',
-        'mobile', 'mobi', 'samsung', 'huawei', 'xiaomi', 'oppo', 'vivo', 
-        'oneplus', 'nokia', 'motorola', 'lg', 'htc', 'sony', 'meizu', 
-        'lenovo', 'tablet', 'kindle', 'silk', 'opera mini', 'opera mobi',
-        'webos', 'palm', 'symbian', 'fennec', 'maemo'
-    ]
-    
-    mobile_matches = [agent for agent in mobile_agents if agent in user_agent_lower]
+    mobile_matches = [agent for agent in MOBILE_AGENTS if agent in user_agent_lower]
     
     # 执行实际检测
     is_mobile = is_mobile_device(request)
     device_type = get_device_type(request)
+    device_info = get_device_info(request)
     
     return {
         'user_agent': user_agent_string,
@@ -217,5 +291,7 @@ def test_device_detection(user_agent_string: str) -> dict:
         'has_mobile_keyword': 'mobile' in user_agent_lower or 'mobi' in user_agent_lower,
         'is_mobile_result': is_mobile,
         'device_type': device_type,
+        'form_factor': device_info.form_factor,
+        'browser': device_info.browser,
         'expected': 'mobile' if mobile_matches and not (desktop_matches and not ('mobile' in user_agent_lower or 'mobi' in user_agent_lower)) else 'desktop'
     } 
\ No newline at end of file
@@ -25,7 +25,8 @@ import math
 from rbac.decorators import require_step_permission, require_role, check_step_permission, log_step_operation
 
 # 新增：导入需要的模型
-from crm.models import PrintOrderFlat, OrderProgress, UserInfo
+from crm.models import PrintOrderFlat, OrderProgress
+from crm.utils import get_current_user
 
 
 # Create your views here.
@@ -52,8 +53,7 @@ class LoginView(View):
         form.request=request
         if form.is_valid():
             request.session['user_id'] = form.user.id  # 登录成功后设置 session
-            InitPermission(request, form.user).init_permissions_dict()
-            InitPermission(request, form.user).init_menu_dict()
+            InitPermission(request, form.user).init_role_set()
             return redirect('/index/')
         return render(request,'login.html',{'form':form})
 
@@ -1433,7 +1433,7 @@ class ConfirmStartProgressStepView(View):
     """确认开始进度步骤（当上个步骤有备注时）"""
     
     def post(self, request, step_id):
-        from crm.models import OrderProgress, UserInfo
+        from crm.models import OrderProgress
         print(f"=== ConfirmStartProgressStepView POST 请求开始 ===")
         print(f"步骤ID: {step_id}")
         
@@ -1449,7 +1449,7 @@ class ConfirmStartProgressStepView(View):
                 print("❌ 用户未登录")
                 return JsonResponse({'status': False, 'message': '用户未登录，请重新登录'})
             
-            user = UserInfo.objects.filter(id=user_id).first()
+            user = get_current_user(request)
             if not user:
                 print(f"❌ 用户ID {user_id} 不存在")
                 return JsonResponse({'status': False, 'message': '用户信息不存在，请重新登录'})
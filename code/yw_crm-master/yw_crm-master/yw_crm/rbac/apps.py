@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class RbacConfig(AppConfig):
     name = 'rbac'
+
+    def ready(self):
+        """
+        应用准备就绪时导入信号处理器
+        """
+        import rbac.signals  # noqa: F401
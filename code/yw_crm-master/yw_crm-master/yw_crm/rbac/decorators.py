@@ -9,7 +9,8 @@ from django.conf import settings
 from django.utils import timezone
 
 from .models import WorkflowStepOperationLog
-from crm.models import OrderProgress, UserInfo
+from crm.models import OrderProgress
+from crm.utils import get_current_user
 
 
 def get_client_ip(request):
@@ -207,7 +208,7 @@ def require_step_permission(operation_type):
                         'error_code': 'NOT_LOGGED_IN'
                     })
                 
-                user = UserInfo.objects.filter(id=user_id).first()
+                user = get_current_user(request)
                 if not user:
                     return JsonResponse({
                         'status': False, 
@@ -304,7 +305,7 @@ def require_role(role_names):
                         'error_code': 'NOT_LOGGED_IN'
                     })
                 
-                user = UserInfo.objects.filter(id=user_id).first()
+                user = get_current_user(request)
                 if not user:
                     return JsonResponse({
                         'status': False, 
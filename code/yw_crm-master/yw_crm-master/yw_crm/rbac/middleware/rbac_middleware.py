@@ -1,6 +1,7 @@
 from django.utils.deprecation import MiddlewareMixin
 from django.shortcuts import render,HttpResponse,redirect
 from django.conf import settings
+from rbac.services.permission_cache import get_permission_dict
 import re
 
 class PermissionMiddleWare(MiddlewareMixin):
@@ -23,8 +24,8 @@ class PermissionMiddleWare(MiddlewareMixin):
             if re.match(reg,current_url):
                 return None
 
-        # 2. 获取当前用户session中所有的权限
-        permissions_dict = request.session.get(settings.PERMISSION_SESSION_KEY)
+        # 2. 获取当前用户角色组合对应的所有权限（session中只存角色组合哈希）
+        permissions_dict = get_permission_dict(request)
         if not permissions_dict:
             return redirect('/login/')
 
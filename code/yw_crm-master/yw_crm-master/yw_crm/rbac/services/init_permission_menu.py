@@ -1,6 +1,5 @@
 from django.conf import settings
-
-from django.conf import settings
+from rbac.services.permission_cache import bind_user
 
 
 # def init_permission(request,user):
@@ -70,6 +69,17 @@ class InitPermission(object):
         self.menu_dict={}
         self.permissions_dict={}
 
+    def init_role_set(self):
+        """
+        登录时调用：session中只记录角色组合哈希和权限版本号，
+        权限字典和菜单字典按角色组合在共享缓存中编译一次（见 permission_cache）
+        :return:
+        """
+        artifact=bind_user(self.request,self.user.id)
+        self.permissions_dict=artifact['permissions']
+        self.menu_dict=artifact['menus']
+        return artifact
+
     def init_data(self):
         """
         从数据库中获取权限信息以及用户信息
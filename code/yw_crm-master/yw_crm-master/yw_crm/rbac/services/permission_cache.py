@@ -0,0 +1,232 @@
+"""
+按角色组合共享的权限/菜单数据
+同一组角色的用户共用一份编译好的权限字典和菜单字典，存放在共享缓存中（键为角色组合的哈希），
+session 中只保存角色组合哈希和权限版本号。
+角色、权限、菜单或用户角色变化时递增版本号（见 rbac/signals.py），
+下一次请求会按最新角色重新取得数据，无需重新登录
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from crm import metrics
+from rbac.models import Permission
+from utils.cache import shared_cache as cache
+
+
+# session 中保存 {'hash': 角色组合哈希, 'version': 权限版本号}
+ROLE_SET_SESSION_KEY = 'rbac_role_set'
+VERSION_CACHE_KEY = 'rbac:permission_version'
+ARTIFACT_CACHE_KEY = 'rbac:artifact:%s:%s'
+# 由权限数据派生的内容（如渲染好的侧边栏HTML）
+FRAGMENT_CACHE_KEY = 'rbac:fragment:%s:%s:%s'
+
+# 共享缓存不可用时退回进程内版本号
+_local_version = int(time.time() * 1000)
+_local_lock = threading.Lock()
+
+# 进程内再缓存最近用到的几组，省去每次请求从缓存反序列化
+_local_artifacts = OrderedDict()
+_LOCAL_MAX_SIZE = 32
+_local_fragments = OrderedDict()
+_LOCAL_FRAGMENT_MAX_SIZE = 256
+
+
+def get_permission_version() -> str:
+    """获取当前权限版本"""
+    try:
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            # 以时间戳初始化，缓存被清空后也不会与旧版本号重复
+            cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+            version = cache.get(VERSION_CACHE_KEY)
+        if version is not None:
+            return str(version)
+    except Exception as e:
+        print(f"⚠️ 读取权限版本失败: {e}")
+    return str(_local_version)
+
+
+def bump_permission_version():
+    """角色/权限/菜单变化时调用，所有已登录用户在下一次请求时使用新数据"""
+    global _local_version
+    with _local_lock:
+        _local_version += 1
+        _local_artifacts.clear()
+        _local_fragments.clear()
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # 键不存在
+        cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+    except Exception as e:
+        print(f"⚠️ 更新权限版本失败: {e}")
+
+
+def role_set_hash(role_ids: Iterable[int]) -> str:
+    """角色组合的哈希（与角色顺序无关）"""
+    content = ','.join(str(role_id) for role_id in sorted(set(role_ids)))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+def compile_role_set(role_ids: Iterable[int]) -> Dict[str, Any]:
+    """
+    一次查询构建一组角色的权限字典和菜单字典
+    permissions={'customer_list':{'id':1,'url':'/customer/list/','title':'客户列表','pid':None,'pname':None}, ...}
+    menus={1:{'title':'客户管理','icon':'fa fa-coffe','children':[{'id':1,'url':'/customer/list/','title':'客户列表'}, ...]}}
+    """
+    rows = Permission.objects.filter(role__id__in=list(role_ids), url__isnull=False).values(
+        'id', 'url', 'title', 'name', 'parent_id', 'parent__name', 'menu_id', 'menu__title', 'menu__icon',
+    ).distinct().order_by('id')
+
+    permissions, menus = {}, {}
+    for row in rows:
+        permissions[row['name']] = {
+            'id': row['id'],
+            'url': row['url'],
+            'title': row['title'],
+            'pid': row['parent_id'],
+            'pname': row['parent__name'],
+        }
+        menu_id = row['menu_id']
+        if not menu_id:
+            continue
+        if menu_id not in menus:
+            menus[menu_id] = {'title': row['menu__title'], 'icon': row['menu__icon'], 'children': []}
+        menus[menu_id]['children'].append({'id': row['id'], 'title': row['title'], 'url': row['url']})
+    return {'permissions': permissions, 'menus': menus}
+
+
+def get_user_role_ids(user_id) -> list:
+    user_model = import_string(settings.USER_MODEL_PATH)
+    return list(user_model.objects.filter(pk=user_id, roles__isnull=False).values_list('roles', flat=True))
+
+
+def get_artifact(role_hash: str, version: str, role_ids: Optional[Iterable[int]] = None) -> Optional[Dict[str, Any]]:
+    """
+    按 (版本, 角色组合哈希) 取编译好的数据：进程内缓存 -> 共享缓存 -> 数据库
+    role_ids 为空且缓存未命中时返回 None
+    """
+    key = ARTIFACT_CACHE_KEY % (version, role_hash)
+    with _local_lock:
+        artifact = _local_artifacts.get(key)
+        if artifact is not None:
+            _local_artifacts.move_to_end(key)
+            metrics.record_cache('rbac_artifact', True)
+            return artifact
+
+    try:
+        artifact = cache.get(key)
+    except Exception as e:
+        print(f"⚠️ 读取权限缓存失败: {e}")
+        artifact = None
+
+    metrics.record_cache('rbac_artifact', artifact is not None)
+    if artifact is None:
+        if role_ids is None:
+            return None
+        artifact = compile_role_set(role_ids)
+        artifact['hash'] = role_hash
+        artifact['version'] = version
+        try:
+            cache.set(key, artifact, getattr(settings, 'RBAC_ARTIFACT_TIMEOUT', 60 * 60 * 24))
+        except Exception as e:
+            print(f"⚠️ 写入权限缓存失败: {e}")
+
+    with _local_lock:
+        _local_artifacts[key] = artifact
+        while len(_local_artifacts) > _LOCAL_MAX_SIZE:
+            _local_artifacts.popitem(last=False)
+    return artifact
+
+
+def bind_user(request, user_id) -> Dict[str, Any]:
+    """按用户当前的角色取得数据，并把角色组合哈希和版本号写入 session"""
+    version = get_permission_version()
+    role_ids = get_user_role_ids(user_id)
+    role_hash = role_set_hash(role_ids)
+    artifact = get_artifact(role_hash, version, role_ids)
+    request.session[ROLE_SET_SESSION_KEY] = {'hash': role_hash, 'version': version}
+    # 旧版本把整份字典放在 session 中，顺便清掉
+    request.session.pop(settings.PERMISSION_SESSION_KEY, None)
+    request.session.pop(settings.MENU_SESSION_KEY, None)
+    request._rbac_artifact = artifact
+    return artifact
+
+
+def get_request_artifact(request) -> Optional[Dict[str, Any]]:
+    """
+    当前请求用户的权限/菜单数据（同一请求内只解析一次）
+    未登录返回 None；版本变化或缓存失效时按用户最新角色重新取得
+    """
+    if hasattr(request, '_rbac_artifact'):
+        return request._rbac_artifact
+
+    artifact = None
+    user_id = request.session.get('user_id')
+    if user_id:
+        role_set = request.session.get(ROLE_SET_SESSION_KEY)
+        version = get_permission_version()
+        if role_set and role_set.get('version') == version:
+            artifact = get_artifact(role_set['hash'], version)
+        if artifact is None:
+            artifact = bind_user(request, user_id)
+    request._rbac_artifact = artifact
+    return artifact
+
+
+def get_permission_dict(request) -> Dict[str, Dict[str, Any]]:
+    artifact = get_request_artifact(request)
+    return artifact['permissions'] if artifact else {}
+
+
+def get_menu_dict(request) -> Dict[int, Dict[str, Any]]:
+    artifact = get_request_artifact(request)
+    return artifact['menus'] if artifact else {}
+
+
+def get_permission_names(request) -> frozenset:
+    """当前用户拥有的权限别名集合（同一请求内只构建一次，供按钮级权限判断）"""
+    names = getattr(request, '_rbac_permission_names', None)
+    if names is None:
+        names = request._rbac_permission_names = frozenset(get_permission_dict(request))
+    return names
+
+
+def get_fragment(artifact: Dict[str, Any], name: str, producer: Callable[[], Any]) -> Any:
+    """
+    按 (版本, 角色组合哈希, name) 缓存由权限数据派生的内容：进程内缓存 -> 共享缓存 -> producer
+    权限版本变化后键随之变化，旧内容自然失效
+    """
+    key = FRAGMENT_CACHE_KEY % (artifact.get('version'), artifact['hash'], name)
+    with _local_lock:
+        value = _local_fragments.get(key)
+        if value is not None:
+            _local_fragments.move_to_end(key)
+            metrics.record_cache('rbac_fragment', True)
+            return value
+
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        print(f"⚠️ 读取权限缓存失败: {e}")
+        value = None
+
+    metrics.record_cache('rbac_fragment', value is not None)
+    if value is None:
+        value = producer()
+        try:
+            cache.set(key, value, getattr(settings, 'RBAC_ARTIFACT_TIMEOUT', 60 * 60 * 24))
+        except Exception as e:
+            print(f"⚠️ 写入权限缓存失败: {e}")
+
+    with _local_lock:
+        _local_fragments[key] = value
+        while len(_local_fragments) > _LOCAL_FRAGMENT_MAX_SIZE:
+            _local_fragments.popitem(last=False)
+    return value
@@ -0,0 +1,31 @@
+"""
+角色、权限、菜单或用户角色变化时递增权限版本，使共享的权限/菜单数据失效
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import Menu, Permission, Role, UserInfo
+from .services.permission_cache import bump_permission_version
+
+
+@receiver(post_save, sender=Menu)
+@receiver(post_delete, sender=Menu)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def rbac_model_changed(sender, **kwargs):
+    bump_permission_version()
+
+
+@receiver(m2m_changed)
+def rbac_relation_changed(sender, instance, model, action, **kwargs):
+    """
+    角色分配权限、用户分配角色（两个方向的 add/remove/clear）
+    用户表继承自抽象的 rbac UserInfo，所以按子类判断
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related = {type(instance), model}
+    if Role in related and (Permission in related or any(issubclass(cls, UserInfo) for cls in related)):
+        bump_permission_version()
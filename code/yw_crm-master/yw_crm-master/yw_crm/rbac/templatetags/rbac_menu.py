@@ -1,23 +1,36 @@
 from django.template import Library
-from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from collections import OrderedDict
+from rbac.services.permission_cache import get_request_artifact, get_permission_names, get_fragment
 
 register=Library()
 
-@register.inclusion_tag('rbac/menu.html')
-def menu(request):
-    #获取session中的菜单列表
-    menu_dict=request.session.get(settings.MENU_SESSION_KEY)
+def render_menu(menu_dict,current_menu_id):
+    """
+    渲染侧边栏菜单：按菜单id升序，当前菜单所在分组默认展开
+    menu_dict由同一角色组合的用户共享，复制后再标记展开状态
+    """
     order_dict=OrderedDict()
-    if menu_dict:
-        for key in sorted(menu_dict): #按照菜单id升序对菜单进行排序
-            order_dict[key]=menu_dict[key]
-            menu_dict[key]['class']='hide'
-            for child in menu_dict[key]['children']:
-                if request.current_menu_id==child['id']:  #非菜单权限以及菜单权限默认展开
-                    child['class']='active'
-                    menu_dict[key]['class'] = ''
-        return {"menu_dict":menu_dict}
+    for key in sorted(menu_dict): #按照菜单id升序对菜单进行排序
+        item=dict(menu_dict[key],children=[dict(child) for child in menu_dict[key]['children']])
+        item['class']='hide'
+        for child in item['children']:
+            if current_menu_id==child['id']:  #非菜单权限以及菜单权限默认展开
+                child['class']='active'
+                item['class'] = ''
+        order_dict[key]=item
+    return render_to_string('rbac/menu.html',{"menu_dict":order_dict})
+
+@register.simple_tag
+def menu(request):
+    #侧边栏HTML按 (角色组合, 当前菜单id) 缓存，权限版本变化时失效
+    artifact=get_request_artifact(request)
+    if not artifact:
+        return ''
+    current_menu_id=getattr(request,'current_menu_id',None)
+    html=get_fragment(artifact,'menu:%s'%current_menu_id,lambda:render_menu(artifact['menus'],current_menu_id))
+    return mark_safe(html)
 
 @register.inclusion_tag('rbac/breadcrumb.html')
 def breadcrumb(request):
@@ -27,8 +40,5 @@ def breadcrumb(request):
 
 @register.filter()
 def has_permission(request,url_name):
-    permissions_dict=request.session.get(settings.PERMISSION_SESSION_KEY)
-    if url_name in permissions_dict:
-        return True
-    else:
-        return False
+    #同一请求内的多个按钮共用一个权限别名集合
+    return url_name in get_permission_names(request)
@@ -1,3 +1,153 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import RequestFactory, TestCase
+
+from crm.models import DepartMent, UserInfo
+from rbac.models import Menu, Permission, Role
+from rbac.services import permission_cache
+from rbac.templatetags import rbac_menu
+from utils.cache import shared_cache
+
+
+class RbacTestCase(TestCase):
+    """两个角色组合相同的用户，及其客户管理菜单"""
+
+    def setUp(self):
+        shared_cache.clear()
+        permission_cache._local_artifacts.clear()
+        permission_cache._local_fragments.clear()
+        self.factory = RequestFactory()
+
+        menu = Menu.objects.create(title='客户管理', icon='fa fa-user')
+        self.customer_list = Permission.objects.create(title='客户列表', url='/customer/list/', name='customer_list', menu=menu)
+        self.customer_add = Permission.objects.create(title='添加客户', url='/customer/add/', name='customer_add', parent=self.customer_list)
+        self.order_list = Permission.objects.create(title='订单列表', url='/order/list/', name='order_list')
+
+        self.sales = Role.objects.create(title='销售')
+        self.sales.permissions.add(self.customer_list, self.customer_add)
+        self.manager = Role.objects.create(title='主管')
+        self.manager.permissions.add(self.customer_list)
+
+        department = DepartMent.objects.create(name='销售部')
+        self.alice = self.create_user('alice', department, self.sales, self.manager)
+        self.bob = self.create_user('bob', department, self.manager, self.sales)
+
+    @staticmethod
+    def create_user(username, department, *roles):
+        user = UserInfo.objects.create(username=username, password='x', email='', name=username, phone='', gender=1, department=department)
+        user.roles.add(*roles)
+        return user
+
+    def make_request(self, session):
+        request = self.factory.get('/')
+        request.session = session
+        return request
+
+
+class PermissionCacheTests(RbacTestCase):
+    """按角色组合共享的权限/菜单数据"""
+
+    def test_role_set_hash_ignores_order_and_duplicates(self):
+        self.assertEqual(permission_cache.role_set_hash([2, 1, 2]), permission_cache.role_set_hash([1, 2]))
+        self.assertNotEqual(permission_cache.role_set_hash([1]), permission_cache.role_set_hash([1, 2]))
+
+    def test_compile_role_set(self):
+        artifact = permission_cache.compile_role_set([self.sales.id, self.manager.id])
+        self.assertEqual(set(artifact['permissions']), {'customer_list', 'customer_add'})
+        self.assertEqual(artifact['permissions']['customer_add']['pid'], self.customer_list.id)
+        self.assertEqual(artifact['permissions']['customer_add']['pname'], 'customer_list')
+        menu = artifact['menus'][self.customer_list.menu_id]
+        # 两个角色都有客户列表，菜单中只出现一次
+        self.assertEqual(menu['children'], [{'id': self.customer_list.id, 'title': '客户列表', 'url': '/customer/list/'}])
+
+    def test_users_with_same_roles_share_artifact(self):
+        first = permission_cache.bind_user(self.make_request({}), self.alice.id)
+        # 第二个用户只需查询角色，权限数据直接复用
+        with self.assertNumQueries(1):
+            second = permission_cache.bind_user(self.make_request({}), self.bob.id)
+        self.assertIs(first, second)
+
+    def test_session_keeps_only_hash_and_version(self):
+        session = {'permission_dict': {'old': {}}, 'menu_dict': {}}
+        permission_cache.bind_user(self.make_request(session), self.alice.id)
+        self.assertEqual(set(session), {permission_cache.ROLE_SET_SESSION_KEY})
+        self.assertEqual(set(session[permission_cache.ROLE_SET_SESSION_KEY]), {'hash', 'version'})
+
+    def test_request_artifact_resolved_from_session(self):
+        session = {'user_id': self.alice.id}
+        permission_cache.get_request_artifact(self.make_request(session))
+        with self.assertNumQueries(0):
+            request = self.make_request(session)
+            self.assertIn('customer_add', permission_cache.get_permission_dict(request))
+            self.assertEqual(permission_cache.get_permission_names(request), frozenset({'customer_list', 'customer_add'}))
+
+    def test_anonymous_request_has_no_artifact(self):
+        request = self.make_request({})
+        self.assertIsNone(permission_cache.get_request_artifact(request))
+        self.assertEqual(permission_cache.get_menu_dict(request), {})
+
+    def test_role_change_applies_without_relogin(self):
+        session = {'user_id': self.alice.id}
+        permission_cache.get_request_artifact(self.make_request(session))
+
+        self.manager.permissions.add(self.order_list)
+        self.assertIn('order_list', permission_cache.get_permission_dict(self.make_request(session)))
+
+        self.alice.roles.remove(self.manager)
+        self.assertNotIn('order_list', permission_cache.get_permission_dict(self.make_request(session)))
+
+    def test_fragment_cached_per_version(self):
+        artifact = permission_cache.bind_user(self.make_request({}), self.alice.id)
+        calls = []
+
+        def producer():
+            calls.append(1)
+            return '<ul>%s</ul>' % len(calls)
+
+        self.assertEqual(permission_cache.get_fragment(artifact, 'menu', producer), '<ul>1</ul>')
+        self.assertEqual(permission_cache.get_fragment(artifact, 'menu', producer), '<ul>1</ul>')
+
+        Menu.objects.create(title='订单管理')
+        artifact = permission_cache.bind_user(self.make_request({}), self.alice.id)
+        self.assertEqual(permission_cache.get_fragment(artifact, 'menu', producer), '<ul>2</ul>')
+
+
+class MenuTagTests(RbacTestCase):
+    """侧边栏HTML按（角色组合, 当前菜单）缓存，不修改共享的菜单数据"""
+
+    def make_menu_request(self, current_menu_id=None):
+        request = self.make_request({'user_id': self.alice.id})
+        request.current_menu_id = current_menu_id
+        return request
+
+    def test_marks_active_menu_without_mutating_shared_data(self):
+        html = rbac_menu.menu(self.make_menu_request(self.customer_list.id))
+        self.assertIn('class="active"', html)
+        self.assertIn('/customer/list/', html)
+        menu = permission_cache.get_menu_dict(self.make_menu_request())[self.customer_list.menu_id]
+        self.assertNotIn('class', menu)
+        self.assertNotIn('class', menu['children'][0])
+
+    def test_rendered_once_per_role_set_and_menu(self):
+        rbac_menu.menu(self.make_menu_request(self.customer_list.id))
+        with mock.patch.object(rbac_menu, 'render_menu', wraps=rbac_menu.render_menu) as render:
+            # 相同角色组合的另一个用户直接复用
+            request = self.make_request({'user_id': self.bob.id})
+            request.current_menu_id = self.customer_list.id
+            with self.assertNumQueries(1):
+                rbac_menu.menu(request)
+            render.assert_not_called()
+            # 当前菜单不同，单独渲染
+            self.assertNotIn('class="active"', rbac_menu.menu(self.make_menu_request()))
+            self.assertEqual(render.call_count, 1)
+
+    def test_permission_change_rerenders(self):
+        rbac_menu.menu(self.make_menu_request())
+        order_menu = Menu.objects.create(title='订单管理')
+        self.order_list.menu = order_menu
+        self.order_list.save()
+        self.sales.permissions.add(self.order_list)
+        self.assertIn('/order/list/', rbac_menu.menu(self.make_menu_request()))
+
+    def test_anonymous_renders_nothing(self):
+        self.assertEqual(rbac_menu.menu(self.make_request({})), '')
@@ -7,7 +7,7 @@ from django.utils.safestring import mark_safe
 from django.urls import reverse
 from django import forms
 from django.db.models import Q
-from django.http import QueryDict
+from django.http import QueryDict, JsonResponse
 from django.db.models import ForeignKey, ManyToManyField, OneToOneField
 from django.utils.safestring import mark_safe
 from django.forms import ModelForm
@@ -179,12 +179,74 @@ class BaseStark(object):
     list_filter = []
     list_editable= []
     filter_horizontal=[]
+    m2m_label_fields={}  # filter_horizontal中多对多字段显示用的列，如{'roles':'title'}
+    m2m_page_size=100  # 左侧可选项一次最多加载的条数，其余通过搜索/翻页向服务端获取
     has_add_btn=True
 
     def get_filter_horizontal(self):
 
         return self.filter_horizontal
 
+    def get_m2m_label_field(self,field_obj):
+        """
+        多对多选项显示的列，优先取m2m_label_fields中的配置，否则依次尝试title、name、username
+        返回None时退回到str(obj)
+        """
+        label_field=self.m2m_label_fields.get(field_obj.name)
+        if label_field:
+            return label_field
+        remote_field_names={f.name for f in field_obj.remote_field.model._meta.concrete_fields}
+        for name in ('title','name','username'):
+            if name in remote_field_names:
+                return name
+        return None
+
+    def get_m2m_choices(self,field_obj,exclude=None,q='',after=None):
+        """
+        只查询(pk,显示文本)两列，按pk分页返回多对多可选项
+        用上一页最后一个pk而不是偏移量翻页，左右移动选项后不会跳过或重复
+        :param field_obj: ManyToManyField字段对象
+        :param exclude: 需要排除的pk（已选项），可以是列表或者queryset
+        :param q: 搜索关键字
+        :param after: 上一页最后一个pk，为None时取第一页
+        :return: ([(pk,text),...], has_more)
+        """
+        remote_model=field_obj.remote_field.model
+        label_field=self.get_m2m_label_field(field_obj)
+        queryset=remote_model.objects.all()
+        if exclude is not None:
+            queryset=queryset.exclude(pk__in=exclude)
+        if q and label_field:
+            queryset=queryset.filter(**{'%s__icontains' % label_field:q})
+        if after is not None:
+            queryset=queryset.filter(pk__gt=after)
+        queryset=queryset.order_by('pk')
+        end=self.m2m_page_size+1  # 多取一条用来判断是否还有下一页
+        if label_field:
+            rows=list(queryset.values_list('pk',label_field)[:end])
+        else:
+            rows=[(obj.pk,str(obj)) for obj in queryset[:end]]
+        has_more=len(rows)>self.m2m_page_size
+        return rows[:self.m2m_page_size],has_more
+
+    def m2m_options_view(self,request,field_name,*args,**kwargs):
+        """
+        多对多左侧可选项的搜索/翻页接口，返回json
+        GET参数：q 搜索关键字，after 上一页最后一个pk，exclude 需要排除的pk（已选项等，可多个）
+        配置了filter_horizontal的stark类使用；权限与其它stark路由一样由rbac中间件按url校验
+        """
+        try:
+            field_obj=self.model_class._meta.get_field(field_name)
+        except Exception:
+            field_obj=None
+        if not isinstance(field_obj,ManyToManyField):
+            return JsonResponse({'status':False,'error':'字段不存在'},status=404)
+        after=request.GET.get('after','')
+        after=int(after) if after.isdigit() else None
+        exclude=[pk for pk in request.GET.getlist('exclude') if pk.isdigit()]
+        rows,has_more=self.get_m2m_choices(field_obj,exclude=exclude,q=request.GET.get('q','').strip(),after=after)
+        return JsonResponse({'status':True,'results':rows,'has_more':has_more,'last':rows[-1][0] if rows else after})
+
     def get_list_editable(self):
 
         return self.list_editable
@@ -315,6 +377,10 @@ class BaseStark(object):
     def get_del_url_name(self):
         return self.get_url_name('del')
 
+    @property
+    def get_m2m_url_name(self):
+        return self.get_url_name('m2m')
+
     def reverse_common_url(self,name,*args,**kwargs):
         common_name = "%s:%s" % (self.site.namespace, name,)
         base_url = reverse(common_name,args=args,kwargs=kwargs)
@@ -582,9 +648,10 @@ class BaseStark(object):
     def add_view(self,request,*args,**kwargs):
         # 处理所有添加功能，使用ModelForm来实现
         Add_Model_Form = self.get_model_form_class(True,request,None,*args,**kwargs)
+        el=EditList(self,request,None,self.get_filter_horizontal(),*args,**kwargs)
         if request.method == 'GET':
             form = Add_Model_Form(request=request)
-            return render(request, 'stark/change.html', {'form': form,'starkclass':self})
+            return render(request, 'stark/change.html', {'form': form,'starkclass':self,'el':el})
         form = Add_Model_Form(request=request,data=request.POST)
         if form.is_valid():
             obj=self.save(request,form,False,*args,**kwargs)
@@ -595,7 +662,7 @@ class BaseStark(object):
                 return render(request,'stark/pop.html',res)
 
             return redirect(self.reverse_changelist_url(*args,**kwargs))
-        return render(request, 'stark/change.html', {'form': form})
+        return render(request, 'stark/change.html', {'form': form,'el':el})
 
     def change_view(self, request,pk,*args,**kwargs):
         """
@@ -608,15 +675,15 @@ class BaseStark(object):
         obj = self.model_class.objects.filter(pk=pk).first()
         if not obj:
             return HttpResponse('该用户不存在')
+        filter_horizontal=self.get_filter_horizontal()
+        el=EditList(self,request,pk,filter_horizontal,*args,**kwargs)#修改和添加共用一个页面，所以form没有进行封装
         if request.method == 'GET':
             form = Edit_Model_Form(request,instance=obj)
-            return render(request, 'stark/change.html', {'form': form})
+            return render(request, 'stark/change.html', {'form': form,'el':el})
         form = Edit_Model_Form(request=request,data=request.POST,instance=obj)
         if form.is_valid():
             self.save(request,form,True,*args,**kwargs)
             return redirect(self.reverse_changelist_url(*args,**kwargs))
-        filter_horizontal=self.get_filter_horizontal()
-        el=EditList(self,request,pk,filter_horizontal,*args,**kwargs)#修改和添加共用一个页面，所以form没有进行封装
         return render(request, 'stark/change.html', {'form': form,'el':el})
 
     def del_view(self, request,pk,*args,**kwargs):
@@ -650,6 +717,7 @@ class BaseStark(object):
             re_path('add/$', self.wrapper(self.add_view), name=self.get_add_url_name),
             re_path(r'(?P<pk>\d+)/change/$', self.wrapper(self.change_view), name=self.get_edit_url_name),
             re_path(r'(?P<pk>\d+)/del/$', self.wrapper(self.del_view), name=self.get_del_url_name),
+            re_path(r'm2m/(?P<field_name>\w+)/$', self.wrapper(self.m2m_options_view), name=self.get_m2m_url_name),
 
         ]
         extra_urls = self.extra_urls()
@@ -20,8 +20,15 @@
         }
 
         function M2mSearch(ths) {
+            var $select = $(ths).next();
+            if ($select.attr('remote_url')) {
+                // 可选项较多时只加载了第一页，搜索交给服务端
+                $select.attr('last_pk', '');
+                M2mFetch($select, $(ths).val(), false);
+                return
+            }
             var $searchText = $(ths).val().toUpperCase();
-            $(ths).next().children().each(function () {
+            $select.children().each(function () {
                 var $matchText = $(this).text().toUpperCase().search($searchText);
                 if ($matchText != -1) {
                     $(this).show()
@@ -31,4 +38,49 @@
             })
 
 
+        }
+
+        function M2mLoadMore(from_id) {
+            var $select = $('#' + from_id);
+            M2mFetch($select, $select.prev().val(), true);
+        }
+
+        function M2mFetch($select, q, append) {
+            var target_id = $select.attr('target_id');
+            var after = append ? $select.attr('last_pk') : '';
+            // 按pk翻页：排除右侧已选项，以及从右侧移回、pk在下一页范围内的选项（避免重复）
+            var exclude = [];
+            $('#' + target_id).children().each(function () {
+                exclude.push($(this).val())
+            });
+            if (append) {
+                $select.children().each(function () {
+                    if (parseInt($(this).val()) > parseInt(after)) {
+                        exclude.push($(this).val())
+                    }
+                });
+            }
+            $.ajax({
+                url: $select.attr('remote_url'),
+                type: 'GET',
+                traditional: true,
+                data: {q: q, after: after, exclude: exclude},
+                success: function (res) {
+                    if (!res.status) {
+                        return
+                    }
+                    if (!append) {
+                        $select.empty();
+                    }
+                    $select.attr('last_pk', res.last === null ? '' : res.last);
+                    $.each(res.results, function (i, row) {
+                        var op = $('<option></option>');
+                        op.attr('ondblclick', 'MoveElement(this,"' + target_id + '")');
+                        op[0].value = row[0];
+                        op[0].text = row[1];
+                        $select.append(op);
+                    });
+                    $('#' + $select.attr('id').replace(/_from$/, '_more')).toggle(res.has_more);
+                }
+            })
         }
\ No newline at end of file
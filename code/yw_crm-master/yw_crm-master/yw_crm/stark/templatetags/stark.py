@@ -86,6 +86,32 @@ def gen_is_pop(bfield,starkclass):
     return bfield
 
 
+def _m2m_choices(form,field,stark_class):
+    """
+    一个表单中每个多对多字段只查询一次，结果缓存在form对象上
+    只取(pk,显示文本)两列，不实例化模型对象；左侧可选项按m2m_page_size分页，剩余的通过m2m接口获取
+    :return: {'data':[(pk,text),...],'un_data':[(pk,text),...],'has_more':bool} 或 None
+    """
+    field_obj=stark_class.model_class._meta.get_field(field.name)
+    if not isinstance(field_obj,ManyToManyField):
+        return None
+    cache=form.__dict__.setdefault('_m2m_choices_cache',{})
+    if field_obj.name in cache:
+        return cache[field_obj.name]
+    selected=[]
+    selected_pk=None
+    if form.instance.pk:
+        related=getattr(form.instance,field_obj.name).all()
+        label_field=stark_class.get_m2m_label_field(field_obj)
+        if label_field:
+            selected=list(related.values_list('pk',label_field))
+        else:
+            selected=[(obj.pk,str(obj)) for obj in related]
+        selected_pk=[pk for pk,text in selected]
+    data,has_more=stark_class.get_m2m_choices(field_obj,exclude=selected_pk)
+    cache[field_obj.name]={'data':data,'un_data':selected,'has_more':has_more}
+    return cache[field_obj.name]
+
 @register.simple_tag()
 def m2m_data(form,field,stark_class):
     """
@@ -93,17 +119,11 @@ def m2m_data(form,field,stark_class):
     :param form:
     :param field:
     :param stark_class:
-    :return:
+    :return: [(pk,text),...]
     """
-    field_name=field.name
-    field_obj=stark_class.model_class._meta.get_field(field_name)
-    if isinstance(field_obj,ManyToManyField):
-        data_set = set(field_obj.remote_field.model.objects.all())
-        if form.instance.id:
-            selected_data_set=set(getattr(form.instance,field_obj.name).all())
-            queryset=data_set-selected_data_set
-            return queryset
-        return data_set
+    choices=_m2m_choices(form,field,stark_class)
+    if choices:
+        return choices['data']
 
 @register.simple_tag()
 def m2m_un_data(form,field,stark_class):
@@ -111,20 +131,17 @@ def m2m_un_data(form,field,stark_class):
     出项在左侧已选项
     :param form:
     :param field:
-    :return:
+    :return: [(pk,text),...]
     """
-    field_name = field.name
-    field_obj=stark_class.model_class._meta.get_field(field_name)
-    if isinstance(field_obj,ManyToManyField):
-        if form.instance.id:
-            selected_data_set = getattr(form.instance, field_obj.name).all()
-            return selected_data_set
-        else:
-            return []
+    choices=_m2m_choices(form,field,stark_class)
+    if choices:
+        return choices['un_data']
+    return []
 
 @register.inclusion_tag('stark/m2m.html')
 def m2m_all_data(form,field,stark_class):
-    return {'m2m_data':m2m_data(form,field,stark_class),'m2m_un_data':m2m_un_data(form,field,stark_class),'field':field}
-
-
-
+    choices=_m2m_choices(form,field,stark_class) or {}
+    remote_url=reverse('%s:%s'%(stark_class.site.namespace,stark_class.get_m2m_url_name),kwargs={'field_name':field.name})
+    return {'m2m_data':choices.get('data',[]),'m2m_un_data':choices.get('un_data',[]),
+            'has_more':choices.get('has_more',False),'remote_url':remote_url,'field':field,
+            'last_pk':choices['data'][-1][0] if choices.get('data') else ''}
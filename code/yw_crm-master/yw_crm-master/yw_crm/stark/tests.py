@@ -1,3 +1,66 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django import forms
+from django.test import RequestFactory, TestCase
+
+from crm.models import DepartMent, UserInfo
+from rbac.models import Role
+from stark.service.base_stark import BaseStark
+from stark.service.stark import site
+from stark.templatetags.stark import m2m_data, m2m_un_data
+
+
+class UserRoleStark(BaseStark):
+    filter_horizontal = ['roles']
+    m2m_page_size = 2
+
+
+class UserRoleForm(forms.ModelForm):
+    class Meta:
+        model = UserInfo
+        fields = ['roles']
+
+
+class M2mOptionsTests(TestCase):
+    """多对多选项：只取(pk,文本)，按pk分页和搜索"""
+
+    def setUp(self):
+        self.stark = UserRoleStark(UserInfo, site, None)
+        self.factory = RequestFactory()
+        self.roles = [Role.objects.create(title=title) for title in ('销售', '销售主管', '财务', '印刷', '质检')]
+
+    def options(self, **params):
+        response = self.stark.m2m_options_view(self.factory.get('/', params), 'roles')
+        return response.status_code, json.loads(response.content)
+
+    def test_pages_by_last_pk(self):
+        _, first = self.options()
+        self.assertEqual([row[1] for row in first['results']], ['销售', '销售主管'])
+        self.assertTrue(first['has_more'])
+
+        _, second = self.options(after=first['last'])
+        self.assertEqual([row[1] for row in second['results']], ['财务', '印刷'])
+        _, last = self.options(after=second['last'])
+        self.assertEqual(([row[1] for row in last['results']], last['has_more']), (['质检'], False))
+
+    def test_search_and_exclude(self):
+        _, data = self.options(q='销售', exclude=[self.roles[0].pk])
+        self.assertEqual(data['results'], [[self.roles[1].pk, '销售主管']])
+        self.assertFalse(data['has_more'])
+
+    def test_unknown_or_non_m2m_field(self):
+        response = self.stark.m2m_options_view(self.factory.get('/'), 'department')
+        self.assertEqual(response.status_code, 404)
+        response = self.stark.m2m_options_view(self.factory.get('/'), 'missing')
+        self.assertEqual(response.status_code, 404)
+
+    def test_form_choices_queried_once(self):
+        department = DepartMent.objects.create(name='销售部')
+        user = UserInfo.objects.create(username='alice', password='x', email='', name='alice', phone='', gender=1,
+                                       department=department)
+        user.roles.add(self.roles[2])
+        form = UserRoleForm(instance=user)
+        field = form['roles']
+        with self.assertNumQueries(2):
+            self.assertEqual(m2m_data(form, field, self.stark), [(self.roles[0].pk, '销售'), (self.roles[1].pk, '销售主管')])
+            self.assertEqual(m2m_un_data(form, field, self.stark), [(self.roles[2].pk, '财务')])
@@ -8,6 +8,7 @@ class WebSocketClient {
         this.maxReconnectAttempts = 5;
         this.reconnectAttempts = 0;
         this.isConnected = false;
+        this.authToken = sessionStorage.getItem('wsAuthToken'); // 重连时免查session的签名令牌
         this.messageHandlers = {};
         this.init();
     }
@@ -20,7 +21,10 @@ class WebSocketClient {
     connect() {
         try {
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            const wsUrl = `${protocol}//${window.location.host}/ws/notifications/`;
+            let wsUrl = `${protocol}//${window.location.host}/ws/notifications/`;
+            if (this.authToken) {
+                wsUrl += `?token=${encodeURIComponent(this.authToken)}`;
+            }
             
             this.socket = new WebSocket(wsUrl);
             this.bindSocketEvents();
@@ -66,6 +70,10 @@ class WebSocketClient {
         
         switch (messageType) {
             case 'connection_established':
+                if (data.token) {
+                    this.authToken = data.token;
+                    sessionStorage.setItem('wsAuthToken', data.token);
+                }
                 this.showNotification('连接成功', 'success');
                 break;
             case 'order_notification':
@@ -80,6 +88,9 @@ class WebSocketClient {
             case 'general_notification':
                 this.handleGeneralNotification(data.data);
                 break;
+            case 'deadline_alert':
+                this.handleDeadlineAlert(data.data);
+                break;
             default:
                 console.log('未知消息类型:', messageType, data);
         }
@@ -127,6 +138,10 @@ class WebSocketClient {
         this.showNotification(data.message, data.type);
     }
 
+    handleDeadlineAlert(data) {
+        this.showNotification(data.message, data.stage === 'overdue' ? 'error' : 'info');
+    }
+
     updateDashboardStats(data) {
         // 更新仪表板统计数据
         const elements = {
@@ -0,0 +1,14 @@
+"""
+多进程共享的缓存
+订单数据版本、按角色组合编译的权限、对话会话等需要各 worker 一致的数据使用 CACHES['shared']（Redis），
+default 仍是进程内缓存，Redis 不可用时不影响其它使用 default 的功能；
+没有配置 shared 时退回 default
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+
+SHARED_CACHE_ALIAS = 'shared' if 'shared' in settings.CACHES else 'default'
+
+shared_cache = ConnectionProxy(caches, SHARED_CACHE_ALIAS)
@@ -1,54 +1,120 @@
 from django.shortcuts import HttpResponse
 import os
+import io
+import random
+import threading
+from collections import deque
+from functools import lru_cache
 from django.conf import settings
 
-def get_verify_code(request):
+#定义验证码的备选值
+CODE_CHARS = '1234567890QWERTYUIOPASDFGHJKLZXCVBNMqwertyuiopasdfghjklzxcvbnm'
+WIDTH = 95
+HEIGHT = 34
+#4个字的横坐标
+CHAR_OFFSETS = (5, 25, 50, 75)
+
+
+@lru_cache(maxsize=1)
+def get_font():
+    """字体对象只从磁盘加载一次"""
+    from PIL import ImageFont
+    return ImageFont.truetype(os.path.join(settings.BASE_DIR, 'static/fonts/Monaco.ttf'), 30)
+
+
+def generate_captcha():
+    """
+    生成一张验证码图片
+    :return: (验证码值, png图片数据)
+    """
     #引入绘图模块
-    from PIL import Image, ImageDraw, ImageFont
-    #引入随机函数模块
-    import random
-    #定义变量，用于画面的背景色、宽、高
-    bgcolor = (random.randrange(20, 100), random.randrange(
-        20, 100), random.randrange(20, 100))
-    width = 95
-    height = 34
+    from PIL import Image, ImageDraw
+    #定义变量，用于画面的背景色
+    bgcolor = (random.randrange(20, 100), random.randrange(20, 100), random.randrange(20, 100))
     #创建画面对象
-    im = Image.new('RGB', (width, height), bgcolor)
+    im = Image.new('RGB', (WIDTH, HEIGHT), bgcolor)
     #创建画笔对象
     draw = ImageDraw.Draw(im)
     #调用画笔的point()函数绘制噪点
     for i in range(0, 100):
-        xy = (random.randrange(0, width), random.randrange(0, height))
+        xy = (random.randrange(0, WIDTH), random.randrange(0, HEIGHT))
         fill = (random.randrange(0, 255), 255, random.randrange(0, 255))
         draw.point(xy, fill=fill)
-    #定义验证码的备选值
-    str = '1234567890QWERTYUIOPASDFGHJKLZXCVBNMqwertyuiopasdfghjklzxcvbnm'
     #随机选取4个值作为验证码
-    rand_str = ''
-    for i in range(0, 4):
-        rand_str += str[random.randrange(0, len(str))]
-    #构造字体对象
-    font = ImageFont.truetype(os.path.join(settings.BASE_DIR,'static/fonts/Monaco.ttf',), 30)
-    #构造字体颜色
-    fontcolor1 = (255, random.randrange(0, 255), random.randrange(0, 255))
-    fontcolor2 = (255, random.randrange(0, 255), random.randrange(0, 255))
-    fontcolor3 = (255, random.randrange(0, 255), random.randrange(0, 255))
-    fontcolor4 = (255, random.randrange(0, 255), random.randrange(0, 255))
-    #绘制4个字
-    draw.text((5, 2), rand_str[0], font=font, fill=fontcolor1)
-    draw.text((25, 2), rand_str[1], font=font, fill=fontcolor2)
-    draw.text((50, 2), rand_str[2], font=font, fill=fontcolor3)
-    draw.text((75, 2), rand_str[3], font=font, fill=fontcolor4)
+    rand_str = ''.join(random.choice(CODE_CHARS) for i in range(0, 4))
+    #绘制4个字，字体颜色随机
+    font = get_font()
+    for x, char in zip(CHAR_OFFSETS, rand_str):
+        draw.text((x, 2), char, font=font, fill=(255, random.randrange(0, 255), random.randrange(0, 255)))
     #释放画笔
     del draw
 
-    #内存文件操作
-    import io
+    #内存文件操作，将图片保存在内存中，文件类型为png
     buf = io.BytesIO()
-    #将图片保存在内存中，文件类型为png
     im.save(buf, 'png')
+    return rand_str, buf.getvalue()
+
+
+class CaptchaPool(object):
+    """
+    预生成的验证码池：后台线程批量生成并补充，请求时直接取出一张（每张只使用一次）
+    池为空时（如刚启动或上班高峰）在请求中现场生成
+    """
+
+    def __init__(self, size=None, low_water=None):
+        self.size = size or getattr(settings, 'CAPTCHA_POOL_SIZE', 200)
+        self.low_water = low_water or getattr(settings, 'CAPTCHA_POOL_LOW_WATER', 50)
+        self._items = deque(maxlen=self.size)
+        self._need_refill = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.served = 0
+        self.inline = 0
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refill_loop, name='captcha-pool', daemon=True)
+                self._thread.start()
+
+    def _refill_loop(self):
+        while True:
+            self._need_refill.wait()
+            self._need_refill.clear()
+            try:
+                while len(self._items) < self.size:
+                    self._items.append(generate_captcha())
+            except Exception as e:
+                print(f"⚠️ 验证码池补充失败: {e}")
+
+    def get(self):
+        """
+        取一张验证码
+        :return: (验证码值, png图片数据)
+        """
+        self._ensure_worker()
+        try:
+            item = self._items.popleft()
+            self.served += 1
+        except IndexError:
+            item = None
+        if len(self._items) < self.low_water:
+            self._need_refill.set()
+        if item is None:
+            self.inline += 1
+            item = generate_captcha()
+        return item
+
+
+captcha_pool = CaptchaPool()
+
+
+def get_verify_code(request):
+    rand_str, image = captcha_pool.get()
     #将内存中的图片数据返回给客户端，MIME类型为图片png
-    response = HttpResponse(buf.getvalue(),'image/png')
+    response = HttpResponse(image,'image/png')
 
     #将验证码的值写入cookie，以被前端浏览器验证验证码
     # response.set_cookie("verifycode", rand_str)
@@ -56,4 +122,4 @@ def get_verify_code(request):
     # 存入session，用于做进一步验证
     request.session['verifycode'] = rand_str
 
-    return response
\ No newline at end of file
+    return response
@@ -3,9 +3,11 @@ from django.views import View
 from django.http import HttpResponse, JsonResponse
 from crm.models import PrintOrderFlat, OrderProgress
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
 import os
-from crm.utils import is_mobile_device, is_root_user, get_device_type, get_user_type
+import hmac
+from django.conf import settings
+from crm.utils import is_mobile_device, is_root_user, get_device_type, get_user_type, get_current_user
 from crm.ai_assistant import ai_assistant
 from crm.models import UserInfo
 # 新增：导入权限装饰器
@@ -301,8 +303,7 @@ class MobileOrderDetailView(View):
             progress_percentage = int(((completed_steps + skipped_steps) / total_steps * 100)) if total_steps > 0 else 0
 
             # 新增：获取当前用户
-            from crm.models import UserInfo
-            user = UserInfo.objects.filter(id=request.session.get('user_id')).first()
+            user = get_current_user(request)
 
             # 计算每个步骤是否可开始，并检查权限
             for step in progress_steps:
@@ -792,7 +793,7 @@ class AIAnalyzeAnomaliesAPI(View):
 
 
 class AICheckDeadlinesAPI(View):
-    """AI交期检查API"""
+    """AI交期检查API（用户点击时生成交期明细报告；到点提醒由交期调度器推送，页面不轮询）"""
     
     def post(self, request):
         # 检查权限
@@ -809,6 +810,115 @@ class AICheckDeadlinesAPI(View):
             })
 
 
+class AITrendReportAPI(View):
+    """AI历史趋势报告API（读取每日运营汇总表）"""
+    
+    def post(self, request):
+        # 检查权限
+        if not is_root_user(request):
+            return JsonResponse({'error': '权限不足'}, status=403)
+        
+        try:
+            days = int(request.POST.get('days') or request.GET.get('days') or 90)
+            result = ai_assistant.generate_trend_report(days)
+            return JsonResponse(result)
+        except Exception as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'趋势报告生成失败：{str(e)}'
+            })
+
+
+class PerfStatsAPI(View):
+    """请求性能统计API（仅root用户）：各视图的耗时、SQL条数/耗时和疑似N+1，?reset=1 清空"""
+    
+    def get(self, request):
+        if not is_root_user(request):
+            return JsonResponse({'error': '权限不足'}, status=403)
+        
+        from crm.middleware.instrumentation_middleware import view_stats
+        views_data = view_stats.snapshot()
+        started_at = view_stats.started_at
+        if request.GET.get('reset'):
+            view_stats.reset()
+        return JsonResponse({
+            'status': 'success',
+            'since': datetime.fromtimestamp(started_at, tz=timezone.get_current_timezone()).isoformat(),
+            'views': views_data,
+        }, json_dumps_params={'ensure_ascii': False, 'indent': 2})
+
+
+class ProfileListAPI(View):
+    """性能采样列表API（仅root用户）"""
+    
+    def get(self, request):
+        if not is_root_user(request):
+            return JsonResponse({'error': '权限不足'}, status=403)
+        
+        from crm.middleware.profiling_middleware import list_profiles
+        return JsonResponse({
+            'status': 'success',
+            'enabled': getattr(settings, 'PROFILING_ENABLED', False),
+            'profiles': list_profiles(),
+        }, json_dumps_params={'ensure_ascii': False, 'indent': 2})
+
+
+class ProfileDetailAPI(View):
+    """
+    下载一份性能采样（仅root用户）
+    ?format=collapsed 折叠栈文本（flamegraph.pl / inferno）
+    ?format=speedscope speedscope JSON（https://www.speedscope.app 直接打开）
+    默认返回原始数据
+    """
+    
+    def get(self, request, name):
+        if not is_root_user(request):
+            return JsonResponse({'error': '权限不足'}, status=403)
+        
+        from crm.middleware.profiling_middleware import load_profile, to_collapsed, to_speedscope
+        profile = load_profile(name)
+        if profile is None:
+            return JsonResponse({'error': '采样文件不存在'}, status=404)
+        
+        output_format = request.GET.get('format', 'json')
+        if output_format == 'collapsed':
+            response = HttpResponse(to_collapsed(profile), content_type='text/plain; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="{name[:-5]}.collapsed.txt"'
+            return response
+        if output_format == 'speedscope':
+            response = JsonResponse(to_speedscope(profile), json_dumps_params={'ensure_ascii': False})
+            response['Content-Disposition'] = f'attachment; filename="{name[:-5]}.speedscope.json"'
+            return response
+        return JsonResponse(profile, json_dumps_params={'ensure_ascii': False, 'indent': 2})
+
+
+class MetricsView(View):
+    """
+    Prometheus 抓取端点：请求头 Authorization: Bearer <METRICS_AUTH_TOKEN>，或已登录的root用户
+    多进程部署时汇总各进程的指标（见 crm/metrics.py）
+    """
+    
+    @staticmethod
+    def has_valid_token(request):
+        token = getattr(settings, 'METRICS_AUTH_TOKEN', '')
+        if not token:
+            return False
+        scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode())
+    
+    def get(self, request):
+        if not self.has_valid_token(request) and not is_root_user(request):
+            response = HttpResponse('unauthorized', status=401, content_type='text/plain; charset=utf-8')
+            response['WWW-Authenticate'] = 'Bearer realm="metrics"'
+            return response
+        
+        from crm.metrics import render_latest
+        content, content_type = render_latest()
+        if content is None:
+            return HttpResponse('prometheus_client 未安装', status=503, content_type='text/plain; charset=utf-8')
+        return HttpResponse(content, content_type=content_type)
+
+
 class DeviceDetectionTestAPI(View):
     """设备检测测试API"""
     
@@ -848,20 +958,57 @@ class DeviceDetectionTestAPI(View):
 # ======================
 
 class ConversationStreamAPI(View):
-    """流式对话AI API - 使用Server-Sent Events"""
+    """
+    流式对话AI API - 使用Server-Sent Events
+    异步视图：ASGI下逐事件转发 achat_stream，不占用同步工作线程；
+    WSGI下异步迭代器会被整体缓冲后才返回，因此改为同步生成器转发 chat_stream
+    """
     
-    def get(self, request):
+    @staticmethod
+    def _check_access(request):
+        """读取会话并检查权限（会话/ORM访问为同步操作）"""
+        return is_root_user(request), request.session.get('user_id')
+    
+    @staticmethod
+    def _sse(data, event=None):
         import json
+        prefix = f"event: {event}\n" if event else ''
+        return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    @classmethod
+    def _start_event(cls):
+        return cls._sse({
+            'type': 'start',
+            'message': '开始处理您的问题...',
+            'timestamp': timezone.now().isoformat()
+        })
+    
+    @classmethod
+    def _end_event(cls):
+        return cls._sse({'type': 'end', 'message': '流式响应结束'}, event='close')
+    
+    @classmethod
+    def _error_events(cls, e):
+        return cls._sse({
+            'type': 'error',
+            'message': f'抱歉，AI助手遇到了技术问题：{str(e)}',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }) + "event: close\ndata: {}\n\n"
+    
+    async def get(self, request):
         import logging
-        import asyncio
+        from asgiref.sync import sync_to_async
+        from django.core.handlers.asgi import ASGIRequest
         from django.http import StreamingHttpResponse
         
         logger = logging.getLogger(__name__)
         
         try:
             # 检查权限 - 目前只允许root用户使用
-            if not is_root_user(request):
-                logger.warning(f"流式对话AI权限不足: {request.session.get('user_id')}")
+            allowed, user_id = await sync_to_async(self._check_access)(request)
+            if not allowed:
+                logger.warning(f"流式对话AI权限不足: {user_id}")
                 return JsonResponse({'error': '权限不足，只有管理员可以使用对话功能'}, status=403)
             
             # 从查询参数获取消息
@@ -875,49 +1022,42 @@ class ConversationStreamAPI(View):
             # 导入对话AI模块
             from crm.conversation_ai import conversation_ai
             
-            # 获取用户ID
-            user_id = request.session.get('user_id')
-            
-            def generate_stream():
-                """生成SSE数据流 - 使用同步方式避免异步数据库调用问题"""
+            async def generate_stream():
+                """生成SSE数据流 - 大模型输出到达即转发"""
                 try:
                     # 发送开始事件
-                    yield "data: " + json.dumps({
-                        'type': 'start',
-                        'message': '开始处理您的问题...',
-                        'timestamp': timezone.now().isoformat()
-                    }, ensure_ascii=False) + "\n\n"
+                    yield self._start_event()
                     
-                    # 调用同步流式处理（避免异步数据库调用问题）
-                    for event_data in conversation_ai.chat_stream(user_message, user_id):
-                        # 格式化为SSE格式
-                        event_json = json.dumps(event_data, ensure_ascii=False)
-                        yield f"data: {event_json}\n\n"
+                    async for event_data in conversation_ai.achat_stream(user_message, user_id):
+                        yield self._sse(event_data)
                         
                         # 如果是完成事件，准备结束
                         if event_data.get('type') in ['complete', 'error']:
                             break
                     
                     # 确保发送结束信号
-                    yield "event: close\ndata: " + json.dumps({
-                        'type': 'end',
-                        'message': '流式响应结束'
-                    }, ensure_ascii=False) + "\n\n"
+                    yield self._end_event()
                     
                 except Exception as e:
                     logger.error(f"流式对话生成错误: {e}")
-                    error_event = {
-                        'type': 'error',
-                        'message': f'抱歉，AI助手遇到了技术问题：{str(e)}',
-                        'error': str(e),
-                        'timestamp': timezone.now().isoformat()
-                    }
-                    yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
-                    yield "event: close\ndata: {}\n\n"
+                    yield self._error_events(e)
+            
+            def generate_stream_sync():
+                """WSGI部署：由WSGI服务器在请求线程中逐块迭代"""
+                try:
+                    yield self._start_event()
+                    for event_data in conversation_ai.chat_stream(user_message, user_id):
+                        yield self._sse(event_data)
+                        if event_data.get('type') in ['complete', 'error']:
+                            break
+                    yield self._end_event()
+                except Exception as e:
+                    logger.error(f"流式对话生成错误: {e}")
+                    yield self._error_events(e)
             
             # 创建流式响应
             response = StreamingHttpResponse(
-                generate_stream(),
+                generate_stream() if isinstance(request, ASGIRequest) else generate_stream_sync(),
                 content_type='text/event-stream; charset=utf-8'
             )
             response['Cache-Control'] = 'no-cache'
@@ -935,16 +1075,18 @@ class ConversationStreamAPI(View):
                 'message': str(e)
             }, status=500)
     
-    def post(self, request):
+    async def post(self, request):
         """POST方法用于启动流式对话"""
         import json
         import logging
+        from asgiref.sync import sync_to_async
         
         logger = logging.getLogger(__name__)
         
         try:
             # 检查权限
-            if not is_root_user(request):
+            allowed, _ = await sync_to_async(self._check_access)(request)
+            if not allowed:
                 return JsonResponse({'error': '权限不足'}, status=403)
             
             # 解析请求数据
@@ -1007,21 +1149,11 @@ class ConversationChatAPI(View):
             # 导入对话AI模块
             from crm.conversation_ai import conversation_ai
             from crm.ai_assistant import ai_assistant
-            from crm.models import UserInfo
             # 获取用户ID
             user_id = request.session.get('user_id')
-            user = UserInfo.objects.filter(id=user_id).first()
-            # 查询最近20条记忆，按created_time正序
-            memories = ai_assistant.get_memories(user, memory_type='chat', limit=20)
-            memories = list(memories)[::-1]  # 反转为正序（最早的在前）
-            mcp_messages = []
-            for idx, m in enumerate(memories):
-                role = 'user' if idx % 2 == 0 else 'AI'
-                mcp_messages.append({'role': role, 'content': m.content})
-            # 加入本轮用户消息
-            mcp_messages.append({'role': 'user', 'content': user_message})
-            # 传递给AI
-            result = conversation_ai.chat(mcp_messages, user_id)
+            user = get_current_user(request)
+            # 多轮历史由 conversation_ai 按用户维护
+            result = conversation_ai.chat(user_message, user_id)
             logger.info(f"AI回复状态: {result.get('status')}")
             # 写入记忆（用户消息和AI回复）
             print('写入记忆：')
@@ -1059,7 +1191,7 @@ class ConversationHistoryAPI(View):
             
             from crm.conversation_ai import conversation_ai
             
-            summary = conversation_ai.get_conversation_summary()
+            summary = conversation_ai.get_conversation_summary(request.session.get('user_id'))
             
             return JsonResponse({
                 'status': 'success',
@@ -1081,7 +1213,7 @@ class ConversationHistoryAPI(View):
             
             from crm.conversation_ai import conversation_ai
             
-            conversation_ai.clear_history()
+            conversation_ai.clear_history(request.session.get('user_id'))
             
             return JsonResponse({
                 'status': 'success',
@@ -1115,7 +1247,8 @@ class ConversationTestAPI(View):
                 'status': 'success',
                 'test_message': test_message,
                 'ai_response': result.get('response', ''),
-                'test_successful': result.get('status') == 'success'
+                'test_successful': result.get('status') == 'success',
+                'gateway': conversation_ai.gateway.stats()
             })
             
         except Exception as e:
@@ -50,14 +50,17 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     # 'crm.middleware.crm_middleware.XssMiddleware',  # xss攻击，返回内容进行过滤
+    'crm.middleware.instrumentation_middleware.InstrumentationMiddleware',  # 请求耗时/SQL统计
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'crm.middleware.profiling_middleware.ProfilingMiddleware',  # 采样性能分析（PROFILING_ENABLED开启）
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'crm.middleware.login_required_middleware.LoginRequiredMiddleware',
+    'crm.middleware.current_user_middleware.CurrentUserMiddleware',
     'rbac.middleware.rbac_middleware.PermissionMiddleWare',
 ]
 
@@ -151,6 +154,8 @@ STATICFILES_DIRS=(
 USER_MODEL_PATH='crm.models.UserInfo'
 PERMISSION_SESSION_KEY='permission_dict'
 MENU_SESSION_KEY='menu_dict'
+# 按角色组合编译的权限/菜单数据在共享缓存中的有效期（秒），权限变化时按版本号失效
+RBAC_ARTIFACT_TIMEOUT=60*60*24
 VALID_URL=[
     '/',
     '/index/',
@@ -159,9 +164,51 @@ VALID_URL=[
     '/admin/.*',
     '/verify_code/',
     '/test/',
+    '/metrics/',
 
 ]
 
+#############性能统计配置
+# 请求耗时/SQL统计中间件开关；同一形状SQL在一个请求中重复多少次视为疑似N+1；慢请求阈值（毫秒）
+PERF_INSTRUMENTATION_ENABLED = True
+PERF_N_PLUS_ONE_THRESHOLD = 5
+PERF_SLOW_REQUEST_MS = 1000
+
+#############采样性能分析配置
+# 开启后按以下规则选中请求，在请求期间采样调用栈并保存到 PROFILING_DIR（最多保留 PROFILING_MAX_FILES 份）
+# 1. 路径匹配 PROFILING_PATH_PATTERNS 且命中采样率；2. PROFILING_USER_IDS 中的用户；3. root 用户带 X-Profile 请求头
+# WSGI 请求只采样处理该请求的线程；ASGI 请求按整个进程采样（scope=process），会混入同时段其它请求的调用栈
+# 关闭时中间件抛出 MiddlewareNotUsed 不加载，ASGI 下不会让整条中间件链退回同步
+PROFILING_ENABLED = False
+PROFILING_PATH_PATTERNS = [
+    r'^/print-orders/create/$',
+    r'^/print-dashboard/$',
+    r'^/api/conversation/stream/$',
+]
+PROFILING_SAMPLE_RATE = 0.05
+PROFILING_USER_IDS = []
+PROFILING_HEADER = 'X-Profile'
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_MAX_FILES = 200
+# 采样间隔（秒）；单个请求最长采样时间（秒）
+PROFILING_INTERVAL = 0.005
+PROFILING_MAX_SECONDS = 60
+
+#############Prometheus监控配置
+# /metrics 的抓取令牌：Prometheus 用 Authorization: Bearer <令牌> 访问（scrape 配置中的 bearer_token）
+# 未配置时只有已登录的root用户可以访问；不按来源IP放行（经反向代理时来源地址都是代理本身）
+METRICS_AUTH_TOKEN = os.environ.get('METRICS_AUTH_TOKEN', '')
+# 多进程模式的共享目录：每个 ASGI 进程把指标写到这里，抓取时汇总
+# 启动服务前先运行 python manage.py clear_metrics_dir 清空上次运行留下的文件
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.path.join(BASE_DIR, 'prometheus_multiproc')
+# prometheus_client 在导入时读取该环境变量，必须在任何模块导入它之前设置
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = PROMETHEUS_MULTIPROC_DIR
+
+#############验证码配置
+# 预生成验证码池的容量，剩余数量低于下限时后台线程补充
+CAPTCHA_POOL_SIZE = 200
+CAPTCHA_POOL_LOW_WATER = 50
+
 #############发送邮件
 # 以下这些配置信息，django会自动读取，使用账号以及授权码进行登录
 # 成功之后，就会发送邮件
@@ -191,6 +238,31 @@ CHANNEL_LAYERS = {
     },
 }
 
+#############WebSocket认证配置
+# session_key -> 用户 的进程内缓存时间（秒），退出登录后最多延迟这么久断开新连接
+WS_AUTH_CACHE_TTL = 60
+# 重连令牌有效期（秒），0 表示不签发令牌、每次都按session认证
+WS_AUTH_TOKEN_MAX_AGE = 600
+
+#############交期提醒调度器配置
+# 与数据库对账的间隔（秒）；调度器发布的紧急订单数超过该秒数未更新则回退到直接查询
+DEADLINE_RESYNC_INTERVAL = 600
+DEADLINE_COUNTS_MAX_AGE = 120
+
+#############缓存配置
+# default 为进程内缓存；shared 与通道层共用Redis（库1），各进程共享订单数据版本、权限数据、对话会话等（见 utils/cache.py）
+# 读写 shared 失败时各模块退回进程内数据，Redis 不可用只影响多进程之间的一致性
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'KEY_PREFIX': 'yw_crm',
+    },
+}
+
 #############OpenAI API配置
 # LangChain对话AI功能配置
 OPENAI_API_KEY = 'hk-rht2as1000055555695a7d72587851cc0765504d540b8b99'
@@ -199,3 +271,65 @@ OPENAI_MODEL = 'gpt-3.5-turbo'
 
 
 
+
+#############RAG对话记忆配置
+# 哈希向量维度（修改后需执行 python manage.py reembed_conversations）
+CONVERSATION_EMBEDDING_DIM = 512
+# 对话记忆异步写入：攒够条数或等待超过秒数即批量落盘；队列上限（超出丢弃）
+AI_MEMORY_BATCH_SIZE = 32
+AI_MEMORY_FLUSH_INTERVAL = 2.0
+AI_MEMORY_MAX_PENDING = 1000
+# 进程内最多保留多少个用户的向量索引（最近最少使用的先淘汰，下次检索时重新加载）
+AI_MEMORY_MAX_INDEXES = 200
+
+#############AI回复缓存配置
+# 同一用户的相同问题在订单数据未变化时复用回复（秒 / 条数）
+AI_RESPONSE_CACHE_TTL = 600
+AI_RESPONSE_CACHE_SIZE = 256
+# 相近问法命中阈值（0~1），None 表示只做精确匹配
+AI_RESPONSE_CACHE_SIMILARITY = None
+# 提示词上下文/统计信息的兜底过期时间（秒），正常情况下由订单信号使其失效
+AI_CONTEXT_CACHE_TTL = 60
+# 让大模型通过函数调用按需查询订单数据；关闭后每轮注入固定的统计+最近订单上下文
+AI_TOOL_CALLING = True
+# 单个问题最多几轮工具调用，用完后强制直接作答
+AI_MAX_TOOL_ROUNDS = 3
+# 输入提示词的token预算（系统提示+上下文+历史），较早对话的滚动摘要上限
+AI_PROMPT_TOKEN_BUDGET = 3000
+AI_SUMMARY_MAX_TOKENS = 300
+# 上下文并发收集：线程数，以及池中各来源的超时（秒，同时作为数据库语句超时），超时的来源不放入提示词
+# 会话历史和滚动摘要在请求线程直接读取，不经过线程池；线程池满时新的来源直接跳过
+AI_CONTEXT_WORKERS = 8
+AI_CONTEXT_TIMEOUTS = {
+    'order_context': 1.5,
+    'fragments': 0.5,
+}
+
+#############AI意图路由配置
+# 问题中未被词表识别的字符数超过该值就交给大模型（越小越保守）
+AI_INTENT_MAX_RESIDUAL = 1
+# 客户/业务员/步骤词表的刷新间隔（秒），到期且订单数据变化时重建
+AI_INTENT_LEXICON_TTL = 300
+
+#############AI对话会话配置
+# 每个用户保留的最近问答轮数 / 历史总字符数
+AI_SESSION_MAX_TURNS = 8
+AI_SESSION_MAX_CHARS = 6000
+# 进程内最多保留的用户会话数，空闲超时（秒）
+AI_SESSION_MAX_USERS = 500
+AI_SESSION_IDLE_TIMEOUT = 3600
+# 'local' 进程内存储；'cache' 使用 CACHES['shared'] 共享（多进程一致）
+AI_SESSION_BACKEND = 'local'
+
+#############大模型调用网关配置
+# 同时进行的大模型调用数上限 / 等待队列长度 / 最长排队时间（秒）
+LLM_MAX_CONCURRENCY = 4
+LLM_MAX_QUEUE = 16
+LLM_QUEUE_TIMEOUT = 10
+# 每个用户每分钟最多调用次数（0 表示不限；函数调用的每一轮都计一次）
+LLM_USER_RATE_PER_MINUTE = 30
+# 连续失败多少次后熔断，熔断冷却时间（秒）
+LLM_BREAKER_FAILURES = 5
+LLM_BREAKER_COOLDOWN = 30
+# 本地测试可运行 python manage.py llm_stub_server，并设置：
+# DEEPSEEK_BASE_URL = 'http://127.0.0.1:8765/v1'
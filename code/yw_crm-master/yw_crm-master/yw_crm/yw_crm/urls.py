@@ -94,6 +94,8 @@ urlpatterns = [
     path('api/ai/analyze-anomalies/', views.AIAnalyzeAnomaliesAPI.as_view(), name='ai_analyze_anomalies'),
     # AI交期检查
     path('api/ai/check-deadlines/', views.AICheckDeadlinesAPI.as_view(), name='ai_check_deadlines'),
+    # AI历史趋势报告
+    path('api/ai/trend-report/', views.AITrendReportAPI.as_view(), name='ai_trend_report'),
     
     # ==================
     # 对话AI API接口
@@ -113,6 +115,17 @@ urlpatterns = [
     # 设备检测测试
     path('api/test/device-detection/', views.DeviceDetectionTestAPI.as_view(), name='test_device_detection'),
     
+    # ==================
+    # 性能统计API
+    # ==================
+    # 各视图耗时与SQL统计（root用户）
+    path('api/perf/stats/', views.PerfStatsAPI.as_view(), name='perf_stats'),
+    # 性能采样列表与下载（collapsed / speedscope）
+    path('api/perf/profiles/', views.ProfileListAPI.as_view(), name='perf_profiles'),
+    path('api/perf/profiles/<str:name>/', views.ProfileDetailAPI.as_view(), name='perf_profile_detail'),
+    # Prometheus 指标（HTTP / WebSocket / 数据库 / 大模型 / 缓存）
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    
     # ==================
     # 手机端步骤操作API
     # ==================